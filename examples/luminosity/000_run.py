@@ -0,0 +1,62 @@
+# %% Luminosity of a round-beam IP with a crossing angle
+import numpy as np
+from madxp import luminosity
+
+parameters=dict(f=11245.5, nb=2736, N1=1.15e11, N2=1.15e11,
+                x_1=0, x_2=0, y_1=0, y_2=0,
+                px_1=160e-6, px_2=-160e-6, py_1=0, py_2=0,
+                energy_tot1=6800, energy_tot2=6800,
+                deltap_p0_1=1.1e-4, deltap_p0_2=1.1e-4,
+                epsilon_x1=2.5e-6, epsilon_x2=2.5e-6, epsilon_y1=2.5e-6, epsilon_y2=2.5e-6,
+                sigma_z1=0.0755, sigma_z2=0.0755,
+                beta_x1=0.3, beta_x2=0.3, beta_y1=0.3, beta_y2=0.3,
+                alpha_x1=0, alpha_x2=0, alpha_y1=0, alpha_y2=0,
+                dx_1=0, dx_2=0, dy_1=0, dy_2=0, dpx_1=0, dpx_2=0, dpy_1=0, dpy_2=0)
+luminosity.L(**parameters)
+
+# %% Scan of beta* and of the vertical separation in a single batched call
+my_beta=np.linspace(0.15, 1, 50)[:, np.newaxis]
+my_separation=np.linspace(0, 60e-6, 40)
+my_parameters=dict(parameters, beta_x1=my_beta, beta_x2=my_beta, beta_y1=my_beta, beta_y2=my_beta, y_1=my_separation)
+my_L, info=luminosity.L_batch(**my_parameters, full_output=True)
+print(my_L.shape, info['order'])
+
+# %% Check the batched result against the adaptive integration of L
+luminosity.check_L_batch(my_parameters, samples=10)
+
+# %% Path of the computation: closed form (large beta*) or numerical integration (hourglass effect)
+print(luminosity.L(**dict(parameters, beta_x1=11, beta_x2=11, beta_y1=11, beta_y2=11), full_output=True, rtol=1e-5))
+print(luminosity.L(**parameters, full_output=True))
+
+# %% Crab cavities: tensor-product Gauss-Hermite grid in (z, t) (milliseconds) or scipy dblquad (seconds)
+crab=dict(parameters, CC_V_x_1=3e6, CC_f_x_1=400.79e6, R12_1=21, CC_V_x_2=-3e6, CC_f_x_2=400.79e6, R12_2=21)
+print(luminosity.L(**crab, full_output=True))
+print(luminosity.L(**crab, full_output=True, cc_integration='dblquad', sigma_integration=6))
+
+# %% Leveling of the pile-up with the separation along a 12 h fill (intensity decaying with a 30 h lifetime)
+from madxp import leveling
+my_time=np.linspace(0, 12*3600, 500)
+my_intensity=1.6e11*np.exp(-my_time/(30*3600))
+my_df, integrated=leveling.level(dict(parameters, N1=my_intensity, N2=my_intensity), 'separation_y', [0, 100e-6],
+                                 target_pileup=60, time=my_time)
+print(f'Integrated luminosity: {integrated/1e39:.3f} fb^-1')
+my_df
+
+# %% Luminosity of all the IPs from the twiss tables of the two beams (a single batched call)
+from cpymad.madx import Madx
+from madxp import cpymadTool as mt
+madx=Madx(stdout=False)
+madx.input('''
+ip1: marker; ip5: marker;
+b1: sequence, l=100; ip1, at=25; ip5, at=75; endsequence;
+b2: sequence, l=100; ip1, at=25; ip5, at=75; endsequence;
+beam, sequence=b1, particle=proton, energy=6800, npart=1.15e11, exn=2.5e-6, eyn=2.5e-6, sigt=0.0755, sige=1.1e-4, kbunch=2736;
+beam, sequence=b2, particle=proton, energy=6800, npart=1.15e11, exn=2.5e-6, eyn=2.5e-6, sigt=0.0755, sige=1.1e-4, kbunch=2736;
+use, sequence=b1; twiss, betx=0.3, bety=0.3, px=160e-6, table=twiss_b1;
+use, sequence=b2; twiss, betx=0.3, bety=0.3, px=-160e-6, table=twiss_b2;
+''')
+my_beams=mt.beams_df(madx)
+# the revolution frequency of the LHC (the lines are not closed)
+my_beams['freq0']=11245.5e-6
+luminosity.twiss_luminosity(mt.twiss_df(madx.table.twiss_b1), mt.twiss_df(madx.table.twiss_b2), my_beams,
+                            ['ip1', 'ip5'], beam_b1='b1', beam_b2='b2')
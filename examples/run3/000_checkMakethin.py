@@ -1,34 +1,32 @@
 # %%
 import madxp
+import madxp.scan
 import cl2pd
 import pandas as pd
 import numpy as np
-import copy # deepcopy of dictionaries
-import gc  # garbage collector to force to free memory
 
 import matplotlib.pyplot as plt
 %matplotlib inline
 # %%
-myList=[]
 pythonData={}
 slicefactorRange=np.arange(2,9,2)
 
 pythonData['rbarc']='true'
-for makedipedgevalue in [0,1]:
-    pythonData['makedipedgevalue']=makedipedgevalue
-    for slicefactor in slicefactorRange:
-        print(slicefactor)
-        pythonData['slicefactor']=slicefactor
-        try:
-            madxp.madxp('input_thin.madx', pythonData=pythonData)
-        except FileNotFoundError:
-            import os
-            os.chdir('/afs/cern.ch/work/s/sterbini/madxp/examples/run3')
-            madxp.madxp('input_thin.madx', pythonData=pythonData)
-        myList.append(copy.deepcopy(pythonData)) # to append the pythonData dictionary
-        gc.collect() # to free memory
+# each point runs in its own process, the output and the logs are in scan/point_XXXX
+import os
+if not os.path.exists('input_thin.madx'):
+    os.chdir('/afs/cern.ch/work/s/sterbini/madxp/examples/run3')
+myDF=madxp.scan.scan('input_thin.madx', 
+                     madxp.scan.grid(makedipedgevalue=[0,1], slicefactor=slicefactorRange), 
+                     pythonData=pythonData)
+assert all(myDF['status']=='ok')
+# %% The same scan, running only once the sections up to 'Call optics file' (the MAD-X process is forked for each point)
+myDF=madxp.scan.sweep('input_thin.madx', 
+                      madxp.scan.grid(makedipedgevalue=[0,1], slicefactor=slicefactorRange), 
+                      'Call optics file',
+                      pythonData=pythonData)
+assert all(myDF['status']=='ok')
 # %%
-myDF=pd.DataFrame(myList)
 myDF['q1 of B1']=myDF['B1summ'].apply(lambda x: x['q1'].values[0])
 myDF['q2 of B1']=myDF['B1summ'].apply(lambda x: x['q2'].values[0])
 myDF['q1 of B2']=myDF['B2summ'].apply(lambda x: x['q1'].values[0])
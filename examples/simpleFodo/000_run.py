@@ -16,6 +16,28 @@ import pandas as pd
 myDF=pd.read_pickle('output.pkl')
 myDF
 
+# %% Run it storing only the differences of the workspace between sections
+madxp.madxp('input.madx', pythonData=pythonData, outputDF='output_diff.pkl', snapshot='diff')
+myDF=pd.read_pickle('output_diff.pkl')
+# rebuild the variables, sequences and beams DFs of a given section
+madxp.snapshot.section_snapshot(myDF, 'Twiss the sequence')['beams_df']
+
+# %% Store only some variables, or build the snapshot DFs only when they are accessed
+madxp.madxp('input.madx', pythonData=pythonData, outputDF='output_knobs.pkl', snapshot=['myk', 'quadrupole_length'])
+pd.read_pickle('output_knobs.pkl')[['myk', 'quadrupole_length']]
+madxp.madxp('input.madx', pythonData=pythonData, outputDF='output_lazy.pkl', lazy=True)
+pd.read_pickle('output_lazy.pkl').loc['Twiss the sequence', 'beams_df']
+
+# %% Run it with a section cache: a second run restores the unchanged sections from the cache
+madxp.madxp('input.madx', pythonData=pythonData, outputDF='output_cache.pkl', cache='.madxp_cache')
+madxp.madxp('input.madx', pythonData=pythonData, outputDF='output_cache.pkl', cache='.madxp_cache')
+pd.read_pickle('output_cache.pkl')['cached']
+
+# %% Profiling columns and hooks
+hooks={'section_end': lambda title, row: print(f"{title}: {row['madx time [s]']:.4f} s (MAD-X), {row['python time [s]']:.4f} s (python)")}
+madxp.madxp('input.madx', pythonData=pythonData, hooks=hooks)
+pd.read_pickle('output.pkl')[madxp.profiling.PROFILE_COLUMNS]
+
 # %% Make markdown
 madxp.madx2md('input.madx','input.md')
 
@@ -80,6 +80,24 @@ mt.knobs_df(mt.sequence_df(mad, 'my_sequence'))
 mt.knob_df('myk1',mt.sequence_df(mad, 'my_sequence'))
 # NB: one can do also 
 # mt.knobDF('f', myVariableDict['dependentVariableDF'])
+# %% The dependency graph of the variables can be built once and shared
+my_graph=mt.variable_graph(mad)
+my_graph.parents('b'), my_graph.children('c'), my_graph.knobs('b'), my_graph.dependents('f')
+# %%
+my_variable_dict=mt.variables_dict(mad, graph=my_graph)
+mt.knobs_df(my_graph)
+# %%
+mt.sequence_df(mad, 'my_sequence', graph=my_graph)
+# %% For long sequences one can extract only some attributes of some element classes (columnar mode)
+mt.sequence_df(mad, 'my_sequence', graph=my_graph, columns=['k1', 'l'], classes=['quadrupole'])
+# %% The expressions can be compiled in a vectorized numpy model of the knobs
+from madxp import evaluator
+import numpy as np
+my_model=evaluator.knob_model(my_variable_dict, knobs=['a', 'f', 'myk1'],
+                              sequence_df=mt.sequence_df(mad, 'my_sequence'), columns=['k1'])
+my_model(a=np.linspace(0, 1, 11), myk1=1e-3)
+# %% and compared with MAD-X on some sample points
+my_model.check(mad, [{'a': 0.2, 'f': 1.}, {'a': 3., 'myk1': 2.}])
 # %% Let us use the sequence
 mad.input('use, sequence=my_sequence;')
 # %% then we have 
@@ -101,11 +119,22 @@ mad.input('twiss, betx=1,bety=1;')
 list(mad.table)
 # %% Then we can import the table by
 mt.table_df(mad.table.twiss)
+# %% One can extract only some columns and rows of a table
+mt.table_df(mad.table.twiss, columns=['s', 'betx', 'bety'], classes=['quadrupole'], s_range=[0, 5])
+# %% or load the columns only when they are needed
+my_table=mt.LazyTable(mad.table.twiss, pattern='q1')
+my_table['betx']
 # %% Summary table
 mt.summ_df(mad.table.summ)
 # %% Interpolation 
 import numpy as np
 mt.table_interpolation_df(my_s_list=np.linspace(2,3,11), my_table=mt.table_df(mad.table.twiss))
+# %% Interpolation with two worker processes, each with its own MAD-X instance
+mt.table_interpolation_df(my_s_list=np.linspace(2,3,11), my_table=mt.table_df(mad.table.twiss), processes=2)
+# %% Interpolation with a single MAD-X twiss for all the positions
+mt.table_interpolation_df(my_s_list=np.linspace(2,3,11), my_table=mt.table_df(mad.table.twiss), method='batch')
+# %% Interpolation with the numpy transfer matrices (all the positions at once)
+mt.table_interpolation_df(my_s_list=np.linspace(2,3,11), my_table=mt.table_df(mad.table.twiss), method='matrix')
 # %%
 mad.input('''
 select, flag=interpolate, clear;
@@ -115,4 +144,7 @@ twiss, betx=1,bety=1,table='with_interpolation';
 ''')
 # %%
 mt.table_df(mad.table.with_interpolation)
+# %% Bulk assignment and reading of variables (numpy arrays as variable families my_array_0, my_array_1, ...)
+mt.set_variables(mad, {'my_knob': 0.1, 'my_array': np.linspace(0, 1, 5), 'my_expression': 'my_knob*2'}, deferred=['my_expression'])
+mt.get_variables(mad, ['my_knob', 'my_array_4', 'my_expression', 'not_defined'])
 # %%
@@ -6,9 +6,18 @@ import madxp # do "pip install --user git+https://github.com/sterbini/madxp.git"
 # %%
 import pandas as pd
 import time
+import numpy as np
+import contextlib
+import pickle
+import hashlib
+import functools
+import re
 from cpymad.madx import Madx
 import sys
 from madxp import cpymadTool as mt
+from madxp import snapshot as sn
+from madxp import profiling as pr
+from madxp.cache import SectionCache
 
 
 def madx2df(inputFile):
@@ -16,150 +25,384 @@ def madx2df(inputFile):
         It converts a MADX file into a pandas dataframe. The index of the dataframe are the sections of the MADX code.
         There are two columns "Code section" and "Code subsections" having the raw code of the sections and the output of the 
         "splitCodeString" method (applied to the "Code section"), respectively. 
+        The columns "Line" and "Subsection lines" have the line numbers (starting from 1) of the section titles and 
+        of the first line of the subsections, respectively (see madx_sections).
+    '''
+    return _sections2df(madx_sections(inputFile))
+
+def _sections2df(mySections):
+    '''
+        It converts the (title, section) pairs of madx_sections into the MADX dataframe.
     '''
-    with open(inputFile) as fid:
-            mask_content = fid.read()
-    # I am assuming that the start of the file is '!## '
-    assert(mask_content[0:4]=="!## ")
-    # We split the mask
-    aux=mask_content.split("!## ") 
     title=[]
     body=[]
-    for i in aux:
-        title.append(i.split('\n')[0])   
-        aux="".join([a+'\n' for a in i.split('\n')[1:]])
-        body.append(aux[0:-1]) 
-    title=title[1:]
-    body=body[1:]
-    # built a pandas df
-    aux=pd.DataFrame(body,index=title, columns=['Code section'])
-    aux['Code subsections']=aux['Code section'].apply(splitCodeString)
-    return aux
+    for section in mySections:
+        title.append(section[0])
+        body.append(section[1])
+    return pd.DataFrame(body, index=title, columns=['Code section', 'Code subsections', 'Line', 'Subsection lines'])
 
-def splitCodeString(myString):
-    ''' 
-        It takes a string and return a list of dictionary having as keys the string "markdown", "python" or "madx".
+def madx_sections(inputFile):
     '''
-    subSectionBefore='none'
-    codeSubSections=[]
-    for line in myString.split('\n'):    
+        It parses a MADX file line by line and yields the sections as soon as they are read.
+        Each section is a pair (title, section), where section is a dictionary with the keys 
+        "Code section", "Code subsections", "Line" and "Subsection lines" (the columns of madx2df).
+        A section starts with a line starting with '!## ' and the file has to start with a section.
+        The generator can be passed to df2run to start the execution before the end of the parsing.
+    '''
+    for title, body, titleLine in _raw_sections(inputFile):
+        yield _section(title, body, titleLine)
+
+def _raw_sections(inputFile):
+    '''
+        It yields the title, the list of the raw lines and the line number of the title of the sections of a MADX file.
+    '''
+    with open(inputFile) as fid:
+        title=None
+        for lineNumber, line in enumerate(fid, 1):
+            if line.startswith('!## '):
+                if title is not None:
+                    yield title, body, titleLine
+                title=line[4:].rstrip('\n')
+                titleLine=lineNumber
+                body=[]
+            else:
+                # I am assuming that the start of the file is '!## '
+                assert title is not None, f'{inputFile} has to start with "!## ".'
+                body.append(line)
+        if title is not None:
+            yield title, body, titleLine
+
+def _section(title, body, titleLine):
+    '''
+        It builds the section of madx_sections from the raw lines of its body.
+    '''
+    codeSubSections, subSectionLines=_splitLines(''.join(body).split('\n'), titleLine+1)
+    return title, {'Code section': ''.join(body),
+                   'Code subsections': codeSubSections,
+                   'Line': titleLine,
+                   'Subsection lines': subSectionLines}
+
+def _splitLines(lines, firstLine=1):
+    '''
+        It groups the lines of a section in subsections (see splitCodeString). 
+        It returns the list of subsections and the list of the numbers of their first lines.
+    '''
+    types=[]
+    blocks=[]
+    subSectionLines=[]
+    for lineNumber, line in enumerate(lines, firstLine):
         if line.strip().startswith('!'):
+            myType='markdown'
             line=line.strip()[1:]
-            if subSectionBefore=='markdown':
-                codeSubSections[-1]['markdown']=codeSubSections[-1]['markdown']+'\n'+line
-            else:
-                codeSubSections.append({'markdown':line})
-                subSectionBefore='markdown'
         elif line.strip().startswith('//'):
+            myType='python'
             line=line.strip()[2:]
-            if subSectionBefore=='python':
-                codeSubSections[-1]['python']=codeSubSections[-1]['python']+'\n'+line
-            else:
-                codeSubSections.append({'python':line})
-                subSectionBefore='python'
         else:
-            if subSectionBefore=='madx':
-                codeSubSections[-1]['madx']=codeSubSections[-1]['madx']+'\n'+line
-            else:
-                codeSubSections.append({'madx':line})
-                subSectionBefore='madx'
-    # cleaning 
-    for item,index in zip(codeSubSections, range(len(codeSubSections))):
-        if list(item.keys())[0]=='madx':
-            if (item['madx'].isspace()) or (item['madx']==''):
-                del codeSubSections[index]
-    return codeSubSections
+            myType='madx'
+        if len(types)>0 and types[-1]==myType:
+            blocks[-1].append(line)
+        else:
+            types.append(myType)
+            blocks.append([line])
+            subSectionLines.append(lineNumber)
+    codeSubSections=[]
+    codeLines=[]
+    for myType, block, lineNumber in zip(types, blocks, subSectionLines):
+        code='\n'.join(block)
+        # cleaning the empty MADX subsections
+        if myType=='madx' and ((code.isspace()) or (code=='')):
+            continue
+        codeSubSections.append({myType: code})
+        codeLines.append(lineNumber)
+    return codeSubSections, codeLines
+
+def splitCodeString(myString):
+    ''' 
+        It takes a string and return a list of dictionary having as keys the string "markdown", "python" or "madx".
+    '''
+    return _splitLines(myString.split('\n'))[0]
 
-def madx2md(inputFile, outputFile, verbose=False):
+def madx2md(inputFile, outputFile, verbose=False, incremental=False):
     '''
         It converts a MADX file into a markdown file.
         inputFile: the MADX input file.
         outputFile: the makdown output file.
         verbose: boolean flag to have verbose output during the execution.
+        incremental: if True the markdown of the sections is cached in outputFile+'.cache.pkl' (by hash of 
+                     the section title and code) and only the sections changed since the last render are rendered.
+        The file is parsed and written section by section (see madx_sections).
     '''
-    df= madx2df(inputFile)
-    myString=''
-    for section in df.iterrows():   
-        print(section[0])        
-        myString=myString+'## ' +section[0]+ '\n'
-        codeSubSections=section[1]['Code subsections']
-        for code in codeSubSections:
-            myType=list(code.keys())[0]
-            if myType=='markdown':
-                myString=myString+code['markdown']+ '\n'
-            elif myType=='python':
-                myString=myString+ '```python\n# python code\n' + code['python'] + '\n```\n'
-            elif myType=='madx':
-                if verbose: 
-                    print(code['madx'])
-                if (code['madx'].isspace()) or (len(code['madx'])==0): # if it is space or empty do nothing
-                    pass
-                else:
-                    if code['madx'][-1]=='\n':
-                        myString=myString+ '```fortran\n' + code['madx'] + '```\n'
-                    else:
-                        myString=myString+ '```fortran\n' + code['madx'] + '\n```\n'
-            else:
-                assert(0)
+    if incremental:
+        myCacheFile=outputFile+'.cache.pkl'
+        try:
+            with open(myCacheFile, 'rb') as fid:
+                myCache=pickle.load(fid)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            myCache={}
+        myNewCache={}
     with open(outputFile, 'w') as fid:
-        fid.write(myString)
+        for title, body, titleLine in _raw_sections(inputFile):
+            if verbose: print(title)
+            if incremental:
+                myKey=hashlib.sha256('\n'.join([title, ''.join(body)]).encode()).hexdigest()
+                if myKey not in myCache:
+                    myCache[myKey]=_section2md(title, _section(title, body, titleLine)[1]['Code subsections'], verbose)
+                myNewCache[myKey]=myCache[myKey]
+                fid.write(myNewCache[myKey])
+            else:
+                fid.write(_section2md(title, _section(title, body, titleLine)[1]['Code subsections'], verbose))
+    if incremental:
+        with open(myCacheFile, 'wb') as fid:
+            pickle.dump(myNewCache, fid)
 
-def df2madx(myDF):
+def _section2md(title, codeSubSections, verbose=False):
+    '''
+        It converts a section in markdown.
+    '''
+    myList=['## ' +title+ '\n']
+    for code in codeSubSections:
+        myType=list(code.keys())[0]
+        if myType=='markdown':
+            myList.append(code['markdown']+ '\n')
+        elif myType=='python':
+            myList.append('```python\n# python code\n' + code['python'] + '\n```\n')
+        elif myType=='madx':
+            if verbose: 
+                print(code['madx'])
+            if (code['madx'].isspace()) or (len(code['madx'])==0): # if it is space or empty do nothing
+                pass
+            else:
+                if code['madx'][-1]=='\n':
+                    myList.append('```fortran\n' + code['madx'] + '```\n')
+                else:
+                    myList.append('```fortran\n' + code['madx'] + '\n```\n')
+        else:
+            assert(0)
+    return ''.join(myList)
+
+def df2madx(myDF, outputFile=None, verbose=False):
     '''
         It converts a MADX dataframe into a MADX string that can be, eventually, dumped in a file.
+        outputFile: if not None, the MADX code is written section by section in this file (and None is returned).
+        verbose: boolean flag to print the section titles.
+    '''
+    if outputFile is None:
+        myList=[]
+        for title, code in zip(myDF.index, myDF['Code section']):
+            if verbose: print(title)
+            myList.append('!## ' +title+ '\n' + code)
+        return ''.join(myList)
+    with open(outputFile, 'w') as fid:
+        for title, code in zip(myDF.index, myDF['Code section']):
+            if verbose: print(title)
+            fid.write('!## ' +title+ '\n' + code)
+
+# the local variables of df2run available to the python subsections (for compatibility)
+_DF2RUN_LOCALS=['myDF', 'verbose', 'myGlobals', 'section', 'codeSubSections', 'myCheck', 'code', 'myType', 'start_time']
+
+def _stored_namespace(namespace):
     '''
-    myString=''
-    for block in myDF.iterrows():
-        print(block[0])
-        myString=myString+ '!## ' +block[0]+ '\n' + block[1]['Code section']
-    return myString
+        It returns the namespace of the python subsections without the names set by df2run 
+        (the globals of this module and _DF2RUN_LOCALS), to be stored in the cache.
+    '''
+    return {name: value for name, value in namespace.items() 
+            if not (name in _DF2RUN_LOCALS or (name in globals() and value is globals()[name]))}
+
+def _block_depth(code, depth=0):
+    '''
+        It returns the depth of the MAD-X blocks ('{ ... }' of if, while and macro) at the end of the MAD-X code,
+        starting from the depth 'depth' (the comments and the strings are not considered).
+    '''
+    code=re.sub(r'/\*.*?\*/|"[^"]*"|\'[^\']*\'|(!|//)[^\n]*', '', code, flags=re.DOTALL)
+    return depth+code.count('{')-code.count('}')
+
+def _block_groups(codeSubSections):
+    '''
+        It groups the indices of the subsections of a section: a MAD-X block spanning several subsections
+        (e.g., a while with a comment line inside) is a single group, all the other subsections are alone.
+    '''
+    myGroups=[]
+    depth=0
+    for subsectionIndex, code in enumerate(codeSubSections):
+        if depth>0:
+            myGroups[-1].append(subsectionIndex)
+        else:
+            myGroups.append([subsectionIndex])
+        if 'madx' in code:
+            depth=_block_depth(code['madx'], depth)
+    return myGroups
 
-def df2run(madx, myDF, pythonData=None, verbose=False):
+@functools.lru_cache(maxsize=1024)
+def _compile_python(code):
+    '''
+        It compiles the code of a python subsection (the code objects are cached by source).
+    '''
+    myHash=hashlib.sha256(code.encode()).hexdigest()
+    return compile(code, f'<madxp python subsection {myHash[:12]}>', 'exec')
+
+def df2run(madx, myDF, pythonData=None, verbose=False, snapshot='full', cache=None, hooks=None, lazy=False, namespace=None):
     '''
         It runs the MADX dataframe using the MADX extended syntax.
-        myDF: the MADX DF to run.
+        myDF: the MADX DF to run or the generator of its sections (see madx_sections), to start
+              the execution before the end of the parsing (with a cache the sections are parsed first).
         command_log_file: the filename of the logging file. Use the None variable not to log.
         stdout_file: the filename of the file to redirect the stdout. Use the None variable not to log.
         verbose: boolean flag to have verbose output during the execution.
+        snapshot: 'full' to store the variables, sequences and beams DFs after each section,
+                  'diff' to store only the changes with respect to the previous section 
+                  (column 'workspace_diff', see madxp.snapshot.section_snapshot to rebuild a section),
+                  'none' not to store any snapshot,
+                  a list of MAD-X variable names to store only their values (a column per variable),
+                  'marked' to store the full snapshot only of the sections with '[snapshot]' in the title
+                  (see madxp.snapshot.SNAPSHOT_MARKER).
+        cache: a madxp.cache.SectionCache (or the folder of one) to store the workspace after each section. 
+               The longest unchanged prefix of sections is restored from the cache (in a new MADX instance) 
+               and only the following sections are executed (column 'cached' of the profile DF).
+               The python namespace is restored too: a prefix whose namespace could not be fully stored 
+               (e.g., functions defined in a python section) is not reused (see madxp.cache).
+        hooks: a dictionary of functions called during the execution (see madxp.profiling.HOOKS).
+        lazy: if True the full snapshots store only the raw MAD-X workspace and their DFs are built when
+              first accessed (see madxp.snapshot.LazyFrame).
+        namespace: the dictionary where the python subsections are executed. It is shared by all the sections 
+                   (the python objects defined in a section are available in the following ones) and 'madx', 
+                   'pythonData', 'mt' and 'pd' are set in it. If None a new one is used.
+                   For compatibility with the previous versions (where the python code was executed in the scope 
+                   of df2run) the globals of the madxp module (e.g., 'time', 'sys', 'Madx', 'np') are added 
+                   to it if not already defined and the local variables of df2run in _DF2RUN_LOCALS 
+                   (e.g., 'myDF' and 'section') are set before each python subsection.
+                   The python subsections are compiled once per process (the code objects are cached by source).
+        The profiling columns of the output DF are listed in madxp.profiling.PROFILE_COLUMNS.
     '''
+    assert (snapshot in ['full', 'diff', 'none', 'marked']) or isinstance(snapshot, (list, tuple))
+    hooks=pr.check_hooks(hooks)
+    if namespace is None:
+        namespace={}
+    namespace.update({'madx': madx, 'pythonData': pythonData, 'mt': mt, 'pd': pd})
+    # the names available to the python code before the shared namespace (the globals of this module and, 
+    # see _DF2RUN_LOCALS, the local variables of df2run) are kept for compatibility
+    for name, value in globals().items():
+        if not name.startswith('__'):
+            namespace.setdefault(name, value)
     myGlobals=[]
-    for section in myDF.iterrows():
+    previousState={}
+    if cache is not None and not isinstance(myDF, pd.DataFrame):
+        myDF=_sections2df(myDF)
+    if cache is not None:
+        if isinstance(cache, str):
+            cache=SectionCache(cache)
+        myKeys=cache.keys(myDF, pythonData, snapshot, lazy)
+        myPrefix=cache.prefix(myKeys)
+        # the python namespace has to be restored too: the prefix ends with an entry storing all of it
+        while myPrefix>0 and not cache.complete(myKeys[myPrefix-1]):
+            myPrefix-=1
+        if myPrefix>0:
+            print(f'Restoring {myPrefix} sections from the cache.')
+            myGlobals=[cache.profile_row(i) for i in myKeys[:myPrefix]]
+            cache.restore(myKeys[myPrefix-1], madx, pythonData, namespace)
+            if snapshot=='diff':
+                previousState=sn.workspace_state(madx)
+    else:
+        myPrefix=0
+    if isinstance(myDF, pd.DataFrame):
+        mySections=myDF.iloc[myPrefix:].iterrows()
+        myIndex=list(myDF.index[:myPrefix])
+    else:
+        mySections=myDF
+        myIndex=[]
+    for sectionIndex, section in enumerate(mySections, myPrefix):
+        myIndex.append(section[0])
         print(section[0])
+        if 'section_start' in hooks: hooks['section_start'](section[0], section[1])
+        pythonCPU0, _ = pr.python_usage()
+        madxCPU0, _ = pr.madx_usage(madx)
         start_time = time.time()
         codeSubSections=section[1]['Code subsections']
-        with madx.batch():
-            myCheck=[list(code.keys())[0] for code in codeSubSections]
-            if verbose: print(codeSubSections)
-            if ('madx' in myCheck) & ('python' in myCheck):
-                raise Exception('Do not put madx and python code in the same section!')
-            for code in codeSubSections:
-                myType=list(code.keys())[0]
-                if myType=='markdown':
-                    pass
-                elif myType=='python':
-                    exec(code['python']) # local variables
-                elif myType=='madx':
-                    madx.input(code['madx'])
-                else:
-                    assert(0)
+        myCheck=[list(code.keys())[0] for code in codeSubSections]
+        if verbose: print(codeSubSections)
+        if ('madx' in myCheck) & ('python' in myCheck):
+            raise Exception('Do not put madx and python code in the same section!')
+        subsectionTimes=[]
+        madx_time=0.
+        # the subsections are timed one by one, but the ones of a MAD-X block (if, while, macro) spanning 
+        # several subsections are sent in a single batch (and their time is NaN)
+        for myGroup in _block_groups(codeSubSections):
+            group_time=time.time()
+            with (madx.batch() if len(myGroup)>1 else contextlib.nullcontext()):
+                for subsectionIndex in myGroup:
+                    code=codeSubSections[subsectionIndex]
+                    myType=list(code.keys())[0]
+                    subsection_time=time.time()
+                    if myType=='markdown':
+                        pass
+                    elif myType=='python':
+                        namespace.update({'myDF': myDF, 'verbose': verbose, 'myGlobals': myGlobals, 'section': section,
+                                          'codeSubSections': codeSubSections, 'myCheck': myCheck, 
+                                          'code': code, 'myType': myType, 'start_time': start_time})
+                        exec(_compile_python(code['python']), namespace)
+                    elif myType=='madx':
+                        madx.input(code['madx'])
+                    else:
+                        assert(0)
+                    subsectionTimes.append(time.time()-subsection_time if len(myGroup)==1 else np.nan)
+                    if 'subsection_end' in hooks: hooks['subsection_end'](section[0], subsectionIndex, myType, subsectionTimes[-1])
+            if 'madx' in myCheck:
+                madx_time+=time.time()-group_time
         execution_time_s=time.time()-start_time
+        # the CPU and memory readings do not include the snapshot (timed separately)
+        pythonCPU, pythonRSS = pr.python_usage()
+        madxCPU, madxRSS = pr.madx_usage(madx)
         myDict={}
-        myVariableDict=mt.variables_dict(madx)
         myDict['Code subsections']=section[1]['Code subsections']
         myDict['Code section']=section[1]['Code section']        
         myDict['execution time [s]']=execution_time_s
+        myDict['madx time [s]']=madx_time
+        myDict['python time [s]']=sum(i for i, j in zip(subsectionTimes, myCheck) if j=='python')
+        myDict['subsection times [s]']=subsectionTimes
         #myDict['pythonData']=pythonData
-        myDict['independent_variable_df']=myVariableDict['independent_variable_df']
-        myDict['dependent_variable_df']=myVariableDict['dependent_variable_df']
-        myDict['constant_df']=myVariableDict['constant_df']
-        myDict['sequences_df']=mt.sequences_df(madx)
-        myDict['beams_df']=mt.beams_df(madx)
-        myDict['tables_list']=list(madx.table)
+        stepTimes={}
+        step_time=time.time()
+        fullSnapshot=(snapshot=='full') or (snapshot=='marked' and sn.is_marked(section[0]))
+        if fullSnapshot and lazy:
+            myDict.update(sn.lazy_snapshot(madx))
+            stepTimes['workspace_state'], step_time = time.time()-step_time, time.time()
+        elif fullSnapshot:
+            myVariableDict=mt.variables_dict(madx)
+            myDict['independent_variable_df']=myVariableDict['independent_variable_df']
+            myDict['dependent_variable_df']=myVariableDict['dependent_variable_df']
+            myDict['constant_df']=myVariableDict['constant_df']
+            stepTimes['variables_dict'], step_time = time.time()-step_time, time.time()
+            myDict['sequences_df']=mt.sequences_df(madx)
+            stepTimes['sequences_df'], step_time = time.time()-step_time, time.time()
+            myDict['beams_df']=mt.beams_df(madx)
+            stepTimes['beams_df'], step_time = time.time()-step_time, time.time()
+        elif snapshot=='diff':
+            myState=sn.workspace_state(madx)
+            stepTimes['workspace_state'], step_time = time.time()-step_time, time.time()
+            myDict['workspace_diff']=sn.state_diff(previousState, myState)
+            previousState=myState
+            stepTimes['state_diff'], step_time = time.time()-step_time, time.time()
+        elif not isinstance(snapshot, str):
+            myDict.update(sn.variables_values(madx, snapshot))
+            stepTimes['variables'], step_time = time.time()-step_time, time.time()
+        if fullSnapshot or snapshot=='diff':
+            myDict['tables_list']=list(madx.table)
+            stepTimes['tables_list']=time.time()-step_time
+        myDict['snapshot time [s]']=sum(stepTimes.values())
+        myDict['snapshot step times [s]']=stepTimes
+        myDict['python peak rss [MB]']=pythonRSS
+        myDict['madx peak rss [MB]']=madxRSS
+        myDict['python cpu time [s]']=pythonCPU-pythonCPU0
+        myDict['madx cpu time [s]']=madxCPU-madxCPU0
+        myDict['tables count'], myDict['tables rows'] = pr.tables_summary(madx)
+        if cache is not None:
+            myDict['cached']=False
+            cache.store(myKeys[sectionIndex], madx, dict(myDict, cached=True), pythonData, _stored_namespace(namespace))
+        if 'section_end' in hooks: hooks['section_end'](section[0], myDict)
         myGlobals.append(myDict)
-    profileDF=pd.DataFrame(myGlobals, index=myDF.index)
+    profileDF=pd.DataFrame(myGlobals, index=myIndex)
     return profileDF
 
-def madxp(inputFile, pythonData=None, outputDF='output.pkl', command_log_file='log.madx', stdout_file='stdout.madx', verbose=False): 
+def madxp(inputFile, pythonData=None, outputDF='output.pkl', command_log_file='log.madx', stdout_file='stdout.madx', verbose=False, snapshot='full', cache=None, hooks=None, lazy=False, namespace=None): 
     '''
         It runs the MADX dataframe using the MADX extended syntax.
         inputFile:  the MADX input file.
@@ -168,6 +411,11 @@ def madxp(inputFile, pythonData=None, outputDF='output.pkl', command_log_file='l
         command_log_file: the filename of the logging file. Use the None variable not to log.
         stdout_file: the filename of the file to redirect the stdout. Use the None variable not to log.
         verbose: boolean flag to have verbose output during the execution.
+        snapshot: 'full', 'diff', 'none', 'marked' or a list of variables, see df2run.
+        cache: a madxp.cache.SectionCache or its folder, see df2run.
+        hooks: a dictionary of profiling hooks, see df2run.
+        lazy: build the snapshot DFs when first accessed, see df2run.
+        namespace: the dictionary where the python subsections are executed, see df2run.
     '''
     if command_log_file==None:
         if stdout_file==None:
@@ -181,7 +429,7 @@ def madxp(inputFile, pythonData=None, outputDF='output.pkl', command_log_file='l
         else:
             with open(stdout_file, 'w') as f:
                 madx = Madx(stdout=f,command_log=command_log_file)
-    aux=df2run(madx, madx2df(inputFile), pythonData=pythonData, verbose=verbose)
+    aux=df2run(madx, madx_sections(inputFile), pythonData=pythonData, verbose=verbose, snapshot=snapshot, cache=cache, hooks=hooks, lazy=lazy, namespace=namespace)
     if outputDF!=None:
         aux.to_pickle(outputDF)
         print('Profiling DF saved.')
@@ -0,0 +1,219 @@
+'''
+Section-level cache of the execution of a MADX file with the extended syntax.
+
+Each section is identified by a hash of its title and code, chained with the hash of the previous section
+(the first one is chained with the hash of the initial pythonData and of the snapshot policy of df2run). After each section df2run(..., cache=...)
+stores in the cache folder the MAD-X workspace (MAD-X 'save' of the variables, elements, sequences and beams,
+and the tables written in TFS), the pythonData and the row of the profile DF.
+A following run restores the longest unchanged prefix of sections from the cache and executes only
+from the first modified section.
+
+The MAD-X 'save' does not store everything (e.g., string variables, macros, options, alignment and field errors,
+'select' flags) and the tables are restored from TFS files (with the MAD-X output precision):
+the cache has to be used with masks that do not rely on them across sections.
+
+The python namespace shared by the sections (see df2run(..., namespace=...)) is stored too: the modules by name
+(imported again when restored) and the other objects if they can be pickled. The objects that cannot be pickled
+(e.g., functions and classes defined in a python section) are not stored and the entry is marked as incomplete:
+df2run does not restore a prefix ending with an incomplete entry (it restores the longest prefix with a complete one
+and runs again the following sections, so that their python code defines again the missing objects).
+
+See madxp/examples/simpleFodo/000_run.py
+'''
+import os
+import shutil
+import pickle
+import hashlib
+import importlib
+import types
+
+# the names of the namespace set by df2run (not stored)
+_NAMESPACE_SKIP=['__builtins__', 'madx', 'pythonData', 'mt', 'pd']
+
+def _namespace_pickle(namespace):
+    '''
+    Pickle the objects of a namespace that can be pickled (the modules are stored by name).
+
+    Returns:
+        The pickle and the list of the names that could not be stored.
+    '''
+    my_objects={}
+    my_modules={}
+    missing=[]
+    for name, value in namespace.items():
+        if name in _NAMESPACE_SKIP:
+            continue
+        if isinstance(value, types.ModuleType):
+            my_modules[name]=value.__name__
+            continue
+        try:
+            my_objects[name]=pickle.dumps(value)
+        except Exception:
+            missing.append(name)
+    return pickle.dumps({'objects': my_objects, 'modules': my_modules, 'missing': missing}), missing
+
+class SectionCache():
+    '''
+    On-disk cache of the MAD-X workspace at the end of the sections of a MADX file.
+
+    Args:
+        folder: the folder of the cache (an entry per section, named as its hash).
+        max_size: the maximum size of the cache in bytes. The least recently used entries are evicted when it is exceeded.
+    '''
+    def __init__(self, folder='.madxp_cache', max_size=2**30):
+        self.folder=folder
+        self.max_size=max_size
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key, name=''):
+        return os.path.join(self.folder, key, name)
+
+    def __contains__(self, key):
+        # the profile row is the last file written: its presence marks a complete entry
+        return os.path.exists(self._path(key, 'profile.pkl'))
+
+    def __len__(self):
+        return len(self.entries())
+
+    def entries(self):
+        '''The list of the keys of the complete entries of the cache.'''
+        return [i for i in os.listdir(self.folder) if i in self]
+
+    @staticmethod
+    def keys(myDF, pythonData=None, snapshot='full', lazy=False):
+        '''
+        Compute the chained hashes of the sections of a MADX DF (see madxp.madx2df).
+
+        Args:
+            myDF: the MADX DF.
+            pythonData: the initial pythonData.
+            snapshot, lazy: the snapshot policy and the lazy flag of df2run. They change the profile rows,
+                so the rows of a different policy are never reused.
+
+        Returns:
+            The list of the keys of the sections.
+        '''
+        try:
+            aux=pickle.dumps(pythonData)
+        except Exception:
+            aux=repr(pythonData).encode()
+        aux=aux+repr((snapshot, lazy)).encode()
+        previous=hashlib.sha256(aux).hexdigest()
+        my_keys=[]
+        for title, code in zip(myDF.index, myDF['Code section']):
+            previous=hashlib.sha256('\n'.join([previous, title, code]).encode()).hexdigest()
+            my_keys.append(previous)
+        return my_keys
+
+    def prefix(self, keys):
+        '''The number of sections, from the first one, present in the cache.'''
+        for index, key in enumerate(keys):
+            if key not in self:
+                return index
+        return len(keys)
+
+    def complete(self, key):
+        '''True if the python namespace of the entry has been fully stored (see the module docstring).'''
+        try:
+            with open(self._path(key, 'namespace.pkl'), 'rb') as fid:
+                return len(pickle.load(fid)['missing'])==0
+        except OSError:
+            return False
+
+    def store(self, key, madx, profile_row, pythonData=None, namespace=None):
+        '''
+        Store the MAD-X workspace, the pythonData, the python namespace and the profile row at the end of a section.
+        It returns False (and the entry is not stored) if pythonData cannot be pickled.
+        '''
+        if key in self:
+            return True
+        try:
+            python_data_pickle=pickle.dumps(pythonData)
+            profile_pickle=pickle.dumps(profile_row)
+        except Exception as error:
+            print(f'The section cannot be cached: {error}')
+            return False
+        namespace_pickle, _ = _namespace_pickle({} if namespace is None else namespace)
+        temporary=self._path(f'{key}.tmp{os.getpid()}')
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        tables=list(madx.table)
+        expanded=[i for i in madx.sequence if madx.sequence[i].is_expanded]
+        madx.input(f'save, file="{os.path.join(temporary, "state.madx")}", beam;')
+        for i in tables:
+            madx.input(f'write, table={i}, file="{os.path.join(temporary, i+".tfs")}";')
+        with open(os.path.join(temporary, 'workspace.pkl'), 'wb') as fid:
+            pickle.dump({'tables': tables, 'expanded sequences': expanded}, fid)
+        with open(os.path.join(temporary, 'pythonData.pkl'), 'wb') as fid:
+            fid.write(python_data_pickle)
+        with open(os.path.join(temporary, 'namespace.pkl'), 'wb') as fid:
+            fid.write(namespace_pickle)
+        with open(os.path.join(temporary, 'profile.pkl'), 'wb') as fid:
+            fid.write(profile_pickle)
+        shutil.rmtree(self._path(key), ignore_errors=True)
+        os.rename(temporary, self._path(key))
+        self.evict(keep=key)
+        return True
+
+    def profile_row(self, key):
+        '''The profile row of an entry (the access time of the entry is updated).'''
+        os.utime(self._path(key))
+        with open(self._path(key, 'profile.pkl'), 'rb') as fid:
+            return pickle.load(fid)
+
+    def restore(self, key, madx, pythonData=None, namespace=None):
+        '''
+        Restore the MAD-X workspace, the pythonData and the python namespace (both updated in place) of an entry.
+        The MAD-X instance should be a new one.
+        '''
+        os.utime(self._path(key))
+        with open(self._path(key, 'workspace.pkl'), 'rb') as fid:
+            workspace=pickle.load(fid)
+        madx.input(f'call, file="{self._path(key, "state.madx")}";')
+        for i in workspace['expanded sequences']:
+            madx.input(f'use, sequence={i};')
+        for i in workspace['tables']:
+            madx.input(f'readtable, file="{self._path(key, i+".tfs")}", table={i};')
+        if pythonData is not None:
+            with open(self._path(key, 'pythonData.pkl'), 'rb') as fid:
+                aux=pickle.load(fid)
+            pythonData.clear()
+            pythonData.update(aux)
+        if namespace is not None:
+            with open(self._path(key, 'namespace.pkl'), 'rb') as fid:
+                aux=pickle.load(fid)
+            namespace.update({name: importlib.import_module(module) for name, module in aux['modules'].items()})
+            namespace.update({name: pickle.loads(value) for name, value in aux['objects'].items()})
+
+    def size(self):
+        '''The size of the cache in bytes.'''
+        my_size=0
+        for root, _, files in os.walk(self.folder):
+            for i in files:
+                my_size+=os.path.getsize(os.path.join(root, i))
+        return my_size
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used entries until the size of the cache is below max_size.
+
+        Args:
+            keep: the key of an entry not to remove.
+        '''
+        my_size=self.size()
+        if my_size<=self.max_size:
+            return
+        my_entries=sorted(self.entries(), key=lambda i: os.path.getmtime(self._path(i)))
+        for i in my_entries:
+            if my_size<=self.max_size:
+                break
+            if i==keep:
+                continue
+            aux=sum(os.path.getsize(os.path.join(root, j)) for root, _, files in os.walk(self._path(i)) for j in files)
+            shutil.rmtree(self._path(i), ignore_errors=True)
+            my_size-=aux
+
+    def clear(self):
+        '''Remove all the entries of the cache.'''
+        for i in os.listdir(self.folder):
+            shutil.rmtree(os.path.join(self.folder, i), ignore_errors=True)
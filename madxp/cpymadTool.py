@@ -4,19 +4,26 @@ import cpymad
 from cpymad.madx import Madx
 import itertools
 import gc
+import re
+import weakref
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import importlib.metadata
+from madxp.graph import VariableGraph, KnobIndex, CyclicDependencyError
+from madxp import expression
+from madxp import optics
 
-def sequences_df(mad):
+def _sequences_dict(mad):
     '''
-    Extract the pandas DF with the list of the sequences defined in the MAD-X handle.
-    
+    Extract the dictionary of the sequences defined in the MAD-X handle.
+
     Args:
         mad: The handle to MAD-X
-    
-    Returns:
-        The pandas DF of the sequences. It can be and empty DF.
-    
-    See madxp/examples/variablesExamples/000_run.py
 
+    Returns:
+        A dictionary {sequence name: {'beam': bool, 'expanded': bool}}.
     '''
     sequences = mad.sequence
     seq_dict = {}
@@ -30,27 +37,63 @@ def sequences_df(mad):
             seq_dict[ii]['expanded'] = True
         else:
             seq_dict[ii]['expanded'] = False
-    return pd.DataFrame(seq_dict).transpose()
+    return seq_dict
 
-def beams_df(mad):
+def sequences_df(mad):
     '''
-    Extract the pandas DF with the beams associated to the sequences defined in the MAD-X handle.
+    Extract the pandas DF with the list of the sequences defined in the MAD-X handle.
     
     Args:
         mad: The handle to MAD-X
     
     Returns:
-        The pandas DF of the beams. It can be and empty DF.
-
+        The pandas DF of the sequences. It can be and empty DF.
+    
     See madxp/examples/variablesExamples/000_run.py
+
+    '''
+    return pd.DataFrame(_sequences_dict(mad)).transpose()
+
+def _beams_dict(mad, verbose=True):
+    '''
+    Extract the dictionary of the beams associated to the sequences defined in the MAD-X handle.
+
+    Args:
+        mad: The handle to MAD-X
+        verbose: print the sequences without a beam attached.
+
+    Returns:
+        A dictionary {sequence name: dictionary of the beam attributes}.
     '''
-    df_list = []
+    beam_dict = {}
     sequences = mad.sequence
     for ii in sequences:
         try:
-            df_list.append(pd.DataFrame([dict(sequences[ii].beam)], index=[ii]))
+            beam_dict[ii] = dict(sequences[ii].beam)
         except:
-            print(f'The sequence {ii} has no beam attached.')
+            if verbose:
+                print(f'The sequence {ii} has no beam attached.')
+    return beam_dict
+
+def beams_df(mad):
+    '''
+    Extract the pandas DF with the beams associated to the sequences defined in the MAD-X handle.
+    
+    Args:
+        mad: The handle to MAD-X
+    
+    Returns:
+        The pandas DF of the beams. It can be and empty DF.
+
+    See madxp/examples/variablesExamples/000_run.py
+    '''
+    return _beams_df_from_dict(_beams_dict(mad))
+
+def _beams_df_from_dict(beam_dict):
+    '''
+    Build the pandas DF of the beams from the output of '_beams_dict'.
+    '''
+    df_list = [pd.DataFrame([beam_dict[ii]], index=[ii]) for ii in beam_dict]
     if len(df_list) > 0:
         return pd.concat(df_list)
     else:
@@ -66,57 +109,148 @@ def _extract_parameters(my_string):
     Returns:
         The list of the parameters present in the MAD-X expression.
 
+    The expression is parsed only once (see madxp.expression.parameters).
     '''
-    if type(my_string)=='NoneType' or my_string==None or my_string=='None' or my_string=='[None]':
+    if my_string is None or my_string=='None' or my_string=='[None]':
         return []
+    return list(expression.parameters(my_string))
+
+def _safe_parameters(my_expression, name):
+    '''
+    The parameters of a MAD-X expression (see madxp.expression.parameters) or None, with a warning,
+    if the expression cannot be parsed.
+    '''
+    try:
+        return expression.parameters(my_expression)
+    except ValueError as error:
+        print(f'Warning: the expression of {name} cannot be parsed, it is treated as opaque ({error}).')
+        return None
+
+def _globals_arrays(mad):
+    '''
+    Extract the global workspace of the MAD-X handle visiting each variable exactly once.
+
+    Each variable costs a single call to MAD-X returning value, expression and type together.
+
+    Args:
+        mad: The MAD-X handle.
+
+    Returns:
+        A dictionary of columnar numpy arrays:
+        - 'name': the variable names
+        - 'value': the values (float, or object if string variables are present)
+        - 'expression': the expressions (None for non-deferred variables)
+        - 'var_type': the MAD-X variable types (0 constant, 1 direct, 2 deferred, 3 string)
+    '''
+    names, values, expressions, var_types = [], [], [], []
+    libmadx=mad._libmadx
+    my_globals=libmadx.get_globals()
+    while True:
+        for i in my_globals[len(names):]:
+            aux=libmadx.get_var(i)
+            names.append(i)
+            values.append(aux.value)
+            expressions.append(aux.expr)
+            var_types.append(aux.var_type)
+        # evaluating a deferred expression can define new variables (at the end of the list)
+        if libmadx.num_globals()==len(names):
+            break
+        my_globals=libmadx.get_globals()
+    return _globals_arrays_from_lists(names, values, expressions, var_types)
+
+def _globals_arrays_from_lists(names, values, expressions, var_types):
+    '''
+    Pack the columns of the global workspace in numpy arrays (see '_globals_arrays').
+    '''
+    var_types=np.array(var_types, dtype=int)
+    if np.any(var_types==3):
+        aux=np.empty(len(values), dtype=object)
+        aux[:]=values
+        values=aux
     else:
-        for i in [
-        '*','->','-','/','+','^','(',')','[',']',',','\'','None']:
-            my_string=my_string.replace(i,' ')
-        my_list=my_string.split(' ')
-        my_list=list(np.unique(my_list))
-        if '' in my_list:
-            my_list.remove('')
-        if type(my_list)=='NoneType':
-            my_list=[]
-        for i in my_list.copy():
-            if i.isdigit() or i[0].isdigit():
-                my_list.remove(i)
-        my_list=list(set(my_list)-
-        set([
-            'sqrt',
-            'log',
-            'log10',
-            'exp',
-            'sin',
-            'cos',
-            'tan',
-            'asin',
-            'acos',
-            'atan',
-            'sinh',
-            'cosh',
-            'tanh',
-            'sinc',
-            'abs',
-            'erf',
-            'erfc',
-            'floor',
-            'ceil',
-            'round',
-            'frac',
-            'ranf',
-            'gauss',
-            'tgauss']))
-        return my_list 
-
-def variables_dict(mad):
+        values=np.array(values, dtype=float)
+    aux=np.empty(len(expressions), dtype=object)
+    aux[:]=expressions
+    return {'name': np.array(names, dtype=object),
+            'value': values,
+            'expression': aux,
+            'var_type': var_types}
+
+def _globals_dict(mad):
+    '''
+    Extract the raw global workspace of the MAD-X handle.
+
+    Args:
+        mad: The MAD-X handle.
+
+    Returns:
+        A dictionary {variable name: (value, expression, variable type)}.
+        The expression is None for non-deferred variables and the variable type
+        follows the MAD-X convention (0 constant, 1 direct, 2 deferred, 3 string).
+    '''
+    aux=_globals_arrays(mad)
+    return dict(zip(aux['name'].tolist(),
+                    zip(aux['value'].tolist(), aux['expression'].tolist(), aux['var_type'].tolist())))
+
+def _globals_arrays_from_dict(globals_dict):
+    '''
+    Convert the output of '_globals_dict' in the output of '_globals_arrays'.
+    '''
+    names=list(globals_dict)
+    return _globals_arrays_from_lists(names,
+                                      [globals_dict[i][0] for i in names],
+                                      [globals_dict[i][1] for i in names],
+                                      [globals_dict[i][2] for i in names])
+
+def variable_graph(mad):
+    '''
+    Build the dependency graph of the global variables of the MAD-X handle.
+
+    Args:
+        mad: The MAD-X handle.
+
+    Returns:
+        The VariableGraph of the MAD-X global workspace. It can be shared by 
+        'variables_dict', 'sequence_df' and 'knobs_df'.
+
+    See madxp/examples/variablesExamples/000_run.py
+    '''
+    return _variable_graph_from_arrays(_globals_arrays(mad))
+
+def _variable_graph_from_arrays(arrays):
+    '''
+    Build the VariableGraph from the global workspace (output of '_globals_arrays').
+    The variables with an expression that cannot be parsed or in a cycle of expressions 
+    are opaque (see VariableGraph) and a warning is printed.
+    '''
+    parameters={}
+    opaque=set()
+    for name, my_expression in zip(arrays['name'], arrays['expression']):
+        if my_expression:
+            aux=_safe_parameters(my_expression, name)
+            if aux is None:
+                opaque.add(name)
+            elif len(aux)>0:
+                parameters[name]=aux
+    var_types=dict(zip(arrays['name'].tolist(), arrays['var_type'].tolist()))
+    while True:
+        try:
+            return VariableGraph(parameters, var_types, opaque)
+        except CyclicDependencyError as error:
+            print(f'Warning: {error}, the variables of the cycle are treated as opaque.')
+            for i in error.cycle:
+                parameters.pop(i, None)
+                opaque.add(i)
+
+def variables_dict(mad, graph=None):
     '''
 
     Extract the dictionary of the variables and constant pandas DF of the MAD-X global workspace.
 
     Args:
         mad: The MAD-X handle.
+        graph: the VariableGraph of the MAD-X handle (see 'variable_graph'). 
+               If None it is built from the MAD-X handle.
     
     Returns:
         The a dictionary containing:
@@ -130,18 +264,51 @@ def variables_dict(mad):
         - 'knobs': the list of the independent variables that control 
           the dependent variables. Note tha the parameters can be constants and/or dependent variables,
           whereas the 'knobs' are only independent variables.
+    The MAD-X workspace is read in a single pass (see '_globals_arrays').
     '''
+    return _variables_dict_from_arrays(_globals_arrays(mad), graph)
+
+def _variables_dict_from_globals(globals_dict, graph=None):
+    '''
+    Build the output of 'variables_dict' from the raw global workspace (output of '_globals_dict').
+    '''
+    return _variables_dict_from_arrays(_globals_arrays_from_dict(globals_dict), graph)
+
+def _variables_dict_from_arrays(arrays, graph=None):
+    '''
+    Build the output of 'variables_dict' from the global workspace.
+
+    Args:
+        arrays: the output of '_globals_arrays'.
+        graph: the corresponding VariableGraph. If None it is built from 'arrays'.
+
+    Returns:
+        The same dictionary of pandas DFs returned by 'variables_dict'.
+    '''
+    if graph is None:
+        graph=_variable_graph_from_arrays(arrays)
+    my_order=np.argsort(arrays['name'])
+    names=arrays['name'][my_order]
+    values=arrays['value'][my_order]
+    var_types=arrays['var_type'][my_order]
+
+    dependent=np.array([graph.is_dependent(i) for i in names], dtype=bool)
+    constant=np.logical_not(dependent) & (var_types==0)
+    independent=np.logical_not(dependent | constant)
+
     my_dict={}
-    aux=_independent_variables_df(mad)
-    import numpy as np
-    independent_variables_df=aux[np.logical_not(aux['constant'])].copy()
-    del independent_variables_df['constant']
-    constant_df=aux[aux['constant']].copy()
-    del constant_df['constant']
-    my_dict['constant_df']=constant_df
-    my_dict['independent_variable_df']=independent_variables_df
-    my_dict['dependent_variable_df']=_dependent_variables_df(mad)
-    
+    my_dict['constant_df']=pd.DataFrame({'value': values[constant]}, index=names[constant])
+    my_dict['independent_variable_df']=pd.DataFrame({'value': values[independent]}, index=names[independent])
+    if np.any(dependent):
+        dependent_names=names[dependent]
+        my_dict['dependent_variable_df']=pd.DataFrame({
+            'value': values[dependent],
+            'expression': arrays['expression'][my_order][dependent],
+            'parameters': [graph.parents(i) for i in dependent_names],
+            'knobs': [graph.knobs(i) for i in dependent_names]},
+            index=dependent_names)
+    else:
+        my_dict['dependent_variable_df']=pd.DataFrame()
     return my_dict
 
 def _dependent_variables_df(mad):
@@ -161,39 +328,7 @@ def _dependent_variables_df(mad):
     
     See madxp/examples/variablesExamples/000_run.py
     '''
-    my_dict={}
-    for i in list(mad.globals):
-        aux=_extract_parameters(str(mad._libmadx.get_var(i)))
-        if aux!=[]:
-            my_dict[i]={}
-            my_dict[i]['parameters']=list(np.unique(aux))
-    
-    myhash=hash(str(my_dict))
-    while True:
-        for i in my_dict:
-            aux=[]
-            for j in my_dict[i]['parameters']:
-                try:
-                    aux=aux+my_dict[j]['parameters']
-                except:
-                    aux=aux+[j]
-            my_dict[i]['knobs']=list(np.unique(aux))
-        if myhash==hash(str(my_dict)):
-            break
-        else:
-            myhash=hash(str(my_dict))
-    
-    for i in my_dict:
-        for j in my_dict[i]['knobs'].copy():
-            if mad._libmadx.get_var_type(j)==0:
-                my_dict[i]['knobs'].remove(j)
-        my_dict[i]['expression']=mad._libmadx.get_var(i)
-        my_dict[i]['value']=mad.globals[i]
-    
-    if len(my_dict)>0:
-        return pd.DataFrame(my_dict).transpose()[['value','expression','parameters','knobs']].sort_index()
-    else:
-        return pd.DataFrame()
+    return variables_dict(mad)['dependent_variable_df']
 
 def _independent_variables_df(mad):
     '''
@@ -209,77 +344,47 @@ def _independent_variables_df(mad):
    
     See madxp/examples/variablesExamples/000_run.py
     '''
+    my_dict=variables_dict(mad)
+    constant_df=my_dict['constant_df'].copy()
+    constant_df['constant']=True
+    independent_variable_df=my_dict['independent_variable_df'].copy()
+    independent_variable_df['constant']=False
+    return pd.concat([independent_variable_df, constant_df]).sort_index()
 
-    dep_df=_dependent_variables_df(mad)
-    #if len(dep_df)>0:
-    #    aux=list(dep_df['knobs'].values)
-    #    aux=list(itertools.chain.from_iterable(aux))
-    #fundamentalSet=set(np.unique(aux))
-    independent_variable_set=set(mad.globals)-set(dep_df.index)
-    my_dict={}
-    for i in independent_variable_set:
-        my_dict[i]={}
-        if mad._libmadx.get_var_type(i)==0:
-            my_dict[i]['constant']=True
-            # my_dict[i]['knob']=False
-        else:
-            my_dict[i]['constant']=False
-            # if i in fundamentalSet:
-            #    my_dict[i]['knob']=True
-            # else:
-            #    my_dict[i]['knob']=False
-        my_dict[i]['value']=mad.globals[i]
-    
-    return pd.DataFrame(my_dict).transpose()[['value','constant']].sort_index()
-
-def _knobs_from_parameters(parameters, indep_df, dep_df):
-    '''
-    Extract the list of knobs from a list of parameters.
-    
-    Args:
-        parameters: list of parameters
-        indep_df: independent variable DF
-        dep_df: dependent variable DF
-
-    Returns:
-        The list of knobs corresponding to the list of parameters.
-    
-    See madxp/examples/variablesExamples/000_run.py
-    '''
-    my_knobs=[]
-    for i in parameters:
-        if i in indep_df.index:
-            if not indep_df.loc[i]['constant']:
-                my_knobs.append([i])
-        else:
-            try:
-                my_knobs.append(dep_df.loc[i]['knobs'])
-            except:
-                print(f'Variable {i} not defined! Cosidered as a knob.')
-                my_knobs.append([i])
-    return list(itertools.chain.from_iterable(my_knobs))
-
-def sequence_df(mad,sequenceName):
+def sequence_df(mad,sequenceName,graph=None,columns=None,classes=None):
     '''
     Extract a pandas DF of the list of the elements and all their attributes for a given sequence.
     
     Args:
         mad: the MAD-X handle
         sequenceName: the sequence name
+        graph: the VariableGraph of the MAD-X handle (see 'variable_graph'). 
+               If None it is built from the MAD-X handle.
+        columns: the list of the element attributes to extract (e.g., ['k1', 'angle']).
+                 If None all the attributes are extracted (as strings and values), 
+                 otherwise only the numerical values of the selected attributes are gathered 
+                 in typed numpy arrays (columnar mode, see '_sequence_columns_df').
+        classes: the list of the element base types to extract (e.g., ['quadrupole', 'sbend']).
+                 If None all the elements are extracted.
 
     Returns:
         The list of knobs corresponding to the list of parameters.
     
     See madxp/examples/variablesExamples/000_run.py
     '''
+    if graph is None:
+        graph=variable_graph(mad)
+    if columns is not None:
+        return _sequence_columns_df(mad, sequenceName, graph, columns, classes)
+
     my_list=[]
     sequences=mad.sequence
     my_sequence=sequences[sequenceName]
-    indep_df=_independent_variables_df(mad)
-    dep_df=_dependent_variables_df(mad)
 
     for my_index, _ in enumerate(my_sequence.elements):
         aux=mad._libmadx.get_element(sequenceName,my_index)
+        if (classes is not None) and (aux['base_type'] not in classes):
+            continue
         my_dict={}
         my_dict['parameters']=[]
         for i in aux:
@@ -290,18 +395,110 @@ def sequence_df(mad,sequenceName):
             my_dict[i]=str(aux['data'][i])
             if isinstance(aux['data'][i], cpymad.types.Parameter):
                 my_dict[i+' value']=aux['data'][i].value
-                my_dict['parameters']+=_extract_parameters(str(aux['data'][i].expr))
-        my_dict['parameters']=np.unique(my_dict['parameters'])
+                my_dict['parameters']+=_safe_parameters(aux['data'][i].expr, f"{aux['name']}->{i}") or ()
+        my_dict['parameters']=sorted(set(my_dict['parameters']))
         my_list.append(my_dict)
     my_df=pd.DataFrame(my_list)
     my_df=my_df.set_index('name')
     my_df.index.name=''
-    my_df['knobs']=my_df['parameters'].apply(lambda x: _knobs_from_parameters(x,indep_df,dep_df))
+    my_df['knobs']=my_df['parameters'].apply(graph.knobs_from_parameters)
     first_columns=['position','parent','base_type','length','parameters','knobs']
     last_columns=list(set(my_df.columns)-set(first_columns))
     last_columns.sort()
     return my_df[first_columns+last_columns]
 
+def _sequence_columns_df(mad, sequenceName, graph, columns, classes=None):
+    '''
+    Extract the selected attributes of the elements of a sequence in columnar mode.
+
+    The values are written directly in preallocated numpy arrays (float, or object for 
+    string and array attributes) and the DF is assembled once at the end.
+    The 'parameters' and the 'knobs' are the ones of the selected attributes only and the knobs
+    are resolved with the precomputed VariableGraph.
+
+    Args:
+        mad: the MAD-X handle
+        sequenceName: the sequence name
+        graph: the VariableGraph of the MAD-X handle.
+        columns: the list of the element attributes to extract.
+        classes: the list of the element base types to extract. If None all the elements are extracted.
+
+    Returns:
+        The pandas DF with the columns 'position', 'parent', 'base_type', 'length', 'parameters', 'knobs'
+        and the selected attributes (NaN if an element has not the attribute).
+    '''
+    libmadx=mad._libmadx
+    my_len=libmadx.get_element_count(sequenceName)
+    names=np.empty(my_len, dtype=object)
+    parents=np.empty(my_len, dtype=object)
+    base_types=np.empty(my_len, dtype=object)
+    positions=np.full(my_len, np.nan)
+    lengths=np.full(my_len, np.nan)
+    parameters=np.empty(my_len, dtype=object)
+    values={i: np.full(my_len, np.nan) for i in columns}
+    selected=np.zeros(my_len, dtype=bool)
+
+    for my_index in range(my_len):
+        aux=libmadx.get_element(sequenceName, my_index)
+        if (classes is not None) and (aux['base_type'] not in classes):
+            continue
+        selected[my_index]=True
+        names[my_index]=aux['name']
+        parents[my_index]=aux['parent']
+        base_types[my_index]=aux['base_type']
+        positions[my_index]=aux['position']
+        lengths[my_index]=aux['length']
+        my_parameters=set()
+        for i in columns:
+            my_parameter=aux['data'].get(i)
+            if my_parameter is None:
+                continue
+            my_value=my_parameter.value
+            if not isinstance(my_value, (int, float)) and values[i].dtype!=object:
+                values[i]=values[i].astype(object)
+            values[i][my_index]=my_value
+            my_parameters.update(_safe_parameters(my_parameter.expr, f"{aux['name']}->{i}") or ())
+        parameters[my_index]=sorted(my_parameters)
+
+    my_df=pd.DataFrame({'position': positions[selected],
+                        'parent': parents[selected],
+                        'base_type': base_types[selected],
+                        'length': lengths[selected],
+                        'parameters': parameters[selected]},
+                        index=names[selected])
+    my_df.index.name=''
+    my_df['knobs']=[graph.knobs_from_parameters(i) for i in my_df['parameters']]
+    for i in columns:
+        my_df[i]=values[i][selected]
+    return my_df
+
+_knob_index_cache={}
+
+def knob_index(my_df, rebuild=False):
+    '''
+    Return the inverted index from the knobs to the rows of a pandas DF.
+
+    The index is built once per DF and kept for the following queries of the session 
+    (it is dropped when the DF is garbage collected or when its row labels change).
+    
+    Args:
+        my_df: a pandas DF (it assumes that DF has a column called "knobs").
+        rebuild: force the rebuild of the index (e.g., after an in-place change of the "knobs" column).
+
+    Returns:
+        The KnobIndex of the DF.
+    
+    See madxp/examples/variablesExamples/000_run.py
+    '''
+    key=id(my_df)
+    aux=_knob_index_cache.get(key)
+    if rebuild or (aux is None) or (not aux.is_valid(my_df)):
+        if key not in _knob_index_cache:
+            weakref.finalize(my_df, _knob_index_cache.pop, key, None)
+        aux=KnobIndex(my_df)
+        _knob_index_cache[key]=aux
+    return aux
+
 def knobs_df(my_df):
     '''
     Extract the knob list of a pandas DF (it assumes that DF has a column called "knobs")
@@ -309,6 +506,8 @@ def knobs_df(my_df):
     
     Args:
         my_df: a pandas DF (it assumes that DF has a column called "knobs").
+               It can be also a VariableGraph: in this case the knobs of all the 
+               dependent variables are returned.
 
     Returns:
         A data frame of knobs.
@@ -316,17 +515,15 @@ def knobs_df(my_df):
     See madxp/examples/variablesExamples/000_run.py
 
     '''
-    import itertools
-    import numpy as np
-    aux= list(my_df['knobs'].values)
-    aux= list(np.unique(list(itertools.chain.from_iterable(aux))))
+    if isinstance(my_df, VariableGraph):
+        return my_df.knobs_df()
+    my_index=knob_index(my_df)
     my_dict={}
-    for i in aux:
+    for i in my_index.knobs:
         my_dict[i]={}
-        filter_df=knob_df(i, my_df)
-        my_dict[i]['multeplicity']=len(filter_df)
-        my_dict[i]['dependences']=list(filter_df.index)
-    return pd.DataFrame(my_dict).transpose().sort_values('multeplicity', ascending=False)
+        my_dict[i]['multeplicity']=len(my_index.positions(i))
+        my_dict[i]['dependences']=my_index.labels(i)
+    return pd.DataFrame(my_dict).transpose().sort_values('multeplicity', ascending=False, kind='stable')
 
 
 def knob_df(my_knob,my_df):
@@ -343,41 +540,120 @@ def knob_df(my_knob,my_df):
     See madxp/examples/variablesExamples/000_run.py
 
     '''
-    return my_df[my_df['knobs'].apply(lambda x: my_knob in x)]
+    return my_df.iloc[knob_index(my_df).positions(my_knob)]
 
-def table_df(table):
+def _table_rows(table, classes=None, pattern=None, s_range=None):
+    '''
+    Select the rows of a MAD-X table.
+
+    Args:
+        table: the MAD-X table handle
+        classes: the list of the element keywords to keep (e.g., ['quadrupole']). None to keep all.
+        pattern: a regular expression matching the start of the row names to keep. None to keep all.
+        s_range: the (s_min, s_max) interval of the rows to keep (boundaries included). None to keep all.
+
+    Returns:
+        The numpy array of the indices of the selected rows or 'all' if no filter is given.
+        Only the columns needed by the filters are loaded from MAD-X.
+    '''
+    if classes is None and pattern is None and s_range is None:
+        return 'all'
+    mask=None
+    if classes is not None:
+        mask=np.isin(table.column('keyword', rows='all'), classes)
+    if pattern is not None:
+        my_regex=re.compile(pattern)
+        aux=np.array([my_regex.match(i) is not None for i in table.column('name', rows='all')], dtype=bool)
+        mask=aux if mask is None else mask & aux
+    if s_range is not None:
+        my_s=table.column('s', rows='all')
+        aux=(my_s>=s_range[0]) & (my_s<=s_range[1])
+        mask=aux if mask is None else mask & aux
+    return np.flatnonzero(mask)
+
+class LazyTable():
+    '''
+    A MAD-X table whose columns are loaded from MAD-X only on first access (and then cached).
+
+    Args:
+        table: the MAD-X table handle
+        classes, pattern, s_range: the row filters (see 'table_df').
+
+    The columns are numpy arrays restricted to the selected rows. Since the columns are loaded lazily, 
+    the table should not be recomputed by MAD-X while the LazyTable is in use.
+    
+    See madxp/examples/variablesExamples/000_run.py
+    '''
+    def __init__(self, table, classes=None, pattern=None, s_range=None):
+        self._table=table
+        self._rows=_table_rows(table, classes, pattern, s_range)
+        self._cache={}
+
+    @property
+    def columns(self):
+        '''The list of the columns of the table.'''
+        return list(self._table.col_names())
+
+    def __getitem__(self, column):
+        if column not in self._cache:
+            self._cache[column]=self._table.column(column, rows=self._rows)
+        return self._cache[column]
+
+    def __len__(self):
+        return len(self['name'])
+
+    def __repr__(self):
+        return f'<LazyTable {self._table._name!r}: {len(self)} rows, loaded columns {list(self._cache)}>'
+
+    def df(self, columns=None):
+        '''
+        Return the pandas DF of the table with the selected columns (all if None), indexed by 'name'.
+        '''
+        if columns is None:
+            columns=self.columns
+        columns=['name']+[i for i in columns if i!='name']
+        my_df=pd.DataFrame({i: self[i] for i in columns})
+        my_df=my_df.set_index('name', drop = False)
+        my_df.index.name=''
+        return my_df
+
+def table_df(table, columns=None, classes=None, pattern=None, s_range=None):
     '''
     Extract the pandas DF of a MAD-X table.
     
     Args:
         table: the MAD-X table handle 
+        columns: the list of the columns to extract (the 'name' column is always present). None for all the columns.
+        classes: the list of the element keywords of the rows to extract (e.g., ['quadrupole']). None for all the rows.
+        pattern: a regular expression matching the start of the names of the rows to extract (e.g., 'ip[15]'). 
+        s_range: the (s_min, s_max) interval of the rows to extract (boundaries included).
 
     Returns:
-        The pandas DF of a MAD-X table.
+        The pandas DF of a MAD-X table. Only the requested columns and rows are transferred from MAD-X.
     
     See madxp/examples/variablesExamples/000_run.py
     '''
-    my_df=pd.DataFrame(dict(table))
-    my_df=my_df.set_index('name', drop = False)
-    my_df.index.name=''
-    return my_df
+    if columns is None and classes is None and pattern is None and s_range is None:
+        my_df=pd.DataFrame(dict(table))
+        my_df=my_df.set_index('name', drop = False)
+        my_df.index.name=''
+        return my_df
+    return LazyTable(table, classes=classes, pattern=pattern, s_range=s_range).df(columns)
 
-def twiss_df(table):
+def twiss_df(table, columns=None, classes=None, pattern=None, s_range=None):
     '''
     Extract the pandas DF of a MAD-X twiss table.
     
     Args:
         table: the MAD-X table handle 
+        columns, classes, pattern, s_range: the column and row selection (see 'table_df').
 
     Returns:
         The pandas DF of a MAD-X table.
     
     See madxp/examples/variablesExamples/000_run.py
     '''
-    my_df=pd.DataFrame(dict(table))
-    my_df=my_df.set_index('name', drop = False)
-    my_df.index.name=''
-    return my_df
+    return table_df(table, columns=columns, classes=classes, pattern=pattern, s_range=s_range)
 
 def summ_df(table):
     '''
@@ -414,22 +690,38 @@ def show_element(element_name, sequence_df):
 
 # %% Interpolation 
 
-def table_interpolation_df(my_s_list, my_table):
+def table_interpolation_df(my_s_list, my_table, method='madx', beta0=1., processes=None):
     '''
     Thanks to H. Bartosik for sharing his code and for the discussion.
     
     This function will interpolate in a list of s-positions the MAD-X table passed as argument.
     This table has to be a full MAD-X twiss table (e.g., 'e1', 'fint',... columns have to be present).
-    For each element in my_s_list there will be a twiss-command of a short sequence. 
+
+    With method='madx', for each element in my_s_list there will be a twiss-command of a short sequence. 
     This can be time consuming for long lists. It this case please look to MAD-X interpolate command at
     http://mad.web.cern.ch/mad/webguide/manual.html#Ch19.S10.
-
     The rationale is to make a new instance of MAD-X in the body of the funciton and to build-and-twiss mini sequences.
     The twiss will be performed with given initial values http://mad.web.cern.ch/mad/webguide/manual.html#Ch19.S3.
 
+    With method='batch', all the mini sequences are concatenated (sorted in s) in a single sequence and a single 
+    twiss computes the transfer map of each of them (MAD-X sectormap, http://mad.web.cern.ch/mad/webguide/manual.html#Ch19.S9).
+    The initial values are then propagated with these maps in numpy (to second order for the orbit).
+
+    With method='matrix', the optics is propagated in numpy for all the s-positions at once with the 
+    analytic transfer matrices of drifts, quadrupoles and bends (see madxp.optics). 
+
+    For the 'batch' and 'matrix' methods, the positions in unsupported elements (other keywords, tilt or skew gradient) 
+    are computed with the 'madx' method and only the columns in madxp.optics.INTERPOLATION_COLUMNS are returned.
+
     Args:
         my_s_list: list of s-position to be evaluated
         my_table: a MAD-X twiss table.
+        method: 'madx', 'batch' or 'matrix'.
+        beta0: the relativistic beta of the beam of the twiss (method='matrix' only, the other methods assume beta0=1).
+        processes: number of worker processes for the 'madx' method (None for a serial execution). 
+            The s-positions are split in shards, each worker process has its own MAD-X instance.
+
+    A ValueError is raised for a position in an element whose keyword has not been implemented in the 'madx' method.
 
     Returns:
         The pandas DF with the interpolated values. 
@@ -437,166 +729,428 @@ def table_interpolation_df(my_s_list, my_table):
     See madxp/examples/variablesExamples/000_run.py
 
     '''
+    if method in ['batch', 'matrix']:
+        return _table_interpolation_vectorized_df(my_s_list, my_table, method, beta0, processes)
+    assert method=='madx', f'Unknown method {method}.'
     # my_s_list=[2.8], my_table=mt.table_df(mad.table.twiss)
-    my_list=[]
-    madx=Madx(stdout=False)
+    my_s_list=np.asarray(my_s_list, dtype=float)
+    element_position, start_position=_interpolation_positions(my_s_list, my_table)
+    my_points=list(zip(my_s_list, my_table.iloc[element_position].iterrows(), my_table.iloc[start_position].iterrows()))
+    my_points=[(my_s, my_element_row, start_condition_row) for my_s, (_, my_element_row), (_, start_condition_row) in my_points]
 
-    for my_s in my_s_list:
-        try:
-            start_condition=my_table[my_table['s']<my_s].index[-1]
-        except:
-            start_condition=my_table.index[0]
+    if processes is None or processes==1 or len(my_points)<2:
+        my_list=_interpolation_points(my_points)
+    else:
+        # contiguous shards of the sorted positions, few per worker to balance the load
+        order=np.argsort(my_s_list, kind='stable')
+        shards=[i for i in np.array_split(order, 4*processes) if len(i)>0]
+        # the workers are forked (no re-import of the main script): the objects inherited from this process
+        # (e.g., other MAD-X instances) are frozen so that the garbage collection of the workers does not finalize them
+        if 'fork' in multiprocessing.get_all_start_methods():
+            my_context=multiprocessing.get_context('fork')
+        else:
+            my_context=None
+        gc.freeze()
         try:
-            my_element=my_table[my_table['s']>=my_s].index[0]
-        except:
-            my_element=my_table.index[-1]
+            with ProcessPoolExecutor(max_workers=processes, mp_context=my_context, initializer=_interpolation_worker_init) as executor:
+                results=executor.map(_interpolation_worker, [[my_points[i] for i in my_shard] for my_shard in shards])
+                my_list=[None]*len(my_points)
+                for my_shard, my_result in zip(shards, results):
+                    for i, interpolation in zip(my_shard, my_result):
+                        my_list[i]=interpolation
+        finally:
+            gc.unfreeze()
+    return pd.concat(my_list)
+
+def _interpolation_point_df(madx, my_s, my_element_row, start_condition_row):
+    '''
+    Interpolate the MAD-X table in one s-position with a twiss of a mini sequence (see table_interpolation_df).
+    It raises a ValueError if the keyword of the element has not been implemented.
+    '''
+    if my_element_row.s==my_s:
+        return pd.DataFrame(my_element_row).transpose()
+    assert my_element_row.l>0 # The elements need to be thick
+    my_string=_interpolation_element_string('my_special_element', my_element_row, my_s-start_condition_row.s)
+    if my_string is None:
+        raise ValueError(f'The element keyword {my_element_row.keyword} ({my_element_row.name}) has not been implemented. '
+                         f'Consider to remove the interpolating position at {my_s} m.')
+
+    my_string =  my_string + f''' 
+        my_special_sequence: sequence, l={my_s-start_condition_row.s}, refer=entry;
+        at_{my_s:}:my_special_element, at=0;
+        endsequence;
         
-        my_element_row= my_table.loc[my_element]
-        start_condition_row= my_table.loc[start_condition]
-        if my_element_row.s==my_s:
-            interpolation=pd.DataFrame(my_element_row).transpose()
-        else:
-            assert my_element_row.l>0 # The elements need to be thick
-            if my_element_row.keyword in ['quadrupole',
-                                        'drift', 
-                                        'sextupole', 
-                                        'octupole', 
-                                        'placeholder',
-                                        'hmonitor',
-                                        'vmonitor',
-                                        'monitor',
-                                        ]:
-                my_string=f'''
-                    my_special_element: quadrupole,
-                    l= {my_s-start_condition_row.s},
-                    k1={my_element_row.k1l/my_element_row.l}, 
-                    k1s={my_element_row.k1sl/my_element_row.l},
-                    tilt={my_element_row.tilt};
-                '''
-            elif my_element_row.keyword in ['sbend']:
-                # 
-                my_string=f'''
-                    my_special_element: sbend,
-                    l={my_s-start_condition_row.s},
-                    angle={my_element_row.angle/my_element_row.l*{my_s-start_condition_row.s}},
-                    tilt={my_element_row.tilt},
-                    k1={my_element_row.k1l/my_element_row.l},
-                    e1={my_element_row.e1},
-                    fint={my_element_row.fint},
-                    fintx=0,
-                    hgap={my_element_row.hgap},
-                    k1s={my_element_row.k1sl/my_element_row.l},
-                    h1={my_element_row.h1},
-                    h2=0,
-                    kill_exi_fringe=0;
-                '''
-            elif my_element_row.keyword in ['rbend']:
-                my_string=f'''
-                    option, rbarc=false;
-                    my_special_element: rbend,
-                    l= {my_s-start_condition_row.s},
-                    angle={my_element_row.angle/my_element_row.l*{my_s-start_condition_row.s}},
-                    k1={my_element_row.k1l/my_element_row.l},
-                    e1={my_element_row.e1},
-                    fint={my_element_row.fint},
-                    fintx=0,
-                    hgap={my_element_row.hgap},
-                    k1s={my_element_row.k1sl/my_element_row.l},
-                    h1={my_element_row.h1},
-                    h2=0,
-                    kill_exi_fringe=0;
-                '''
-            elif my_element_row.keyword in ['matrix', 
-                                          'collimator',
-                                          'elseparator',
-                                          'hacdipole',
-                                          'vacdipole',
-                                          'twcavity',
-                                          'tkicker',
-                                          'hkicker',
-                                          'vkicker',
-                                          'kicker',
-                                          'solenoid'
-                                          'rfcavity']:
-                print(f'The element keyword {my_element_row.keyword} has not been implemented.')
-                print(f'Consider to remove the interpolating position at {my_s} m.')
-                return
-
-            my_string =  my_string + f''' 
-                my_special_sequence: sequence, l={my_s-start_condition_row.s}, refer=entry;
-                at_{my_s:}:my_special_element, at=0;
-                endsequence;
-                
-                beam, sequence=my_special_sequence; ! we assume normalized elements
-                use, sequence=my_special_sequence;
-                
-                twiss, 
-                betx  = {start_condition_row.betx}, 
-                alfx  = {start_condition_row.alfx}, 
-                mux   = {start_condition_row.mux}, 
-                bety  = {start_condition_row.bety}, 
-                alfy  = {start_condition_row.alfy},
-                muy   = {start_condition_row.muy}, 
-                dx    = {start_condition_row.dx},
-                dpx   = {start_condition_row.dpx},
-                dy    = {start_condition_row.dy},
-                dpy   = {start_condition_row.dpy},
-                x     = {start_condition_row.x},
-                px    = {start_condition_row.px},
-                y     = {start_condition_row.y},
-                py    = {start_condition_row.py},
-                t     = {start_condition_row.t},
-                pt    = {start_condition_row.pt},
-                wx    = {start_condition_row.wx},
-                phix  = {start_condition_row.phix},
-                dmux  = {start_condition_row.dmux},
-                wy    = {start_condition_row.wy},
-                phiy  = {start_condition_row.phiy},
-                dmuy  = {start_condition_row.dmuy},
-                ddx   = {start_condition_row.ddx},
-                ddy   = {start_condition_row.ddy},
-                ddpx  = {start_condition_row.ddpx},
-                ddpy  = {start_condition_row.ddpy},
-                r11   = {start_condition_row.r11},
-                r12   = {start_condition_row.r12},
-                r21   = {start_condition_row.r21},
-                r22   = {start_condition_row.r22},
-                table=special_twiss;
-                '''
-            madx.input(my_string)
-            madx.input('delete, sequence=my_special_sequence;my_special_element=0;')
-            interpolation=table_df(madx.table.special_twiss).iloc[[1]]
-            interpolation.keyword='interpolation'
-            interpolation.s=my_s
-        my_list.append(interpolation)
+        beam, sequence=my_special_sequence; ! we assume normalized elements
+        use, sequence=my_special_sequence;
+        
+        twiss, 
+        betx  = {start_condition_row.betx}, 
+        alfx  = {start_condition_row.alfx}, 
+        mux   = {start_condition_row.mux}, 
+        bety  = {start_condition_row.bety}, 
+        alfy  = {start_condition_row.alfy},
+        muy   = {start_condition_row.muy}, 
+        dx    = {start_condition_row.dx},
+        dpx   = {start_condition_row.dpx},
+        dy    = {start_condition_row.dy},
+        dpy   = {start_condition_row.dpy},
+        x     = {start_condition_row.x},
+        px    = {start_condition_row.px},
+        y     = {start_condition_row.y},
+        py    = {start_condition_row.py},
+        t     = {start_condition_row.t},
+        pt    = {start_condition_row.pt},
+        wx    = {start_condition_row.wx},
+        phix  = {start_condition_row.phix},
+        dmux  = {start_condition_row.dmux},
+        wy    = {start_condition_row.wy},
+        phiy  = {start_condition_row.phiy},
+        dmuy  = {start_condition_row.dmuy},
+        ddx   = {start_condition_row.ddx},
+        ddy   = {start_condition_row.ddy},
+        ddpx  = {start_condition_row.ddpx},
+        ddpy  = {start_condition_row.ddpy},
+        r11   = {start_condition_row.r11},
+        r12   = {start_condition_row.r12},
+        r21   = {start_condition_row.r21},
+        r22   = {start_condition_row.r22},
+        table=special_twiss;
+        '''
+    madx.input(my_string)
+    madx.input('delete, sequence=my_special_sequence;my_special_element=0;')
+    interpolation=table_df(madx.table.special_twiss).iloc[[1]]
+    interpolation.keyword='interpolation'
+    interpolation.s=my_s
+    return interpolation
+
+def _interpolation_points(my_points, madx=None):
+    '''
+    Interpolate the MAD-X table in a list of (s-position, element row, start condition row).
+    A new MAD-X instance is used if madx is None.
+    '''
+    if madx is None:
+        with Madx(stdout=False) as madx:
+            return _interpolation_points(my_points, madx)
+    my_list=[]
+    for my_point in my_points:
+        my_list.append(_interpolation_point_df(madx, *my_point))
         gc.collect()
-    return pd.concat(my_list)
+    return my_list
 
-def python_data_to_mad(mad, python_data, verbose=False):
+# the MAD-X instance of a worker process of table_interpolation_df
+_interpolation_madx=None
+
+def _interpolation_worker_init():
+    global _interpolation_madx
+    _interpolation_madx=Madx(stdout=False)
+
+def _interpolation_worker(my_points):
+    return _interpolation_points(my_points, _interpolation_madx)
+
+def _interpolation_positions(my_s, my_table):
     '''
-    It assigns a dictionary to a MAD-X handle.
+    Find, for each s-position, the table row of the element containing it and the one of the start conditions 
+    (the last row before it). The s column of the table is sorted.
     '''
-    for i in python_data:
-        if i[0]!='_': 
-            if isinstance(python_data[i],float) or isinstance(python_data[i],int):
-                mad.input(f'{i}={python_data[i]};')
+    aux=np.searchsorted(my_table['s'].values, my_s, side='left')
+    return np.minimum(aux, len(my_table)-1), np.maximum(aux-1, 0)
+
+def _interpolation_element_string(my_name, my_element_row, my_length):
+    '''
+    The MAD-X definition of the first part (of length my_length) of an element of a full twiss table.
+    It returns None if the element keyword has not been implemented.
+    '''
+    if my_element_row.keyword in ['quadrupole',
+                                'drift', 
+                                'sextupole', 
+                                'octupole', 
+                                'placeholder',
+                                'hmonitor',
+                                'vmonitor',
+                                'monitor',
+                                'instrument',
+                                'collimator',
+                                'rcollimator',
+                                'ecollimator',
+                                ]:
+        return f'''
+            {my_name}: quadrupole,
+            l= {my_length},
+            k1={my_element_row.k1l/my_element_row.l}, 
+            k1s={my_element_row.k1sl/my_element_row.l},
+            tilt={my_element_row.tilt};
+        '''
+    elif my_element_row.keyword in ['sbend', 'rbend']:
+        # in the twiss table the face angles of an rbend are already the ones of the equivalent sbend
+        return f'''
+            {my_name}: sbend,
+            l={my_length},
+            angle={my_element_row.angle/my_element_row.l*my_length},
+            tilt={my_element_row.tilt},
+            k1={my_element_row.k1l/my_element_row.l},
+            e1={my_element_row.e1},
+            fint={my_element_row.fint},
+            fintx=0,
+            hgap={my_element_row.hgap},
+            k1s={my_element_row.k1sl/my_element_row.l},
+            h1={my_element_row.h1},
+            h2=0,
+            kill_exi_fringe=false;
+        '''
+    return None
+
+def _interpolation_maps(my_s, start_df, element_df):
+    '''
+    Interpolate with the MAD-X transfer maps of the mini sequences, computed with a single twiss (see table_interpolation_df).
+    '''
+    my_length=my_s-start_df['s'].values
+    order=np.argsort(my_s, kind='stable')
+    my_elements=[]
+    my_sequence=[]
+    at=0.
+    for j, my_position in enumerate(order):
+        my_elements.append(_interpolation_element_string(f'interpolation_{j}', element_df.iloc[my_position], my_length[my_position]))
+        my_sequence.append(f'p{j}: interpolation_{j}, at={at};')
+        at=at+my_length[my_position]
+    with Madx(stdout=False) as madx:
+        madx.input('\n'.join(my_elements))
+        # the sector maps are also written on a file
+        with tempfile.TemporaryDirectory() as my_directory:
+            madx.input(f'''
+                interpolation_sequence: sequence, l={at}, refer=entry;
+                {''.join(my_sequence)}
+                endsequence;
+
+                beam, sequence=interpolation_sequence; ! we assume normalized elements
+                use, sequence=interpolation_sequence;
+
+                select, flag=sectormap, clear;
+                select, flag=sectormap, pattern="^p";
+                twiss, betx=1, bety=1, sectormap, sectortable=interpolation_maps, sectorfile="{os.path.join(my_directory, 'sectormap')}";
+                ''')
+        my_table=madx.table.interpolation_maps
+        assert list(my_table.name)==[f'p{j}' for j in range(len(order))]
+        aux=range(1, 7)
+        kick=np.stack([my_table[f'k{i}'] for i in aux], axis=-1)
+        rmatrix=np.stack([np.stack([my_table[f'r{i}{j}'] for j in aux], axis=-1) for i in aux], axis=-2)
+        tmatrix=np.stack([np.stack([np.stack([my_table[f't{i}{j}{k}'] for k in aux], axis=-1) for j in aux], axis=-2) for i in aux], axis=-3)
+    # back to the order of the s-positions
+    inverse=np.empty_like(order)
+    inverse[order]=np.arange(len(order))
+    return optics.propagate(my_s, start_df, rmatrix[inverse], kick[inverse], tmatrix[inverse])
+
+def _table_interpolation_vectorized_df(my_s_list, my_table, method, beta0=1., processes=None):
+    '''
+    Interpolate the MAD-X table in a list of s-positions with the 'batch' or 'matrix' method (see table_interpolation_df).
+    '''
+    my_s=np.asarray(my_s_list, dtype=float)
+    element_position, start_position=_interpolation_positions(my_s, my_table)
+    element_df=my_table.iloc[element_position]
+    start_df=my_table.iloc[start_position]
+
+    exact=my_table['s'].values[element_position]==my_s
+    vectorized=(~exact) & optics.supported(element_df)
+    assert np.all(element_df['l'].values[vectorized]>0) # The elements need to be thick
+
+    columns=[i for i in optics.INTERPOLATION_COLUMNS if i in my_table.columns]
+    my_list=[element_df[exact][columns]]
+    positions=[np.flatnonzero(exact)]
+    if np.any(vectorized):
+        if method=='matrix':
+            interpolation=optics.interpolate(my_s[vectorized], start_df[vectorized], element_df[vectorized], beta0)
+        else:
+            interpolation=_interpolation_maps(my_s[vectorized], start_df[vectorized], element_df[vectorized])
+        my_list.append(interpolation[columns])
+        positions.append(np.flatnonzero(vectorized))
+    fallback=~(exact | vectorized)
+    if np.any(fallback):
+        my_list.append(table_interpolation_df(my_s[fallback], my_table, processes=processes)[columns])
+        positions.append(np.flatnonzero(fallback))
+    my_df=pd.concat([i for i in my_list if len(i)>0])
+    my_df.index.name=''
+    return my_df.iloc[np.argsort(np.concatenate(positions), kind='stable')]
+
+# the versions of cpymad and minrpc whose RPC client is used by '_madx_exec'
+_EXEC_TESTED={'cpymad': '1.19.', 'minrpc': '0.2.'}
+
+_GET_VARIABLES_CODE='''
+from cpymad import libmadx
+result={}
+for name in names:
+    try:
+        result[name]=(libmadx.get_var(name).value, None)
+    except Exception as error:
+        result[name]=(None, f'{type(error).__name__}: {error}')
+'''
+
+def _madx_exec_check(mad):
+    '''
+    Check if python code can be executed in the MAD-X process of 'mad' (see _EXEC_TESTED).
+
+    Returns:
+        None if it can be executed, otherwise the reason.
+    '''
+    for package, version in _EXEC_TESTED.items():
+        try:
+            aux=importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            return f'{package} version not found'
+        if not aux.startswith(version):
+            return f'{package} {aux} is not a tested version ({version}x)'
+    if not hasattr(getattr(mad._libmadx, '_RemoteModule__client', None), '_request'):
+        return 'the MAD-X instance has no RPC client'
+    return None
+
+def _madx_exec(mad, code, **kwargs):
+    '''
+    Execute python code in the MAD-X process with a single call (fast path of 'get_variables').
+    It uses the RPC client of cpymad (not a public API), only with the tested versions of cpymad
+    and minrpc (_EXEC_TESTED).
+
+    Args:
+        mad: The MAD-X handle.
+        code: the python code, it has to define the variable 'result'.
+        kwargs: the variables (picklable) available to the code.
+
+    Returns:
+        The variable 'result' of the code or None if the RPC client cannot be used.
+    '''
+    if _madx_exec_check(mad) is not None:
+        return None
+    try:
+        return mad._libmadx._RemoteModule__client._request('function_call', 'builtins', 'eval',
+            ("exec(code, namespace) or namespace['result']", {'code': code, 'namespace': dict(kwargs)}), {})
+    except (AttributeError, TypeError) as error:
+        # the RPC protocol is not the expected one (the crashes of the MAD-X process are not caught)
+        print(f'Warning: the python code cannot be executed in the MAD-X process ({type(error).__name__}: {error}).')
+        return None
+
+def _family_names(name, shape):
+    '''
+    The MAD-X names of the variable family of a numpy array (e.g., 'kq_0', 'kq_1', ... or 'kq_0_0', ... in 2D).
+    '''
+    return [name+''.join(f'_{j}' for j in index) for index in np.ndindex(*shape)]
+
+def set_variables(mad, variables, deferred=False):
+    '''
+    Assign many MAD-X variables with a single MAD-X input.
+
+    Args:
+        mad: The MAD-X handle.
+        variables: a dictionary {name: value}. The values can be numbers (python or numpy scalars),
+            numpy arrays (assigned to the variable family 'name_i', see '_family_names') or
+            strings (MAD-X expressions, assigned only if deferred).
+        deferred: True to assign all the variables as deferred expressions (':='), or a list of the 
+            names to assign as deferred expressions.
+
+    Returns:
+        The dictionary {name: reason} of the variables that were not assigned (e.g., NaN and inf values
+        or, for arrays, their elements).
+
+    See madxp/examples/variablesExamples/000_run.py
+    '''
+    lines=[]
+    skipped={}
+    for i, value in variables.items():
+        operator=':=' if (deferred is True) or (deferred is not False and i in deferred) else '='
+        if isinstance(value, (bool, np.bool_, int, np.integer)):
+            lines.append(f'{i}{operator}{int(value)};')
+        elif isinstance(value, (float, np.floating)):
+            # MAD-X reads nan and inf as undefined variables (equal to 0)
+            if np.isfinite(value):
+                lines.append(f'{i}{operator}{float(value)!r};')
             else:
-                if verbose:
-                    print(f'{i} was not assigned to the MAD-X instance.')
+                skipped[i]='not finite'
+        elif isinstance(value, np.ndarray) and value.dtype.kind in 'biuf':
+            for j, k in zip(_family_names(i, value.shape), value.ravel().tolist()):
+                if np.isfinite(k):
+                    lines.append(f'{j}{operator}{k!r};')
+                else:
+                    skipped[j]='not finite'
+        elif isinstance(value, str) and operator==':=':
+            lines.append(f'{i}{operator}{value};')
         else:
-            if verbose:
-                print(f'{i} was not assigned to the MAD-X instance.')
+            skipped[i]=f'type {type(value).__name__} not supported'
+    if len(lines)>0:
+        mad.input('\n'.join(lines))
+    return skipped
+
+def _get_variables_loop(mad, names):
+    '''
+    Read the MAD-X variables one by one (slow path of 'get_variables', same output of _GET_VARIABLES_CODE).
+    '''
+    result={}
+    for name in names:
+        try:
+            result[name]=(mad._libmadx.get_var(name).value, None)
+        except KeyError as error:
+            # the remote error message is the full traceback of the MAD-X process: keep its last line
+            result[name]=(None, str(error).strip().splitlines()[-1])
+    return result
+
+def get_variables(mad, names):
+    '''
+    Read many MAD-X variables with a single call to the MAD-X process.
+    If the call cannot be done (see '_madx_exec') the variables are read one by one.
+
+    Args:
+        mad: The MAD-X handle.
+        names: the list of the variable names.
+
+    Returns:
+        The dictionary {name: value} of the variables found and the dictionary {name: error} of the others.
+
+    See madxp/examples/variablesExamples/000_run.py
+    '''
+    aux=_madx_exec(mad, _GET_VARIABLES_CODE, names=list(names))
+    if aux is None:
+        aux=_get_variables_loop(mad, names)
+    values={i: aux[i][0] for i in aux if aux[i][1] is None}
+    errors={i: aux[i][1] for i in aux if aux[i][1] is not None}
+    return values, errors
+
+def python_data_to_mad(mad, python_data, verbose=False, deferred=False):
+    '''
+    It assigns a dictionary to a MAD-X handle (with a single MAD-X input, see 'set_variables').
+    The keys starting with '_' are not assigned.
+    It returns the dictionary {key: reason} of the keys not assigned.
+    '''
+    skipped={i: 'private key' for i in python_data if i[0]=='_'}
+    skipped.update(set_variables(mad, {i: python_data[i] for i in python_data if i[0]!='_'}, deferred=deferred))
+    if verbose:
+        for i in skipped:
+            print(f'{i} was not assigned to the MAD-X instance ({skipped[i]}).')
+    return skipped
 
 
 def mad_to_python_data(mad, python_data, verbose=False):
     '''
     It assigns the variables present in python_data from the values of the
-    MAD-X workspace.
+    MAD-X workspace (with a single call, see 'get_variables'). The numpy arrays are 
+    read from their MAD-X variable family (see 'set_variables').
+    It returns the dictionary {key: error} of the keys not found.
     '''
+    names=[]
     for i in python_data:
-        try:
-            a=mad.globals[i]
-            python_data[i]=a
-        except:
-            if verbose:
-                print(f'{i} not found in MAD-X instance.')
+        if isinstance(python_data[i], np.ndarray):
+            names+=_family_names(i, python_data[i].shape)
+        else:
+            names.append(i)
+    values, errors=get_variables(mad, names)
+    my_errors={}
+    for i in python_data:
+        if isinstance(python_data[i], np.ndarray):
+            family=_family_names(i, python_data[i].shape)
+            missing=[j for j in family if j in errors]
+            if len(missing)>0:
+                my_errors[i]=errors[missing[0]]
+            else:
+                python_data[i]=np.array([values[j] for j in family]).reshape(python_data[i].shape)
+        elif i in errors:
+            my_errors[i]=errors[i]
+        else:
+            python_data[i]=values[i]
+    if verbose:
+        for i in my_errors:
+            print(f'{i} not found in MAD-X instance ({my_errors[i]}).')
+    return my_errors
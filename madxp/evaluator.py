@@ -0,0 +1,248 @@
+'''
+Compiler of the MAD-X deferred expressions in vectorized numpy evaluators.
+
+The expressions of the dependent variables (see cpymadTool.variables_dict) and of the element
+attributes (see cpymadTool.sequence_df) are translated in a single python function of the knobs.
+A batch of N knob settings is then evaluated with one vectorized call, without MAD-X.
+
+See madxp/examples/variablesExamples/000_run.py
+'''
+import numpy as np
+import pandas as pd
+from scipy import special
+from madxp import expression
+from madxp.graph import VariableGraph
+
+_FUNCTIONS={'sqrt': 'np.sqrt',
+            'log': 'np.log',
+            'log10': 'np.log10',
+            'exp': 'np.exp',
+            'sin': 'np.sin',
+            'cos': 'np.cos',
+            'tan': 'np.tan',
+            'asin': 'np.arcsin',
+            'acos': 'np.arccos',
+            'atan': 'np.arctan',
+            'sinh': 'np.sinh',
+            'cosh': 'np.cosh',
+            'tanh': 'np.tanh',
+            'sinc': '_sinc',
+            'abs': 'np.abs',
+            'erf': 'special.erf',
+            'erfc': 'special.erfc',
+            'floor': 'np.floor',
+            'ceil': 'np.ceil',
+            'round': 'np.rint',
+            'frac': '_frac'}
+
+_OPERATORS={'+': '+', '-': '-', '*': '*', '/': '/', '^': '**',
+            '<': '<', '>': '>', '<=': '<=', '>=': '>=', '==': '==', '!=': '!=', '<>': '!=',
+            '&&': '&', '||': '|'}
+
+_COMPARISONS=['<', '>', '<=', '>=', '==', '!=', '<>', '&&', '||']
+
+
+def _sinc(x):
+    '''MAD-X sinc, sin(x)/x.'''
+    return np.sinc(np.asarray(x)/np.pi)
+
+def _frac(x):
+    '''MAD-X frac, fractional part with the sign of x.'''
+    return x-np.trunc(x)
+
+
+class _NotCompilable(Exception):
+    '''The expression cannot be translated in numpy.'''
+
+
+def _to_source(node, symbols, values):
+    '''
+    Translate the AST of a MAD-X expression in python source.
+
+    Args:
+        node: the AST (see madxp.expression).
+        symbols: a dictionary {MAD-X name: python name} of the knobs and of the compiled expressions.
+        values: a dictionary {MAD-X name: value}, the other names are replaced by their values.
+    '''
+    kind=node[0]
+    if kind=='number':
+        return repr(node[1])
+    if kind=='name':
+        if node[1] in symbols:
+            return symbols[node[1]]
+        try:
+            return repr(float(values[node[1]]))
+        except (KeyError, TypeError, ValueError):
+            raise _NotCompilable(node[1])
+    if kind=='unary':
+        return f'({node[1]}{_to_source(node[2], symbols, values)})'
+    if kind=='binary':
+        left=_to_source(node[2], symbols, values)
+        right=_to_source(node[3], symbols, values)
+        if node[1] in ['&&', '||']:
+            return f'(1.0*(({left}!=0){_OPERATORS[node[1]]}({right}!=0)))'
+        if node[1] in _COMPARISONS:
+            return f'(1.0*({left}{_OPERATORS[node[1]]}{right}))'
+        return f'({left}{_OPERATORS[node[1]]}{right})'
+    if kind=='call' and node[1] in _FUNCTIONS:
+        return f'{_FUNCTIONS[node[1]]}({", ".join(_to_source(i, symbols, values) for i in node[2])})'
+    # random functions, table access and strings cannot be compiled
+    raise _NotCompilable(kind)
+
+
+class KnobModel():
+    '''
+    Vectorized evaluator of MAD-X expressions as functions of a list of knobs.
+
+    Args:
+        expressions: a dictionary {name: MAD-X expression}. The names can be dependent variables
+            or element attributes (e.g., 'q1->k1') and they are evaluated in the order of the dictionary
+            (a dependent variable has to be defined before the expressions using it).
+        values: a dictionary {name: value} with the current values of the variables. The parameters
+            that are neither knobs nor expressions are kept at these values.
+        knobs: the list of the knobs (the input of the model).
+
+    The expressions that cannot be compiled (random functions, 'table', undefined parameters, ...)
+    are kept constant at the values in 'values' and are listed in the attribute 'frozen'.
+    The generated python code is in the attribute 'source'.
+    '''
+    def __init__(self, expressions, values, knobs):
+        self.knobs=list(knobs)
+        self.outputs=list(expressions)
+        self.frozen=[]
+        self._values=dict(values)
+        symbols={}
+        lines=['def _model(_knobs, _values):']
+        for my_index, i in enumerate(self.knobs):
+            symbols[i]=f'k{my_index}'
+            lines.append(f'    k{my_index}=_knobs[{i!r}]')
+        for my_index, i in enumerate(self.outputs):
+            if i in self.knobs:
+                my_source=symbols[i]
+            else:
+                try:
+                    my_source=_to_source(expression.parse(expressions[i]), symbols, self._values)
+                except (_NotCompilable, ValueError):
+                    self.frozen.append(i)
+                    my_source=f'_values.get({i!r}, np.nan)'
+                symbols[i]=f'v{my_index}'
+            lines.append(f'    v{my_index}={my_source}')
+        lines.append('    return [' + ', '.join(f'v{i}' for i in range(len(self.outputs))) + ']')
+        self.source='\n'.join(lines)
+        my_namespace={'np': np, 'special': special, '_sinc': _sinc, '_frac': _frac}
+        exec(compile(self.source, '<madxp.evaluator>', 'exec'), my_namespace)
+        self._model=my_namespace['_model']
+
+    def evaluate(self, knob_values):
+        '''
+        Evaluate all the outputs for a batch of knob settings.
+
+        Args:
+            knob_values: a dictionary {knob: scalar or array}. The arrays are broadcast together.
+                The missing knobs are kept at their current values.
+
+        Returns:
+            A dictionary {output name: numpy array}.
+        '''
+        my_knobs={}
+        for i in self.knobs:
+            my_knobs[i]=np.asarray(knob_values[i], dtype=float) if i in knob_values else self._values.get(i, 0.)
+        shape=np.broadcast_shapes(*[np.shape(my_knobs[i]) for i in my_knobs])
+        with np.errstate(all='ignore'):
+            aux=self._model(my_knobs, self._values)
+        return {i: np.broadcast_to(j, shape) for i, j in zip(self.outputs, aux)}
+
+    def __call__(self, knob_values=None, **kwargs):
+        '''
+        Evaluate all the outputs for a batch of knob settings (see 'evaluate').
+
+        Returns:
+            A pandas DF with a row per knob setting and a column per output.
+        '''
+        if knob_values is None:
+            knob_values={}
+        knob_values=dict(knob_values, **kwargs)
+        aux=self.evaluate(knob_values)
+        return pd.DataFrame({i: np.atleast_1d(aux[i]) for i in aux})
+
+    def check(self, mad, knob_values, rtol=1e-9, atol=1e-12):
+        '''
+        Compare the model with MAD-X on a list of sample points.
+
+        For each sample the knobs are assigned in MAD-X, the outputs are evaluated by MAD-X and
+        compared with the model. The original knob values are restored at the end.
+
+        Args:
+            mad: the MAD-X handle.
+            knob_values: a list of dictionaries {knob: value}.
+            rtol, atol: the tolerances of the comparison.
+
+        Returns:
+            A pandas DF with the maximum absolute difference per sample and the flag 'passed'.
+        '''
+        original={i: mad.globals[i] for i in self.knobs}
+        my_list=[]
+        try:
+            for my_sample in knob_values:
+                my_sample=dict(original, **my_sample)
+                for i in my_sample:
+                    mad.input(f'{i}={my_sample[i]!r};')
+                model=self.evaluate(my_sample)
+                difference=0.
+                passed=True
+                for i in self.outputs:
+                    if i in self.frozen:
+                        continue
+                    madx_value=mad.eval(i)
+                    model_value=float(model[i])
+                    difference=max(difference, abs(model_value-madx_value))
+                    passed=passed and bool(np.isclose(model_value, madx_value, rtol=rtol, atol=atol))
+                my_list.append({'max abs difference': difference, 'passed': passed})
+        finally:
+            for i in original:
+                mad.input(f'{i}={original[i]!r};')
+        return pd.DataFrame(my_list)
+
+
+def knob_model(my_variable_dict, knobs, sequence_df=None, columns=None):
+    '''
+    Compile the dependent variables (and, optionally, the element attributes) in a KnobModel.
+
+    Args:
+        my_variable_dict: the output of cpymadTool.variables_dict.
+        knobs: the list of the knobs (the input of the model).
+        sequence_df: a DF obtained with cpymadTool.sequence_df (full mode).
+        columns: the element attributes of 'sequence_df' to compile (e.g., ['k1', 'angle']).
+            The outputs are named as the MAD-X element attributes (e.g., 'q1->k1').
+
+    Returns:
+        The KnobModel of the dependent variables and of the element attributes.
+
+    See madxp/examples/variablesExamples/000_run.py
+    '''
+    values={}
+    for i in ['constant_df', 'independent_variable_df', 'dependent_variable_df']:
+        if len(my_variable_dict[i])>0:
+            values.update(my_variable_dict[i]['value'].to_dict())
+    dep_df=my_variable_dict['dependent_variable_df']
+    expressions={}
+    if len(dep_df)>0:
+        # the parameters have to be evaluated before the variables using them
+        graph=VariableGraph(dict(zip(dep_df.index, dep_df['parameters'])), {})
+        aux=dep_df['expression'].to_dict()
+        for i in graph.dependent_variables:
+            expressions[i]=aux[i]
+    if sequence_df is not None:
+        for i in columns:
+            my_values=sequence_df[i+' value'] if i+' value' in sequence_df else pd.Series(np.nan, index=sequence_df.index)
+            for my_element, my_definition, my_value in zip(sequence_df.index, sequence_df[i], my_values):
+                if not isinstance(my_definition, str):
+                    continue
+                name=f'{my_element}->{i}'
+                values[name]=my_value
+                try:
+                    if len(expression.parameters(my_definition))>0:
+                        expressions[name]=my_definition
+                except ValueError:
+                    pass
+    return KnobModel(expressions, values, knobs)
@@ -0,0 +1,218 @@
+'''
+Tokenizer and parser of the MAD-X expressions.
+
+An expression is parsed once in an abstract syntax tree (AST) made of tuples:
+- ('number', value)
+- ('string', text), e.g. in the arguments of the 'table' function
+- ('name', variable name), the name can be an element attribute (e.g., 'mq.12l1.b1->l')
+- ('unary', operator, operand)
+- ('binary', operator, left operand, right operand)
+- ('call', function name, tuple of the arguments)
+
+The results are cached on the expression string: thousands of elements share identical
+expressions (e.g., 'kqf.a12*l.mq'), so each distinct expression is parsed only once.
+'''
+import re
+from functools import lru_cache
+
+# MAD-X functions (see the MAD-X manual, "Expressions")
+FUNCTIONS=['sqrt', 'log', 'log10', 'exp',
+           'sin', 'cos', 'tan', 'asin', 'acos', 'atan',
+           'sinh', 'cosh', 'tanh', 'sinc',
+           'abs', 'erf', 'erfc', 'floor', 'ceil', 'round', 'frac',
+           'ranf', 'gauss', 'tgauss', 'table']
+
+# The 'table' function refers to table, row and column names: its arguments are not variables
+_NOT_PARAMETER_FUNCTIONS=['table']
+
+_TOKEN_REGEX=re.compile(r'''
+    (?P<space>\s+)
+    |(?P<string>"[^"]*"|'[^']*')
+    |(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eEdD][+-]?\d+)?)
+    |(?P<name>[A-Za-z_][\w.$]*(?:->[A-Za-z_][\w.$]*)?)
+    |(?P<operator>\*\*|<=|>=|==|!=|<>|&&|\|\||[-+*/^<>(),])
+    ''', re.VERBOSE)
+
+# binary operators by increasing precedence ('^' is handled separately)
+_BINARY_OPERATORS=[['||'], ['&&'], ['<', '>', '<=', '>=', '==', '!=', '<>'], ['+', '-'], ['*', '/']]
+
+
+def tokenize(expression):
+    '''
+    Split a MAD-X expression in tokens.
+
+    Args:
+        expression: the string of the MAD-X expression.
+
+    Returns:
+        The list of tokens (kind, text) with kind in 'number', 'string', 'name' and 'operator'.
+        A ValueError is raised for an invalid character.
+    '''
+    tokens=[]
+    position=0
+    while position<len(expression):
+        match=_TOKEN_REGEX.match(expression, position)
+        if match is None:
+            raise ValueError(f'Invalid character {expression[position]!r} at position {position} of {expression!r}.')
+        if match.lastgroup!='space':
+            text=match.group()
+            if text=='**':
+                text='^'
+            tokens.append((match.lastgroup, text))
+        position=match.end()
+    return tokens
+
+
+class _Parser():
+    '''Recursive descent parser of a list of tokens.'''
+    def __init__(self, tokens, expression):
+        self.tokens=tokens
+        self.expression=expression
+        self.position=0
+
+    def _peek(self):
+        if self.position<len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def _next(self):
+        token=self._peek()
+        self.position+=1
+        return token
+
+    def _expect(self, text):
+        if self._next()[1]!=text:
+            raise ValueError(f'Expected {text!r} in {self.expression!r}.')
+
+    def parse(self):
+        node=self._binary(0)
+        if self.position!=len(self.tokens):
+            raise ValueError(f'Unexpected token {self._peek()[1]!r} in {self.expression!r}.')
+        return node
+
+    def _binary(self, level):
+        if level==len(_BINARY_OPERATORS):
+            return self._unary()
+        node=self._binary(level+1)
+        while self._peek()[0]=='operator' and self._peek()[1] in _BINARY_OPERATORS[level]:
+            operator=self._next()[1]
+            node=('binary', operator, node, self._binary(level+1))
+        return node
+
+    def _unary(self):
+        if self._peek()[1] in ['+', '-']:
+            operator=self._next()[1]
+            return ('unary', operator, self._unary())
+        return self._power()
+
+    def _power(self):
+        # as in MAD-X, '^' is left associative (2^3^2 is 64) and binds tighter than the sign (-2^2 is -4)
+        node=self._atom()
+        while self._peek()[1]=='^':
+            self._next()
+            node=('binary', '^', node, self._signed_atom())
+        return node
+
+    def _signed_atom(self):
+        if self._peek()[1] in ['+', '-']:
+            operator=self._next()[1]
+            return ('unary', operator, self._signed_atom())
+        return self._atom()
+
+    def _atom(self):
+        kind, text=self._next()
+        if kind=='number':
+            return ('number', float(text.replace('d', 'e').replace('D', 'e')))
+        if kind=='string':
+            return ('string', text[1:-1])
+        if kind=='name':
+            if self._peek()[1]=='(':
+                self._next()
+                args=[]
+                if self._peek()[1]!=')':
+                    args.append(self._binary(0))
+                    while self._peek()[1]==',':
+                        self._next()
+                        args.append(self._binary(0))
+                self._expect(')')
+                return ('call', text.lower(), tuple(args))
+            return ('name', text.lower())
+        if text=='(':
+            node=self._binary(0)
+            self._expect(')')
+            return node
+        raise ValueError(f'Unexpected token {text!r} in {self.expression!r}.')
+
+
+@lru_cache(maxsize=2**16)
+def parse(expression):
+    '''
+    Parse a MAD-X expression (cached on the expression string).
+
+    Args:
+        expression: the string of the MAD-X expression.
+
+    Returns:
+        The AST of the expression (see the module documentation).
+        A ValueError is raised if the expression cannot be parsed.
+    '''
+    return _Parser(tokenize(expression), expression).parse()
+
+
+def _ast_parameters(node, my_set):
+    kind=node[0]
+    if kind=='name':
+        my_set.add(node[1])
+    elif kind=='unary':
+        _ast_parameters(node[2], my_set)
+    elif kind=='binary':
+        _ast_parameters(node[2], my_set)
+        _ast_parameters(node[3], my_set)
+    elif kind=='call' and node[1] not in _NOT_PARAMETER_FUNCTIONS:
+        for i in node[2]:
+            _ast_parameters(i, my_set)
+
+
+@lru_cache(maxsize=2**16)
+def _parameters(expression):
+    my_set=set()
+    _ast_parameters(parse(expression), my_set)
+    return tuple(sorted(my_set))
+
+
+def parameters(expression):
+    '''
+    Extract the parameters of a MAD-X expression (cached on the expression string).
+
+    Args:
+        expression: the string of the MAD-X expression. It can be also None
+            (non-deferred attribute) or a list of expressions (array attribute, e.g., 'knl').
+
+    Returns:
+        The sorted tuple of the parameters present in the MAD-X expression.
+    '''
+    if expression is None:
+        return ()
+    if isinstance(expression, (list, tuple)):
+        my_set=set()
+        for i in expression:
+            my_set.update(parameters(i))
+        return tuple(sorted(my_set))
+    if not isinstance(expression, str):
+        return ()
+    return _parameters(expression)
+
+
+def cache_info():
+    '''
+    The statistics of the parser cache (see functools.lru_cache).
+    '''
+    return parse.cache_info()
+
+
+def cache_clear():
+    '''
+    Clear the parser caches.
+    '''
+    parse.cache_clear()
+    _parameters.cache_clear()
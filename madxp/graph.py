@@ -0,0 +1,219 @@
+'''
+Dependency graph of the MAD-X global variables.
+
+The graph is built once from the deferred expressions of the workspace and resolved in
+topological order: the knobs (the independent, non-constant variables controlling a variable)
+are computed once per variable and memoized.
+The same object can be shared by cpymadTool.variables_dict, cpymadTool.sequence_df and
+cpymadTool.knobs_df.
+
+See madxp/examples/variablesExamples/000_run.py
+'''
+import numpy as np
+import pandas as pd
+
+
+class CyclicDependencyError(ValueError):
+    '''
+    Raised by VariableGraph for a cycle in the expressions ('cycle' is the list of its variables).
+    '''
+    def __init__(self, cycle):
+        self.cycle=cycle
+        super().__init__(f'Cyclic dependency: {" -> ".join(cycle)}')
+
+
+class VariableGraph():
+    '''
+    Dependency graph of the MAD-X global variables.
+
+    Args:
+        parameters: a dictionary {dependent variable: list of the parameters of its expression}.
+        var_types: a dictionary {variable name: MAD-X variable type} for all the global variables
+            (0 constant, 1 direct, 2 deferred, 3 string).
+        opaque: the dependent variables whose parameters are unknown (e.g., their expression cannot
+            be parsed): they have no parameters and no knobs.
+
+    A dependent variable is a variable whose expression has at least one parameter.
+    A cycle in the expressions raises a CyclicDependencyError (a ValueError).
+    '''
+    def __init__(self, parameters, var_types, opaque=()):
+        self._parents={i: sorted(set(parameters[i])) for i in parameters}
+        self._parents.update({i: [] for i in opaque})
+        self.opaque=sorted(opaque)
+        self._var_types=dict(var_types)
+        self._children=None
+        self._dependents={}
+        self._order=self._topological_order()
+        self._knobs={}
+        for i in self._order:
+            aux=set()
+            for j in self._parents[i]:
+                if j in self._parents:
+                    aux.update(self._knobs[j])
+                elif self._var_types.get(j)!=0:
+                    aux.add(j)
+            self._knobs[i]=frozenset(aux)
+
+    def _topological_order(self):
+        '''
+        Order the dependent variables so that each one follows all its dependent parameters.
+        '''
+        order=[]
+        state={}
+        for root in sorted(self._parents):
+            if root in state:
+                continue
+            # iterative depth first search: 1 visiting, 2 done
+            stack=[(root, iter(self._parents[root]))]
+            state[root]=1
+            while stack:
+                node, parents=stack[-1]
+                for j in parents:
+                    if j not in self._parents:
+                        continue
+                    if state.get(j)==1:
+                        cycle=[i[0] for i in stack]
+                        raise CyclicDependencyError(cycle[cycle.index(j):]+[j])
+                    if j not in state:
+                        state[j]=1
+                        stack.append((j, iter(self._parents[j])))
+                        break
+                else:
+                    state[node]=2
+                    order.append(node)
+                    stack.pop()
+        return order
+
+    def __contains__(self, name):
+        return name in self._var_types
+
+    def __len__(self):
+        return len(self._var_types)
+
+    @property
+    def variables(self):
+        '''The list of all the global variables.'''
+        return sorted(self._var_types)
+
+    @property
+    def dependent_variables(self):
+        '''The dependent variables in topological order (parameters before the variables using them).'''
+        return list(self._order)
+
+    def is_dependent(self, name):
+        '''True if the variable has an expression with at least one parameter.'''
+        return name in self._parents
+
+    def is_constant(self, name):
+        '''True if the variable is a MAD-X constant.'''
+        return self._var_types.get(name)==0
+
+    def parents(self, name):
+        '''The parameters of the expression of the variable (empty for independent variables).'''
+        return list(self._parents.get(name, []))
+
+    def children(self, name):
+        '''The dependent variables having the variable as parameter.'''
+        if self._children is None:
+            self._children={}
+            for i in sorted(self._parents):
+                for j in self._parents[i]:
+                    self._children.setdefault(j, []).append(i)
+        return list(self._children.get(name, []))
+
+    def knobs(self, name):
+        '''
+        The knobs of a variable: the independent, non-constant variables controlling its value.
+        An independent variable is the knob of itself, a constant has no knobs.
+        '''
+        if name in self._knobs:
+            return sorted(self._knobs[name])
+        elif self._var_types.get(name)==0:
+            return []
+        else:
+            return [name]
+
+    def dependents(self, knob):
+        '''All the dependent variables controlled, directly or not, by a variable.'''
+        if knob not in self._dependents:
+            my_set=set()
+            to_visit=[knob]
+            while to_visit:
+                for i in self.children(to_visit.pop()):
+                    if i not in my_set:
+                        my_set.add(i)
+                        to_visit.append(i)
+            self._dependents[knob]=sorted(my_set)
+        return list(self._dependents[knob])
+
+    def knobs_from_parameters(self, parameters):
+        '''
+        Extract the list of knobs from a list of parameters.
+
+        Args:
+            parameters: list of parameters
+
+        Returns:
+            The sorted list of knobs corresponding to the list of parameters.
+        '''
+        my_knobs=set()
+        for i in parameters:
+            if i not in self._var_types:
+                print(f'Variable {i} not defined! Cosidered as a knob.')
+            my_knobs.update(self.knobs(i))
+        return sorted(my_knobs)
+
+    def knobs_df(self):
+        '''
+        The pandas DF of the knobs of the dependent variables (same format of cpymadTool.knobs_df).
+        '''
+        my_dict={}
+        for i in self._order:
+            for j in self._knobs[i]:
+                my_dict.setdefault(j, []).append(i)
+        my_dict={i: {'multeplicity': len(my_dict[i]), 'dependences': sorted(my_dict[i])} for i in sorted(my_dict)}
+        return pd.DataFrame(my_dict).transpose().sort_values('multeplicity', ascending=False)
+
+
+class KnobIndex():
+    '''
+    Inverted index from the knobs to the rows of a pandas DF with a 'knobs' column
+    (e.g., the output of cpymadTool.sequence_df or the dependent variable DF).
+
+    The index is built in a single pass over the 'knobs' column; then the rows depending on
+    a knob are found without scanning the DF.
+
+    Args:
+        my_df: a pandas DF (it assumes that DF has a column called "knobs").
+    '''
+    def __init__(self, my_df):
+        self._index=my_df.index
+        self._len=len(my_df)
+        my_dict={}
+        for my_position, my_knobs in enumerate(my_df['knobs']):
+            for i in set(my_knobs):
+                my_dict.setdefault(i, []).append(my_position)
+        self._positions={i: np.array(my_dict[i], dtype=int) for i in my_dict}
+
+    def __contains__(self, knob):
+        return knob in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    @property
+    def knobs(self):
+        '''The sorted list of the knobs.'''
+        return sorted(self._positions)
+
+    def positions(self, knob):
+        '''The positions of the rows depending on the knob (empty if the knob is not present).'''
+        return self._positions.get(knob, np.array([], dtype=int))
+
+    def labels(self, knob):
+        '''The labels of the rows depending on the knob.'''
+        return list(self._index[self.positions(knob)])
+
+    def is_valid(self, my_df):
+        '''True if the index can be used for 'my_df' (same row labels).'''
+        return (my_df.index is self._index) and (len(my_df)==self._len)
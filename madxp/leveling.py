@@ -0,0 +1,183 @@
+'''
+Luminosity leveling over a fill timeline.
+
+For each step of a fill (beam parameters given as numpy arrays, see luminosity.L) the value of a leveling
+variable (separation, beta* or crossing angle, see LEVELING_VARIABLES) giving a target luminosity and/or
+pile-up is found. All the steps are solved together with batched luminosity evaluations (luminosity.L_batch):
+a coarse solution on a subsample of the steps warm-starts the brackets of all the steps, that are then
+refined with a vectorized Illinois (regula falsi) iteration on log(L).
+The timeline is given: the burn-off of the intensities is not computed from the leveled luminosity.
+
+See madxp/examples/luminosity/000_run.py
+'''
+import numpy as np
+import pandas as pd
+from scipy import integrate
+from madxp import luminosity
+
+# the luminosity arguments of each leveling variable and their factors (e.g., full separation and full crossing angle)
+LEVELING_VARIABLES={'separation_x': {'x_1': 0.5, 'x_2': -0.5},
+                    'separation_y': {'y_1': 0.5, 'y_2': -0.5},
+                    'beta': {'beta_x1': 1, 'beta_x2': 1, 'beta_y1': 1, 'beta_y2': 1},
+                    'crossing_x': {'px_1': 0.5, 'px_2': -0.5},
+                    'crossing_y': {'py_1': 0.5, 'py_2': -0.5}}
+
+
+def pileup(my_luminosity, nb, f, sigma_inel=81e-27):
+    '''
+    Average number of inelastic collisions per bunch crossing.
+
+    Args:
+        my_luminosity: the luminosity [Hz/cm^2].
+        nb: the number of colliding bunches.
+        f: the revolution frequency [Hz].
+        sigma_inel: the inelastic cross section [cm^2].
+    '''
+    return my_luminosity*sigma_inel/nb/f
+
+
+def _evaluate(parameters, variable, value, options):
+    '''Luminosity (batched) with the leveling variable set to value.'''
+    aux=dict(parameters)
+    for i, factor in variable.items():
+        aux[i]=factor*value
+    return luminosity.L_batch(**aux, **options)
+
+
+def _illinois(function, a, b, fa, fb, rtol, max_iterations):
+    '''
+    Vectorized Illinois iteration for the roots of function in the brackets [a, b] (fa*fb<=0).
+    function(x, mask) evaluates the cases of the boolean mask.
+    It returns the roots and the residuals of the function (|residual|>rtol if max_iterations is reached).
+    '''
+    x=np.where(np.abs(fa)<np.abs(fb), a, b)
+    fx=np.where(np.abs(fa)<np.abs(fb), fa, fb)
+    active=np.abs(fx)>rtol
+    for _ in range(max_iterations):
+        if not np.any(active):
+            break
+        with np.errstate(all='ignore'):
+            c=b-fb*(b-a)/(fb-fa)
+        c=np.where(np.isfinite(c), c, (a+b)/2)[active]
+        fc=function(c, active)
+        x[active]=c
+        fx[active]=fc
+        opposite=fc*fb[active]<0
+        # a new bracket [b, c] or, on the same side, halving the function at the old end (Illinois)
+        aux_a=a[active]
+        aux_fa=fa[active]
+        aux_a[opposite]=b[active][opposite]
+        aux_fa[opposite]=fb[active][opposite]
+        aux_fa[~opposite]=aux_fa[~opposite]/2
+        a[active]=aux_a
+        fa[active]=aux_fa
+        b[active]=c
+        fb[active]=fc
+        active[active]=np.abs(fc)>rtol
+    return x, fx
+
+
+def level(parameters, variable, bounds, target_luminosity=None, target_pileup=None, time=None,
+          sigma_inel=81e-27, rtol=1e-4, max_iterations=50, stride=10, options=None):
+    '''
+    Solve the leveling variable over a fill timeline.
+
+    Args:
+        parameters: a dictionary with the arguments of luminosity.L. The arguments changing along the fill
+            are numpy arrays with a value per step (broadcast together).
+        variable: the name of the leveling variable (see LEVELING_VARIABLES) or a dictionary
+            {argument of luminosity.L: factor}.
+        bounds: the range [min, max] of the leveling variable.
+        target_luminosity: the target luminosity [Hz/cm^2] (scalar or per step).
+        target_pileup: the target pile-up (scalar or per step), see 'pileup'.
+            If both targets are given the lower luminosity is used.
+        time: the time of the steps [s], to compute the integrated luminosity.
+        sigma_inel: the inelastic cross section [cm^2].
+        rtol: the relative tolerance on the leveled luminosity.
+        max_iterations: the maximum number of iterations of the root finder.
+        stride: the steps of the coarse solution warm-starting the brackets (one every 'stride').
+        options: the options of luminosity.L_batch.
+
+    Returns:
+        A pandas DF with a row per step with the leveling variable, the luminosity [Hz/cm^2], the pile-up
+        and the flag 'leveled' (False if the target is not reachable in the bounds, in this case the
+        variable is at the bound closest to the target, or if the root finder did not converge within
+        max_iterations), and the integrated luminosity [cm^-2]
+        (None if time is None).
+    '''
+    assert (target_luminosity is not None) or (target_pileup is not None), 'A target is needed.'
+    if isinstance(variable, str):
+        name=variable
+        variable=LEVELING_VARIABLES[variable]
+    else:
+        name='leveling variable'
+    if options is None:
+        options={}
+    names=list(parameters)
+    aux=np.broadcast_arrays(*[np.asarray(parameters[i], dtype=float) for i in names],
+                            *[np.asarray(i, dtype=float) for i in [target_luminosity, target_pileup] if i is not None])
+    steps=np.atleast_1d(aux[0]).shape
+    assert len(steps)==1, 'The parameters have to be scalars or 1D arrays (a value per step).'
+    p={i: np.atleast_1d(j).copy() for i, j in zip(names, aux)}
+    target=np.full(steps, np.inf)
+    if target_luminosity is not None:
+        target=np.minimum(target, np.broadcast_to(target_luminosity, steps))
+    if target_pileup is not None:
+        target=np.minimum(target, np.broadcast_to(target_pileup, steps)*p['nb']*p['f']/sigma_inel)
+
+    def function(x, mask):
+        '''log of the ratio between the luminosity and the target.'''
+        return np.log(_evaluate({i: j[mask] for i, j in p.items()}, variable, x, options)/target[mask])
+
+    everywhere=np.ones(steps, dtype=bool)
+    low=np.full(steps, float(bounds[0]))
+    high=np.full(steps, float(bounds[1]))
+    f_low=function(low, everywhere)
+    f_high=function(high, everywhere)
+    reachable=f_low*f_high<=0
+    # unreachable target: the bound closest to the target
+    value=np.where(np.abs(f_low)<np.abs(f_high), low, high)
+    residual=np.where(np.abs(f_low)<np.abs(f_high), f_low, f_high)
+
+    # coarse solution on a subsample of the reachable steps
+    coarse=np.zeros(steps, dtype=bool)
+    coarse[np.flatnonzero(reachable)[::stride]]=True
+    coarse[np.flatnonzero(reachable)[-1:]]=True
+    index=np.flatnonzero(coarse)
+    if len(index)>0:
+        value[coarse], residual[coarse]=_illinois(lambda x, mask: function(x, np.flatnonzero(coarse)[mask]),
+                                   low[coarse], high[coarse], f_low[coarse], f_high[coarse], rtol, max_iterations)
+    fine=reachable & ~coarse
+    if np.any(fine):
+        # warm start: interpolation of the coarse solution and a bracket of the width of its steps
+        guess=np.interp(np.arange(steps[0]), index, value[index])
+        width=np.abs(np.diff(value[index])).max() if len(index)>1 else np.abs(bounds[1]-bounds[0])
+        width=max(width, 1e-6*np.abs(bounds[1]-bounds[0]))
+        a=np.clip(guess-width, *sorted(bounds))[fine]
+        b=np.clip(guess+width, *sorted(bounds))[fine]
+        fa=function(a, fine)
+        fb=function(b, fine)
+        # brackets without a sign change are widened to the bounds
+        wrong=fa*fb>0
+        if np.any(wrong):
+            # the root is in [b, high] if low, a and b are on the same side, otherwise in [low, a]
+            side=np.sign(fa)==np.sign(f_low[fine])
+            aux_a=np.where(side, b, low[fine])
+            aux_fa=np.where(side, fb, f_low[fine])
+            aux_b=np.where(side, high[fine], a)
+            aux_fb=np.where(side, f_high[fine], fa)
+            a[wrong], fa[wrong]=aux_a[wrong], aux_fa[wrong]
+            b[wrong], fb[wrong]=aux_b[wrong], aux_fb[wrong]
+        value[fine], residual[fine]=_illinois(lambda x, mask: function(x, np.flatnonzero(fine)[mask]),
+                                 a, b, fa, fb, rtol, max_iterations)
+
+    my_luminosity=_evaluate(p, variable, value, options)
+    my_df=pd.DataFrame({name: value,
+                        'luminosity [Hz/cm^2]': my_luminosity,
+                        'pileup': pileup(my_luminosity, p['nb'], p['f'], sigma_inel),
+                        'leveled': reachable & (np.abs(residual)<=rtol)})
+    integrated=None
+    if time is not None:
+        my_df.insert(0, 'time [s]', np.broadcast_to(time, steps))
+        integrated=integrate.trapezoid(my_luminosity, my_df['time [s]'].values)
+    return my_df, integrated
@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 from madxp import particle
 from scipy import integrate
 
@@ -39,7 +40,8 @@ def L(f, nb,
       CC_V_y_2=0, CC_f_y_2=0, CC_phase_y_2=0,
       R12_1=0, R22_1=0, R34_1=0, R44_1=0,
       R12_2=0, R22_2=0, R34_2=0, R44_2=0,
-      verbose=False, sigma_integration=3):
+      verbose=False, sigma_integration=3, rtol=1e-6, full_output=False, closed_form=True,
+      cc_integration='hermite', order=16, max_order=256):
     '''
     Returns luminosity in Hz/cm^2.
 
@@ -65,7 +67,22 @@ def L(f, nb,
         that the beam sees before reaching the IP and IP itself [SI units] 
     verbose: to have verbose output
     sigma_integration: the number of sigma consider for the integration 
-        (taken into account only if CC(s) is/are present)
+        (taken into account only if CC(s) is/are present and cc_integration is 'dblquad')
+    cc_integration: 'hermite' to integrate the CC(s) case on a tensor-product Gauss-Hermite grid 
+        (see _double_integral), starting from 'order' and doubling it (up to 'max_order') until 
+        the relative difference between two consecutive orders is below rtol, or 'dblquad' to use scipy.
+        NB: the default is 'hermite' (milliseconds), the former default is 'dblquad' (seconds) and its results
+        differ at the 1e-4 level: the Gauss-Hermite grid covers the full (z, t) plane and it matches dblquad within rtol 
+        for sigma_integration of about 6 (the default dblquad range, 3 sigma, truncates the integral).
+        If max_order is reached before rtol a warning is printed (and 'converged' is False in the full output).
+    rtol: without CCs, the luminosity is computed in closed form (see _gaussian_approximation) 
+        if its estimated relative error is below rtol, otherwise with the numerical integration (quad).
+        NB: by default the result without CCs is therefore accurate to about rtol (1e-6) and not to the 
+        quad precision (about 1e-10).
+    closed_form: if False, the closed form is not used and the luminosity without CCs is always computed with quad.
+    full_output: if True it returns also a dictionary with the 'path' of the computation
+        ('closed form', 'quad', 'hermite' or 'dblquad'), the estimated relative 'error' and, for 'hermite',
+        'converged' (the flag of the convergence of the quadrature).
 
     In MAD-X px is p_x/p_0 (p_x is the x-component of the momentum and p_0 is the design momentum).
     In our approximation we use the paraxial approximation: p_0~p_z so px is an angle. 
@@ -177,37 +194,474 @@ def L(f, nb,
                                -( br_2*c*t+z)**2/(sigma_z2**2))) \
         /np.sqrt((sx1(z)**2 + sx2(z)**2)*(sy1(z)**2 + sy2(z)**2))/sigma_z1/sigma_z2
 
-        integral=integrate.dblquad((lambda t, z: kernel_double_integral(t, z)),
-                                   -sigma_integration*sigma_z, sigma_integration*sigma_z,-sigma_integration*sigma_z/c, sigma_integration*sigma_z/c)
-        L0=f*N1*N2*nb*c/2/np.pi**(2)*integral[0]
+        if cc_integration=='dblquad':
+            integral=integrate.dblquad((lambda t, z: kernel_double_integral(t, z)),
+                                       -sigma_integration*sigma_z, sigma_integration*sigma_z,-sigma_integration*sigma_z/c, sigma_integration*sigma_z/c)
+            path='dblquad'
+            error=integral[1]/integral[0]
+            integral=integral[0]
+        else:
+            assert cc_integration=='hermite'
+            my_locals=locals()
+            integral, error, order, converged=_hermite(_double_integral, 
+                                                       ({i: my_locals[i] for i in _L_ARGUMENTS+_CC_ARGUMENTS}, br_1, br_2, betagamma_1, betagamma_2),
+                                                       order, max_order, rtol)
+            path='hermite'
+        L0=f*N1*N2*nb*c/2/np.pi**(2)*integral
     else:
-        def mx1(z):
-            '''The mu_x of B1 as straight line'''
-            return x_1 + px_1*z
+        my_locals=locals()
+        if closed_form:
+            integral, error=_gaussian_approximation({i: my_locals[i] for i in _L_ARGUMENTS}, br_1, br_2, betagamma_1, betagamma_2)
+            path='closed form'
+        if not (closed_form and error<=rtol):
+            def mx1(z):
+                '''The mu_x of B1 as straight line'''
+                return x_1 + px_1*z
+
+            def my1(z):
+                '''The mu_y of B1 as straight line'''
+                return y_1 + py_1*z
+
+            def mx2(z):
+                '''The mu_x of B2 as straight line'''
+                return x_2 + px_2*z
+
+            def my2(z):
+                '''The mu_y of B2 as straight line'''
+                return y_2 + py_2*z
+
+            def kernel_single_integral(z):
+                return np.exp(0.5*(-(mx1(z) - mx2(z))**2/(sx1(z)**2 + sx2(z)**2) \
+                                   -(my1(z) - my2(z))**2/(sy1(z)**2 + sy2(z)**2) \
+                                   -((br_1+br_2)**2*z**2)/(br_2**2*sigma_z1**2 + br_1**2*sigma_z2**2))) \
+                /np.sqrt((sx1(z)**2 + sx2(z)**2)*(sy1(z)**2 + sy2(z)**2)*(sigma_z1**2 + sigma_z2**2))
+
+            integral=integrate.quad(lambda z: kernel_single_integral(z), -20*sigma_z, 20*sigma_z)
+            path='quad'
+            error=integral[1]/integral[0]
+            integral=integral[0]
+        L0=f*N1*N2*nb/np.sqrt(2)/np.pi**(3/2)*integral
+    result= L0*Moeller_efficiency/1e4
+    if verbose:
+        print(f'Moeller efficiency: {Moeller_efficiency}')
+        print(f'Integration path: {path}')
+        print(f'Integral Relative Error: {error}')
+        print(f'==> Luminosity [Hz/cm^2]: {result}')
+    if full_output:
+        if path=='hermite':
+            return result, {'path': path, 'error': error, 'converged': converged}
+        return result, {'path': path, 'error': error}
+    return result
 
-        def my1(z):
-            '''The mu_y of B1 as straight line'''
-            return y_1 + py_1*z
+_L_ARGUMENTS=['f', 'nb',
+              'N1', 'N2',
+              'x_1', 'x_2',
+              'y_1', 'y_2',
+              'px_1', 'px_2',
+              'py_1', 'py_2',
+              'energy_tot1', 'energy_tot2',
+              'deltap_p0_1', 'deltap_p0_2',
+              'epsilon_x1', 'epsilon_x2',
+              'epsilon_y1', 'epsilon_y2',
+              'sigma_z1', 'sigma_z2',
+              'beta_x1', 'beta_x2',
+              'beta_y1', 'beta_y2',
+              'alpha_x1', 'alpha_x2',
+              'alpha_y1', 'alpha_y2',
+              'dx_1', 'dx_2',
+              'dy_1', 'dy_2',
+              'dpx_1', 'dpx_2',
+              'dpy_1', 'dpy_2']
+
+_CC_ARGUMENTS=['CC_V_x_1', 'CC_f_x_1', 'CC_phase_x_1',
+               'CC_V_x_2', 'CC_f_x_2', 'CC_phase_x_2',
+               'CC_V_y_1', 'CC_f_y_1', 'CC_phase_y_1',
+               'CC_V_y_2', 'CC_f_y_2', 'CC_phase_y_2',
+               'R12_1', 'R22_1', 'R34_1', 'R44_1',
+               'R12_2', 'R22_2', 'R34_2', 'R44_2']
+
+def _relativistic(energy_tot):
+    '''Relativistic beta and beta*gamma of a proton of total energy energy_tot [GeV] (vectorized).'''
+    gamma=energy_tot/particle.restEnergyProton_GeV
+    br=np.sqrt(1.-gamma**-2)
+    return br, gamma*br
+
+def _moeller_efficiency(br_1, br_2, px_1, px_2, py_1, py_2):
+    '''Moeller efficiency of the crossing (vectorized, see L).'''
+    c=particle.speedOfLight_m_s
+    v_1=br_1*c*np.array([px_1, py_1, np.sqrt(1-px_1**2-py_1**2)])
+    v_2=-br_2*c*np.array([px_2, py_2, np.sqrt(1-px_2**2-py_2**2)])
+    diff_v=v_1-v_2
+    cross_v=np.cross(v_1, v_2, axis=0)
+    return np.sqrt(c**2*np.sum(diff_v**2, axis=0)-np.sum(cross_v**2, axis=0))/c**2/2
 
-        def mx2(z):
-            '''The mu_x of B2 as straight line'''
-            return x_2 + px_2*z
+def _sigma2(z, beta0, alpha0, epsilon0, betagamma, br, d0, dp0, deltap_p0):
+    '''Square of the beam size, quadratic sum of betatronic and dispersive sigma (vectorized).'''
+    return sigma(beta(z, beta0, alpha0), epsilon0, betagamma)**2+(dispersion(z, br*d0, br*dp0)*deltap_p0)**2
 
-        def my2(z):
-            '''The mu_y of B2 as straight line'''
-            return y_2 + py_2*z
+def _size_coefficients(beta0, alpha0, epsilon0, betagamma, br, d0, dp0, deltap_p0):
+    '''
+    Coefficients (s0, s1, s2) of the square of the beam size in drift space, s0+s1*z+s2*z**2 (see _sigma2).
+    '''
+    s0=beta0*epsilon0/betagamma+(br*d0*deltap_p0)**2
+    s1=-2*alpha0*epsilon0/betagamma+2*br**2*d0*dp0*deltap_p0**2
+    s2=(1+alpha0**2)/beta0*epsilon0/betagamma+(br*dp0*deltap_p0)**2
+    return s0, s1, s2
 
-        def kernel_single_integral(z):
-            return np.exp(0.5*(-(mx1(z) - mx2(z))**2/(sx1(z)**2 + sx2(z)**2) \
-                               -(my1(z) - my2(z))**2/(sy1(z)**2 + sy2(z)**2) \
-                               -((br_1+br_2)**2*z**2)/(br_2**2*sigma_z1**2 + br_1**2*sigma_z2**2))) \
-            /np.sqrt((sx1(z)**2 + sx2(z)**2)*(sy1(z)**2 + sy2(z)**2)*(sigma_z1**2 + sigma_z2**2))
+def _gaussian_approximation(p, br_1, br_2, betagamma_1, betagamma_2):
+    '''
+    Closed form of the integral over z of the kernel of L without crab cavities.
 
-        integral=integrate.quad(lambda z: kernel_single_integral(z), -20*sigma_z, 20*sigma_z)
-        L0=f*N1*N2*nb/np.sqrt(2)/np.pi**(3/2)*integral[0]
-    result= L0*Moeller_efficiency/1e4
-    if verbose:
-        print(f'Moeller efficiency: {Moeller_efficiency}')
-        print(f'Integral Relative Error: {integral[1]/integral[0]}')
-        print(f'==> Luminosity [Hz/cm^2]: {result}')
+    The logarithm of the dependence of the kernel on the beam sizes (hourglass and dispersion) is 
+    expanded to the second order in z, so that the kernel is a Gaussian and it is integrated analytically
+    (exact if the beam sizes do not depend on z, i.e., the crossing angle and offset reduction factor).
+    The relative error is estimated with a three-point Gauss-Hermite quadrature of the neglected terms.
+    The arguments are the ones of _single_integral.
+
+    Returns:
+        The integral and its estimated relative error (inf if the expansion is not a Gaussian).
+    '''
+    s2=(br_2**2*p['sigma_z1']**2+br_1**2*p['sigma_z2']**2)/(br_1+br_2)**2
+    planes=[]
+    for plane in ['x', 'y']:
+        aux_1=_size_coefficients(p[f'beta_{plane}1'], p[f'alpha_{plane}1'], p[f'epsilon_{plane}1'], betagamma_1, br_1,
+                                 p[f'd{plane}_1'], p[f'dp{plane}_1'], p['deltap_p0_1'])
+        aux_2=_size_coefficients(p[f'beta_{plane}2'], p[f'alpha_{plane}2'], p[f'epsilon_{plane}2'], betagamma_2, br_2,
+                                 p[f'd{plane}_2'], p[f'dp{plane}_2'], p['deltap_p0_2'])
+        size=[i+j for i, j in zip(aux_1, aux_2)]
+        # angle and offset of the separation
+        a=p[f'p{plane}_1']-p[f'p{plane}_2']
+        b=p[f'{plane}_1']-p[f'{plane}_2']
+        planes.append((size, a, b))
+
+    def log_h(z):
+        '''Logarithm of the kernel divided by its value with the beam sizes at z=0.'''
+        aux=0
+        for (s0, s1, s2_), a, b in planes:
+            sz=s0+s1*z+s2_*z**2
+            aux=aux-0.5*((b+a*z)**2*(1/sz-1/s0)+np.log(sz/s0))
+        return aux
+
+    # Gaussian with the beam sizes at z=0, exp(-0.5*(A*z**2+2*B*z+C)), and second order expansion of log_h
+    A=1/s2
+    B=0
+    C=0
+    g1=0
+    g2=0
+    for (s0, s1, s2_), a, b in planes:
+        A=A+a**2/s0
+        B=B+a*b/s0
+        C=C+b**2/s0
+        q1=s1/s0
+        q2=s2_/s0
+        g1=g1-0.5*(q1-q1*b**2/s0)
+        g2=g2-0.5*((b**2*(q1**2-q2)-2*a*b*q1)/s0+q2-q1**2/2)
+    A=A-2*g2
+    B=B-g1
+    # A<=0 (the expansion is not a Gaussian): infinite error, the numerical integration is used
+    with np.errstate(invalid='ignore', divide='ignore'):
+        integral=np.sqrt(2*np.pi/A)*np.exp(-0.5*(C-B**2/A))/np.sqrt(planes[0][0][0]*planes[1][0][0]*(p['sigma_z1']**2+p['sigma_z2']**2))
+        z_c=-B/A
+        width=1/np.sqrt(A)
+        error=0
+        for node, weight in zip([-np.sqrt(3), 0, np.sqrt(3)], [1/6, 2/3, 1/6]):
+            z=z_c+node*width
+            error=error+weight*np.expm1(log_h(z)-g1*z-g2*z**2)
+    return integral, np.where(A>0, np.abs(error), np.inf)[()]
+
+def _single_integral(p, br_1, br_2, betagamma_1, betagamma_2, order):
+    '''
+    Gauss-Hermite quadrature of the kernel of L without crab cavities.
+
+    The nodes of order 'order' are shared by all the cases: for each case they are scaled and centered on the
+    Gaussian approximation of the kernel (bunch length, crossing angle and offsets at the IP).
+    The arguments are broadcast numpy arrays and the output has their shape.
+    '''
+    u, w=np.polynomial.hermite.hermgauss(order)
+    u=u.reshape((-1,)+(1,)*np.ndim(br_1))
+    w=(w*np.exp(u.ravel()**2)).reshape(u.shape)
+    s2=(br_2**2*p['sigma_z1']**2+br_1**2*p['sigma_z2']**2)/(br_1+br_2)**2
+    sx0=(_sigma2(0, p['beta_x1'], p['alpha_x1'], p['epsilon_x1'], betagamma_1, br_1, p['dx_1'], p['dpx_1'], p['deltap_p0_1'])
+         +_sigma2(0, p['beta_x2'], p['alpha_x2'], p['epsilon_x2'], betagamma_2, br_2, p['dx_2'], p['dpx_2'], p['deltap_p0_2']))
+    sy0=(_sigma2(0, p['beta_y1'], p['alpha_y1'], p['epsilon_y1'], betagamma_1, br_1, p['dy_1'], p['dpy_1'], p['deltap_p0_1'])
+         +_sigma2(0, p['beta_y2'], p['alpha_y2'], p['epsilon_y2'], betagamma_2, br_2, p['dy_2'], p['dpy_2'], p['deltap_p0_2']))
+    ax=p['px_1']-p['px_2']
+    ay=p['py_1']-p['py_2']
+    bx=p['x_1']-p['x_2']
+    by=p['y_1']-p['y_2']
+    a=1/s2+ax**2/sx0+ay**2/sy0
+    z_c=-(ax*bx/sx0+ay*by/sy0)/a
+    width=np.sqrt(2/a)
+    z=z_c+width*u
+    sx=(_sigma2(z, p['beta_x1'], p['alpha_x1'], p['epsilon_x1'], betagamma_1, br_1, p['dx_1'], p['dpx_1'], p['deltap_p0_1'])
+        +_sigma2(z, p['beta_x2'], p['alpha_x2'], p['epsilon_x2'], betagamma_2, br_2, p['dx_2'], p['dpx_2'], p['deltap_p0_2']))
+    sy=(_sigma2(z, p['beta_y1'], p['alpha_y1'], p['epsilon_y1'], betagamma_1, br_1, p['dy_1'], p['dpy_1'], p['deltap_p0_1'])
+        +_sigma2(z, p['beta_y2'], p['alpha_y2'], p['epsilon_y2'], betagamma_2, br_2, p['dy_2'], p['dpy_2'], p['deltap_p0_2']))
+    kernel=np.exp(0.5*(-(bx+ax*z)**2/sx-(by+ay*z)**2/sy-z**2/s2))/np.sqrt(sx*sy*(p['sigma_z1']**2+p['sigma_z2']**2))
+    return width*np.sum(w*kernel, axis=0)
+
+def _double_integral(p, br_1, br_2, betagamma_1, betagamma_2, order):
+    '''
+    Tensor-product Gauss-Hermite quadrature in (z, t) of the kernel of L with crab cavities.
+
+    The nodes are scaled and centered on the Gaussian approximation of the kernel in (z, c*t): 
+    bunch lengths, beam sizes at the IP and separation with the CC kicks linearized.
+    The kernel is evaluated on the order x order grid as a single numpy expression.
+    The arguments are broadcast numpy arrays (see _single_integral) and the output has their shape.
+    '''
+    c=particle.speedOfLight_m_s
+    u, w=np.polynomial.hermite.hermgauss(order)
+    shape=(1,)*np.ndim(br_1)
+    u_1=u.reshape((-1, 1)+shape)
+    u_2=u.reshape((1, -1)+shape)
+    w=(w*np.exp(u**2))
+    w=(w[:, np.newaxis]*w[np.newaxis, :]).reshape((order, order)+shape)
+
+    def theta(plane, beam, delta_z):
+        return p[f'CC_V_{plane}_{beam}']/p[f'energy_tot{beam}']/1e9 \
+               *np.sin(p[f'CC_phase_{plane}_{beam}']+2*np.pi*p[f'CC_f_{plane}_{beam}']/c*delta_z)
+
+    def separation(z, ct):
+        mx1=p['x_1']+p['R12_1']*theta('x', 1, z-ct)+(p['px_1']+p['R22_1']*theta('x', 1, z-ct))*z
+        my1=p['y_1']+p['R34_1']*theta('y', 1, z-ct)+(p['py_1']+p['R44_1']*theta('y', 1, z-ct))*z
+        mx2=p['x_2']+p['R12_2']*theta('x', 2, z+ct)+(p['px_2']+p['R22_2']*theta('x', 2, z+ct))*z
+        my2=p['y_2']+p['R34_2']*theta('y', 2, z+ct)+(p['py_2']+p['R44_2']*theta('y', 2, z+ct))*z
+        return mx1-mx2, my1-my2
+
+    def sizes(z):
+        sx=(_sigma2(z, p['beta_x1'], p['alpha_x1'], p['epsilon_x1'], betagamma_1, br_1, p['dx_1'], p['dpx_1'], p['deltap_p0_1'])
+            +_sigma2(z, p['beta_x2'], p['alpha_x2'], p['epsilon_x2'], betagamma_2, br_2, p['dx_2'], p['dpx_2'], p['deltap_p0_2']))
+        sy=(_sigma2(z, p['beta_y1'], p['alpha_y1'], p['epsilon_y1'], betagamma_1, br_1, p['dy_1'], p['dpy_1'], p['deltap_p0_1'])
+            +_sigma2(z, p['beta_y2'], p['alpha_y2'], p['epsilon_y2'], betagamma_2, br_2, p['dy_2'], p['dpy_2'], p['deltap_p0_2']))
+        return sx, sy
+
+    # Gaussian of the bunch lengths, exp(-0.5*x^T M x) with x=(z, c*t)
+    b11=1/p['sigma_z1']**2+1/p['sigma_z2']**2
+    b12=-br_1/p['sigma_z1']**2+br_2/p['sigma_z2']**2
+    b22=br_1**2/p['sigma_z1']**2+br_2**2/p['sigma_z2']**2
+    # separation linearized in (z, c*t) by finite differences (it is linear for small CC kicks)
+    h=np.sqrt(1/b11)*1e-3
+    s_0=separation(0, 0)
+    s_z=[(i-j)/2/h for i, j in zip(separation(h, 0), separation(-h, 0))]
+    s_t=[(i-j)/2/h for i, j in zip(separation(0, h), separation(0, -h))]
+    m11, m12, m22, v1, v2=b11, b12, b22, 0, 0
+    for s0, sz, st, size in zip(s_0, s_z, s_t, sizes(0)):
+        m11=m11+sz**2/size
+        m12=m12+sz*st/size
+        m22=m22+st**2/size
+        v1=v1+s0*sz/size
+        v2=v2+s0*st/size
+    det=m11*m22-m12**2
+    z_c=-(m22*v1-m12*v2)/det
+    ct_c=-(m11*v2-m12*v1)/det
+    # Cholesky factor of the covariance of the Gaussian approximation
+    l11=np.sqrt(m22/det)
+    l21=-m12/det/l11
+    l22=np.sqrt(m11/det-l21**2)
+    z=z_c+np.sqrt(2)*l11*u_1
+    ct=ct_c+np.sqrt(2)*(l21*u_1+l22*u_2)
+    dx, dy=separation(z, ct)
+    sx, sy=sizes(z)
+    kernel=np.exp(-0.5*(dx**2/sx+dy**2/sy+b11*z**2+2*b12*z*ct+b22*ct**2))/np.sqrt(sx*sy)/p['sigma_z1']/p['sigma_z2']
+    # Jacobian of (u_1, u_2) -> (z, t)
+    return 2*l11*l22/c*np.sum(w*kernel, axis=(0, 1))
+
+def _hermite(integrand, args, order, max_order, rtol):
+    '''
+    Gauss-Hermite quadrature with automatic convergence: the order is doubled (up to max_order) until 
+    the relative difference between two consecutive orders is below rtol for all the cases.
+    A warning is printed if max_order is reached without convergence (not for a fixed order, order>=max_order,
+    that cannot be checked).
+
+    Returns:
+        The integral, the estimated relative error, the final order and the flag of the convergence.
+    '''
+    integral=integrand(*args, order)
+    error=np.full(np.shape(integral), np.inf)
+    converged=False
+    while order<max_order:
+        order=min(2*order, max_order)
+        previous=integral
+        integral=integrand(*args, order)
+        with np.errstate(all='ignore'):
+            error=np.abs(integral-previous)/np.abs(integral)
+        converged=bool(np.all((error<=rtol) | (integral==0)))
+        if converged:
+            break
+    if not converged and np.isfinite(error).any():
+        print(f'Warning: the Gauss-Hermite quadrature did not converge within rtol={rtol} at order {order} '
+              f'(max relative error {np.nanmax(error)}).')
+    return integral, error, order, converged
+
+def L_batch(f, nb,
+            N1, N2,
+            x_1, x_2,
+            y_1, y_2,
+            px_1, px_2,
+            py_1, py_2,
+            energy_tot1, energy_tot2,
+            deltap_p0_1, deltap_p0_2,
+            epsilon_x1, epsilon_x2,
+            epsilon_y1, epsilon_y2,
+            sigma_z1, sigma_z2,
+            beta_x1, beta_x2,
+            beta_y1, beta_y2,
+            alpha_x1, alpha_x2,
+            alpha_y1, alpha_y2,
+            dx_1, dx_2,
+            dy_1, dy_2,
+            dpx_1, dpx_2,
+            dpy_1, dpy_2,
+            CC_V_x_1=0, CC_f_x_1=0, CC_phase_x_1=0,
+            CC_V_x_2=0, CC_f_x_2=0, CC_phase_x_2=0,
+            CC_V_y_1=0, CC_f_y_1=0, CC_phase_y_1=0,
+            CC_V_y_2=0, CC_f_y_2=0, CC_phase_y_2=0,
+            R12_1=0, R22_1=0, R34_1=0, R44_1=0,
+            R12_2=0, R22_2=0, R34_2=0, R44_2=0,
+            order=16, rtol=1e-8, max_order=256, full_output=False):
+    '''
+    Returns luminosity in Hz/cm^2 for a batch of cases (see L for the arguments).
+
+    All the arguments can be numpy arrays and they are broadcast together. 
+    The integral over z is computed for all the cases at once with a Gauss-Hermite quadrature 
+    (see _single_integral). The order starts from 'order' and it is doubled (up to 'max_order') 
+    until the relative difference between two consecutive orders is below 'rtol' for all the cases.
+    The cases with crab cavities are integrated in (z, t) on a tensor-product grid (see _double_integral),
+    with the same convergence check.
+
+    full_output: if True it returns also a dictionary with the final 'order', the 'crab cavity order' 
+        (None without crab cavities), the estimated 'relative error' (array) of the quadrature and 
+        'converged' (False if max_order was reached before rtol, a warning is printed too).
+
+    See check_L_batch to compare the result with L.
+    See madxp/examples/luminosity/000_run.py
+    '''
+    p={i: j for i, j in locals().items() if i in _L_ARGUMENTS+_CC_ARGUMENTS}
+    aux=np.broadcast_arrays(*[np.asarray(p[i], dtype=float) for i in _L_ARGUMENTS+_CC_ARGUMENTS])
+    p=dict(zip(_L_ARGUMENTS+_CC_ARGUMENTS, aux))
+    br_1, betagamma_1=_relativistic(p['energy_tot1'])
+    br_2, betagamma_2=_relativistic(p['energy_tot2'])
+
+    args=(p, br_1, br_2, betagamma_1, betagamma_2)
+    integral, error, single_order, converged=_hermite(_single_integral, args, order, max_order, rtol)
+    error=np.array(error)
+    result=np.array(p['f']*p['N1']*p['N2']*p['nb']/np.sqrt(2)/np.pi**(3/2)*integral \
+           *_moeller_efficiency(br_1, br_2, p['px_1'], p['px_2'], p['py_1'], p['py_2'])/1e4)
+
+    crab=np.any([p[i]!=0 for i in ['CC_V_x_1', 'CC_V_y_1', 'CC_V_x_2', 'CC_V_y_2']], axis=0)
+    double_order=None
+    if np.any(crab):
+        aux={i: p[i][crab] for i in p}
+        args=(aux, br_1[crab], br_2[crab], betagamma_1[crab], betagamma_2[crab])
+        integral, error[crab], double_order, aux_converged=_hermite(_double_integral, args, order, max_order, rtol)
+        converged=converged and aux_converged
+        result[crab]=aux['f']*aux['N1']*aux['N2']*aux['nb']*particle.speedOfLight_m_s/2/np.pi**2*integral \
+                     *_moeller_efficiency(br_1[crab], br_2[crab], aux['px_1'], aux['px_2'], aux['py_1'], aux['py_2'])/1e4
+    if full_output:
+        return result, {'order': single_order, 'crab cavity order': double_order, 'relative error': error, 'converged': converged}
     return result
+
+def check_L_batch(arguments, samples=10, rtol=1e-6, seed=0, reference_options=None, **kwargs):
+    '''
+    Compare L_batch with the adaptive integration of L on a random sample of the cases.
+
+    Args:
+        arguments: a dictionary with the arguments of L (numpy arrays are broadcast together).
+        samples: the number of cases to compare.
+        rtol: the relative tolerance of the comparison.
+        seed: the seed of the random sample.
+        reference_options: the options of L for the reference (if None the adaptive integrations, 
+            quad and dblquad on +/-6 sigma).
+        kwargs: the options of L_batch (e.g., order and rtol).
+
+    Returns:
+        A pandas DF with, for each sampled case, its index, L, L_batch, the relative difference and the flag 'passed'.
+    '''
+    if reference_options is None:
+        reference_options={'closed_form': False, 'cc_integration': 'dblquad', 'sigma_integration': 6}
+    batch=L_batch(**arguments, **kwargs)
+    names=list(arguments)
+    aux=np.broadcast_arrays(*[np.asarray(arguments[i], dtype=float) for i in names])
+    my_indices=np.random.default_rng(seed).choice(batch.size, size=min(samples, batch.size), replace=False)
+    my_list=[]
+    for i in my_indices:
+        index=np.unravel_index(i, batch.shape)
+        reference=L(**{j: k[index] for j, k in zip(names, aux)}, **reference_options)
+        difference=abs(batch[index]-reference)/abs(reference)
+        my_list.append({'index': index, 'L': reference, 'L_batch': batch[index],
+                        'relative difference': difference, 'passed': bool(difference<=rtol)})
+    return pd.DataFrame(my_list)
+
+# sign of the B2 twiss columns in the B1 reference frame (lhcb2) for a B2 twiss in its own frame (lhcb4)
+_LHCB4_SIGNS={'x': -1, 'px': 1, 'y': 1, 'py': -1, 'betx': 1, 'bety': 1, 'alfx': -1, 'alfy': -1,
+              'dx': -1, 'dpx': 1, 'dy': 1, 'dpy': -1}
+
+def _ip_rows(twiss, ips):
+    '''
+    The rows of a twiss DF (see cpymadTool.twiss_df) of a list of IPs, with a single indexed lookup.
+    The IPs can be given with or without the MAD-X occurrence suffix (e.g., 'ip1' or 'ip1:1').
+    '''
+    ips=np.asarray(ips, dtype=object)
+    indexer=twiss.index.get_indexer(ips)
+    indexer=np.where(indexer<0, twiss.index.get_indexer(ips+':1'), indexer)
+    if np.any(indexer<0):
+        raise KeyError(f'IPs not found in the twiss table: {list(ips[indexer<0])}')
+    return twiss.iloc[indexer]
+
+def twiss_luminosity(twiss_b1, twiss_b2, beams_df, ips, beam_b1='lhcb1', beam_b2='lhcb2', b2='lhcb2', nb=None, **kwargs):
+    '''
+    Compute the luminosity of a list of IPs from the twiss tables of the two beams (one batched call of L_batch).
+
+    Args:
+        twiss_b1, twiss_b2: the twiss DFs of B1 and B2 (see cpymadTool.twiss_df).
+        beams_df: the beams DF (see cpymadTool.beams_df) with the beams of B1 and B2 
+            (energy, npart, exn, eyn, sigt, sige, kbunch and freq0 in MHz are used).
+        ips: the list of the IP names (e.g., ['ip1', 'ip5']).
+        beam_b1, beam_b2: the index of B1 and B2 in beams_df.
+        b2: the reference frame of the B2 twiss, 'lhcb2' (the one of B1, used by L) or 'lhcb4' 
+            (B2 direction, the signs of x, py, alfx, alfy, dx and dpy are flipped).
+        nb: the number of colliding bunches (scalar or per IP). If None 'kbunch' of B1 is used.
+        kwargs: the other arguments of L_batch (e.g., the crab cavity parameters or the quadrature options).
+
+    Returns:
+        A pandas DF, indexed by IP, with the arguments of L and the column 'luminosity [Hz/cm^2]'.
+
+    The normalized emittances are computed from the geometric ones if 'exn' ('eyn') is zero and
+    the rms momentum spread is sige/beta**2.
+
+    See madxp/examples/luminosity/000_run.py
+    '''
+    assert b2 in ['lhcb2', 'lhcb4']
+    columns=list(_LHCB4_SIGNS)
+    rows_1=_ip_rows(twiss_b1, ips)[columns].values.T
+    rows_2=_ip_rows(twiss_b2, ips)[columns].values.T
+    if b2=='lhcb4':
+        rows_2=rows_2*np.array([_LHCB4_SIGNS[i] for i in columns])[:, np.newaxis]
+    optics_1=dict(zip(columns, rows_1))
+    optics_2=dict(zip(columns, rows_2))
+    beam_1=beams_df.loc[beam_b1]
+    beam_2=beams_df.loc[beam_b2]
+
+    def emittance(beam, plane):
+        if beam[f'e{plane}n']!=0:
+            return beam[f'e{plane}n']
+        return beam[f'e{plane}']*beam['gamma']*beam['beta']
+
+    arguments=dict(f=beam_1['freq0']*1e6, nb=beam_1['kbunch'] if nb is None else np.asarray(nb),
+                   N1=beam_1['npart'], N2=beam_2['npart'],
+                   energy_tot1=beam_1['energy'], energy_tot2=beam_2['energy'],
+                   deltap_p0_1=beam_1['sige']/beam_1['beta']**2, deltap_p0_2=beam_2['sige']/beam_2['beta']**2,
+                   epsilon_x1=emittance(beam_1, 'x'), epsilon_x2=emittance(beam_2, 'x'),
+                   epsilon_y1=emittance(beam_1, 'y'), epsilon_y2=emittance(beam_2, 'y'),
+                   sigma_z1=beam_1['sigt'], sigma_z2=beam_2['sigt'])
+    for beam, optics in [('1', optics_1), ('2', optics_2)]:
+        arguments.update({f'x_{beam}': optics['x'], f'y_{beam}': optics['y'],
+                          f'px_{beam}': optics['px'], f'py_{beam}': optics['py'],
+                          f'beta_x{beam}': optics['betx'], f'beta_y{beam}': optics['bety'],
+                          f'alpha_x{beam}': optics['alfx'], f'alpha_y{beam}': optics['alfy'],
+                          f'dx_{beam}': optics['dx'], f'dy_{beam}': optics['dy'],
+                          f'dpx_{beam}': optics['dpx'], f'dpy_{beam}': optics['dpy']})
+    my_luminosity=L_batch(**arguments, **kwargs)
+    my_df=pd.DataFrame({i: np.broadcast_to(arguments[i], np.shape(my_luminosity)) for i in _L_ARGUMENTS}, index=list(ips))
+    my_df['luminosity [Hz/cm^2]']=my_luminosity
+    return my_df
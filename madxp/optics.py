@@ -0,0 +1,158 @@
+'''
+Linear optics in numpy.
+
+The Twiss parameters, the dispersion and the closed orbit are propagated from the entrance of an element
+to a given s-position inside it with the analytic transfer matrices of drifts, quadrupoles and
+sector/rectangular bends (with the entrance edge and fringe field focusing).
+The attributes of the elements are the ones of a full MAD-X twiss table.
+The propagation is linear: the optics is not corrected for the chromatic and the orbit feed-down effects
+(they are accounted for by the MAD-X twiss of the original sequence) and the path length t is not propagated.
+
+See madxp/examples/variablesExamples/000_run.py
+'''
+import numpy as np
+import pandas as pd
+
+# keywords treated as (possibly) focusing straight elements (k1=k1l/l, as in the MAD-X path)
+STRAIGHT_KEYWORDS=['quadrupole', 'drift', 'sextupole', 'octupole', 'placeholder',
+                   'hmonitor', 'vmonitor', 'monitor', 'instrument',
+                   'collimator', 'rcollimator', 'ecollimator']
+BEND_KEYWORDS=['sbend', 'rbend']
+
+INTERPOLATION_COLUMNS=['name', 'keyword', 's',
+                       'betx', 'alfx', 'mux', 'bety', 'alfy', 'muy',
+                       'dx', 'dpx', 'dy', 'dpy',
+                       'x', 'px', 'y', 'py', 't', 'pt']
+
+
+def _body_matrix(k, l, h):
+    '''
+    Transfer matrix terms of a body of length l with focusing k (1/m^2) and curvature h (1/m).
+
+    Returns:
+        c, s, cp, sp (the 2x2 matrix [[c, s], [cp, sp]]) and the dispersion terms d, dp
+        (vectorized on numpy arrays).
+    '''
+    k=np.asarray(k, dtype=float)
+    l=np.asarray(l, dtype=float)
+    sqk=np.sqrt(np.abs(k))
+    phi=sqk*l
+    focusing=k*l**2>1e-12
+    defocusing=k*l**2<-1e-12
+    with np.errstate(all='ignore'):
+        c=np.where(focusing, np.cos(phi), np.where(defocusing, np.cosh(phi), 1.))
+        s=np.where(focusing, np.sin(phi)/sqk, np.where(defocusing, np.sinh(phi)/sqk, l))
+        cp=np.where(focusing, -sqk*np.sin(phi), np.where(defocusing, sqk*np.sinh(phi), 0.))
+        d=np.where(focusing | defocusing, h*(1-c)/k, h*l**2/2)
+    return c, s, cp, c, d, h*s
+
+
+def _propagate_plane(beta0, alpha0, mu0, d0, dp0, m11, m12, m21, m22, m16, m26):
+    '''
+    Propagate the Twiss parameters and the dispersion of one plane.
+    '''
+    gamma0=(1+alpha0**2)/beta0
+    beta=m11**2*beta0-2*m11*m12*alpha0+m12**2*gamma0
+    alpha=-m11*m21*beta0+(m11*m22+m12*m21)*alpha0-m12*m22*gamma0
+    mu=mu0+np.arctan2(m12, m11*beta0-m12*alpha0)/(2*np.pi)
+    d=m11*d0+m12*dp0+m16
+    dp=m21*d0+m22*dp0+m26
+    return beta, alpha, mu, d, dp
+
+
+def propagate(my_s, start_df, rmatrix, kick=None, tmatrix=None):
+    '''
+    Propagate the optics from the start conditions with the (uncoupled) transfer maps of the segments.
+
+    Args:
+        my_s: numpy array of the s-positions at the end of the segments.
+        start_df: the rows of the twiss table with the start conditions.
+        rmatrix: numpy array (n, 6, 6) of the first order transfer matrices.
+        kick: numpy array (n, 6) of the zero order terms of the maps (None for no kick).
+        tmatrix: numpy array (n, 6, 6, 6) of the second order terms of the maps (None for linear maps).
+            The orbit is propagated to second order and the optics with the matrices fed down by the orbit.
+
+    Returns:
+        The pandas DF of the interpolated values (see INTERPOLATION_COLUMNS).
+    '''
+    my_s=np.asarray(my_s, dtype=float)
+    z0=start_df[['x', 'px', 'y', 'py', 't', 'pt']].values.astype(float)
+    z=np.einsum('nij,nj->ni', rmatrix, z0)
+    if kick is not None:
+        z=z+kick
+    if tmatrix is not None:
+        z=z+np.einsum('nijk,nj,nk->ni', tmatrix, z0, z0)
+        rmatrix=rmatrix+2*np.einsum('nijk,nk->nij', tmatrix, z0)
+    m=[[rmatrix[:, i, j] for j in range(6)] for i in range(6)]
+    betx, alfx, mux, dx, dpx=_propagate_plane(
+        start_df['betx'].values, start_df['alfx'].values, start_df['mux'].values,
+        start_df['dx'].values, start_df['dpx'].values,
+        m[0][0], m[0][1], m[1][0], m[1][1], m[0][5], m[1][5])
+    bety, alfy, muy, dy, dpy=_propagate_plane(
+        start_df['bety'].values, start_df['alfy'].values, start_df['muy'].values,
+        start_df['dy'].values, start_df['dpy'].values,
+        m[2][2], m[2][3], m[3][2], m[3][3], m[2][5], m[3][5])
+
+    names=[f'at_{i}:1' for i in my_s]
+    return pd.DataFrame({'name': names,
+                         'keyword': 'interpolation',
+                         's': my_s,
+                         'betx': betx, 'alfx': alfx, 'mux': mux,
+                         'bety': bety, 'alfy': alfy, 'muy': muy,
+                         'dx': dx, 'dpx': dpx, 'dy': dy, 'dpy': dpy,
+                         'x': z[:, 0], 'px': z[:, 1], 'y': z[:, 2], 'py': z[:, 3], 't': z[:, 4], 'pt': z[:, 5]},
+                        index=names)
+
+
+def supported(my_element_df):
+    '''
+    Return the boolean numpy array of the rows that can be interpolated in numpy
+    (supported keyword, no tilt and no skew gradient).
+    '''
+    return (my_element_df['keyword'].isin(STRAIGHT_KEYWORDS+BEND_KEYWORDS).values
+            & (my_element_df['tilt'].values==0)
+            & (my_element_df['k1sl'].values==0))
+
+
+def interpolate(my_s, start_df, element_df, beta0=1.):
+    '''
+    Propagate the optics from the start conditions to the s-positions inside the elements.
+
+    Args:
+        my_s: numpy array of the s-positions.
+        start_df: the rows of the twiss table with the start conditions (the end of the previous elements).
+        element_df: the rows of the twiss table of the elements containing the s-positions.
+        beta0: the relativistic beta of the reference particle (the dispersion of the twiss table is computed with respect to pt).
+
+    Returns:
+        The pandas DF of the interpolated values (see INTERPOLATION_COLUMNS).
+
+    The three arguments have to have the same length. Rows with unsupported elements
+    (see 'supported') have undefined values.
+    '''
+    my_s=np.asarray(my_s, dtype=float)
+    ds=my_s-start_df['s'].values
+    length=element_df['l'].values
+    keyword=element_df['keyword'].values
+    bend=np.isin(keyword, BEND_KEYWORDS)
+    with np.errstate(all='ignore'):
+        k1=np.where(length>0, element_df['k1l'].values/length, 0.)
+        h=np.where(bend & (length>0), element_df['angle'].values/length, 0.)
+    # in the twiss table the face angles of an rbend are already the ones of the equivalent sbend (e1+angle/2)
+    e1=np.where(bend, element_df['e1'].values, 0.)
+    fringe=2*h*element_df['hgap'].values*element_df['fint'].values
+    psi=e1-fringe*(1+np.sin(e1)**2)/np.cos(e1)
+
+    rmatrix=np.zeros((len(my_s), 6, 6))
+    rmatrix[:, 4, 4]=1.
+    rmatrix[:, 5, 5]=1.
+    # horizontal plane: entrance edge and body
+    c, s, cp, sp, d, dp=_body_matrix(h**2+k1, ds, h/beta0)
+    edge=h*np.tan(e1)
+    rmatrix[:, 0, 0], rmatrix[:, 0, 1], rmatrix[:, 1, 0], rmatrix[:, 1, 1]=c+s*edge, s, cp+sp*edge, sp
+    rmatrix[:, 0, 5], rmatrix[:, 1, 5]=d, dp
+    # vertical plane: entrance edge and body
+    c, s, cp, sp, d, dp=_body_matrix(-k1, ds, 0.)
+    edge=-h*np.tan(psi)
+    rmatrix[:, 2, 2], rmatrix[:, 2, 3], rmatrix[:, 3, 2], rmatrix[:, 3, 3]=c+s*edge, s, cp+sp*edge, sp
+    return propagate(my_s, start_df, rmatrix)
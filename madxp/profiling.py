@@ -0,0 +1,100 @@
+'''
+Profiling of the execution of a MADX file with the extended syntax.
+
+After each section df2run adds to the profile DF the columns in PROFILE_COLUMNS:
+the wall time of the MAD-X and of the python code (and of each code subsection), the wall time
+of each step of the snapshot, the CPU time of the python and of the MAD-X processes, their peak RSS and
+the number of MAD-X tables (and of their rows).
+The subsections are timed one by one. The subsections of a MAD-X block (if, while, macro) spanning several
+subsections (e.g., with a comment line inside) are sent in a single batch and their time is NaN
+(the MAD-X time of the section includes the one of the batch).
+The CPU times and the peak RSS are read before the snapshot and do not include it.
+The CPU time and the peak RSS of the MAD-X process are read from /proc (NaN if not available).
+The peak RSS is the high-water mark of the process since its start, not of the single section.
+
+The hooks (see HOOKS) are optional functions called by df2run during the execution:
+    'section_start': f(section title, section row of the MADX DF)
+    'subsection_end': f(section title, subsection index, subsection type, wall time [s] (NaN in a MAD-X block))
+    'section_end': f(section title, profile row as a dictionary)
+
+See madxp/examples/simpleFodo/000_run.py
+'''
+import os
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource=None
+
+PROFILE_COLUMNS=['execution time [s]',
+                 'madx time [s]',
+                 'python time [s]',
+                 'subsection times [s]',
+                 'snapshot time [s]',
+                 'snapshot step times [s]',
+                 'python cpu time [s]',
+                 'madx cpu time [s]',
+                 'python peak rss [MB]',
+                 'madx peak rss [MB]',
+                 'tables count',
+                 'tables rows']
+
+HOOKS=['section_start', 'subsection_end', 'section_end']
+
+
+def check_hooks(hooks):
+    '''Return the dictionary of the hooks (an empty one for None) after checking their names.'''
+    if hooks is None:
+        return {}
+    for i in hooks:
+        assert i in HOOKS, f'Unknown hook {i}, the hooks are {HOOKS}.'
+    return hooks
+
+
+def _madx_pid(madx):
+    '''The pid of the MAD-X process (None if the instance has not started it).'''
+    my_process=getattr(madx, '_process', None)
+    return getattr(my_process, 'pid', None)
+
+
+def python_usage():
+    '''
+    Return the CPU time [s] and the peak RSS [MB] of the python process.
+    '''
+    if resource is None:
+        return time.process_time(), np.nan
+    # ru_maxrss is in kB on Linux
+    return time.process_time(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+def madx_usage(madx):
+    '''
+    Return the CPU time [s] and the peak RSS [MB] of the MAD-X process (NaN if not available).
+    '''
+    my_pid=_madx_pid(madx)
+    my_cpu=np.nan
+    my_rss=np.nan
+    if my_pid is None:
+        return my_cpu, my_rss
+    try:
+        with open(f'/proc/{my_pid}/stat') as fid:
+            # the fields after the process name (that can contain spaces), utime and stime are the 14th and 15th
+            aux=fid.read().rsplit(')', 1)[1].split()
+        my_cpu=(int(aux[11])+int(aux[12]))/os.sysconf('SC_CLK_TCK')
+        with open(f'/proc/{my_pid}/status') as fid:
+            for line in fid:
+                if line.startswith('VmHWM:'):
+                    my_rss=int(line.split()[1])/1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return my_cpu, my_rss
+
+
+def tables_summary(madx):
+    '''
+    Return the number of MAD-X tables and the total number of their rows.
+    '''
+    my_tables=list(madx.table)
+    return len(my_tables), int(sum(madx._libmadx.get_table_row_count(i) for i in my_tables))
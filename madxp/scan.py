@@ -0,0 +1,454 @@
+'''
+Parameter scans of a MADX file with the extended syntax.
+
+Each point of the scan is a pythonData dictionary. The points are run with madxp.madxp, each in its own
+worker process (hence with its own MAD-X instance), and write their output DF and logs in their own folder.
+The final pythonData dictionaries of all the points are aggregated in a single DF.
+
+When only the last sections of the MADX file depend on the scanned parameters, 'sweep' runs the common
+sections once and forks the MAD-X process (copy-on-write) for each point to run only the remaining sections.
+The fork relies on cpymad and minrpc internals and it is used only with the tested versions (_FORK_TESTED):
+otherwise the MAD-X workspace at the end of the common sections is restored from a madxp.cache.SectionCache
+(only for the masks whose workspace can be restored from a MAD-X save).
+
+See madxp/examples/run3/000_checkMakethin.py
+'''
+import os
+import re
+import sys
+import gc
+import copy
+import time
+import pickle
+import tempfile
+import itertools
+import traceback
+import importlib.metadata
+import multiprocessing
+from multiprocessing.connection import wait
+import numpy as np
+import pandas as pd
+from cpymad.madx import Madx
+import madxp
+from madxp import cpymadTool as mt
+from madxp.cache import SectionCache
+
+# the files written by each point in its folder
+POINT_FILES={'output DF': 'output.pkl',
+             'pythonData file': 'pythonData.pkl',
+             'command log file': 'log.madx',
+             'stdout file': 'stdout.madx',
+             'python log file': 'python.log'}
+
+# the versions of cpymad and minrpc (prefixes) whose internals are used to fork the MAD-X process
+_FORK_TESTED={'cpymad': '1.19.', 'minrpc': '0.2.'}
+
+# the MAD-X commands whose effect is not reproduced by the MAD-X 'save' (see madxp.cache)
+_UNSAVED_COMMANDS={'macro': re.compile(r':\s*macro\b', re.IGNORECASE),
+                   'ealign': re.compile(r'\bealign\s*,', re.IGNORECASE),
+                   'efcomp': re.compile(r'\befcomp\s*,', re.IGNORECASE),
+                   'select': re.compile(r'\bselect\s*,', re.IGNORECASE),
+                   'option': re.compile(r'\boption\s*,', re.IGNORECASE)}
+
+# Code executed in the MAD-X process to fork it. The child serves the RPC requests on two named pipes
+# (instead of the ones of the parent) and writes the MAD-X output on its own file.
+_FORK_CODE='''
+import os, sys, ctypes
+from minrpc.service import Service
+from minrpc.connection import Connection
+# reap the children already finished
+try:
+    while os.waitpid(-1, os.WNOHANG)[0]>0:
+        pass
+except ChildProcessError:
+    pass
+ctypes.CDLL(None).fflush(None)
+if os.fork()==0:
+    try:
+        os.close(int(sys.argv[-2]))
+        os.close(int(sys.argv[-1]))
+        my_fd=os.open(stdout_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+        os.dup2(my_fd, 1)
+        os.dup2(my_fd, 2)
+        os.close(my_fd)
+        my_connection=Connection(open(to_madx, 'rb', 0), open(from_madx, 'wb', 0))
+        Service(my_connection).run()
+    finally:
+        ctypes.CDLL(None).fflush(None)
+        os._exit(0)
+'''
+
+def grid(**ranges):
+    '''
+    Build the list of points of a cartesian parameter grid.
+
+    Args:
+        ranges: the iterables of the values of each parameter (e.g., slicefactor=[2,4], makedipedgevalue=[0,1]).
+
+    Returns:
+        The list of dictionaries {parameter: value}, the last parameter is the fastest.
+    '''
+    names=list(ranges)
+    return [dict(zip(names, values)) for values in itertools.product(*[ranges[i] for i in names])]
+
+def _point_files(output_folder, index):
+    '''
+    The dictionary of the files of a point (see POINT_FILES).
+    '''
+    folder=os.path.join(output_folder, f'point_{index:04d}')
+    return {key: os.path.join(folder, POINT_FILES[key]) for key in POINT_FILES}
+
+def _fork_context():
+    '''
+    The multiprocessing context of the workers: they are forked, so the main script is not imported again.
+    '''
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+def _points_data(points, pythonData, output_folder):
+    '''
+    The initial pythonData and the files of each point.
+    '''
+    if isinstance(points, dict):
+        points=grid(**points)
+    if pythonData is None:
+        pythonData={}
+    my_data=[]
+    my_files=[]
+    for index, point in enumerate(points):
+        aux=copy.deepcopy(pythonData)
+        aux.update(copy.deepcopy(point))
+        my_data.append(aux)
+        my_files.append(_point_files(output_folder, index))
+        os.makedirs(os.path.dirname(my_files[-1]['output DF']), exist_ok=True)
+    return my_data, my_files
+
+def _worker(target, args, files, connection):
+    '''
+    Run a point of the scan in the worker process and send its status to the parent process.
+    The function target(*args) runs the point and returns its final pythonData.
+    The python output of the point is redirected to its log file.
+    '''
+    with open(files['python log file'], 'w') as fid:
+        sys.stdout=fid
+        sys.stderr=fid
+        try:
+            pythonData=target(*args)
+            with open(files['pythonData file'], 'wb') as pickle_fid:
+                pickle.dump(pythonData, pickle_fid)
+            connection.send(('ok', ''))
+        except BaseException:
+            my_traceback=traceback.format_exc()
+            print(my_traceback)
+            connection.send(('failed', my_traceback))
+        fid.flush()
+
+def _run_points(start, number_of_points, processes, timeout):
+    '''
+    Run the points of a scan, with at most 'processes' points at the same time.
+
+    Args:
+        start: a function start(index, connection) starting (and returning) the worker process of a point.
+            The worker has to send its (status, error) on the connection (see '_worker').
+        number_of_points: the number of points.
+        processes, timeout: see 'scan'.
+
+    Returns:
+        The list of the dictionaries with the status, the error and the execution time of each point.
+    '''
+    if processes is None:
+        processes=os.cpu_count()
+    assert processes>0
+    my_context=_fork_context()
+    my_status=[None]*number_of_points
+    to_run=list(range(number_of_points))[::-1]
+    running={}
+    # the objects inherited by the workers (e.g., MAD-X instances) are not finalized by their garbage collection
+    gc.freeze()
+    try:
+        while to_run or running:
+            while to_run and len(running)<processes:
+                index=to_run.pop()
+                receiver, sender=my_context.Pipe(duplex=False)
+                process=start(index, sender)
+                sender.close()
+                print(f'Point {index} started.')
+                running[index]=(process, receiver, time.time())
+            if timeout is None:
+                wait_time=None
+            else:
+                wait_time=max(0, min(running[i][2] for i in running)+timeout-time.time())
+            wait([running[i][0].sentinel for i in running], timeout=wait_time)
+            for index in list(running):
+                process, receiver, start_time=running[index]
+                if not process.is_alive():
+                    process.join()
+                    if receiver.poll():
+                        status, error=receiver.recv()
+                    else:
+                        status, error='failed', f'The worker process exited with code {process.exitcode}.'
+                elif (timeout is not None) and (time.time()-start_time>timeout):
+                    process.terminate()
+                    process.join()
+                    status, error='timeout', f'The point exceeded the timeout of {timeout} s.'
+                else:
+                    continue
+                receiver.close()
+                my_status[index]={'status': status, 'error': error, 'execution time [s]': time.time()-start_time}
+                print(f'Point {index} {status}.')
+                del running[index]
+    finally:
+        for index in running:
+            running[index][0].terminate()
+        gc.unfreeze()
+    return my_status
+
+def _scan_df(my_data, my_files, my_status, output_folder):
+    '''
+    Aggregate the final pythonData of the points in a DF (see 'scan') and save it in the output folder.
+    '''
+    my_list=[]
+    for index in range(len(my_data)):
+        aux=my_data[index]
+        if my_status[index]['status']=='ok':
+            with open(my_files[index]['pythonData file'], 'rb') as fid:
+                aux=pickle.load(fid)
+        my_list.append(dict(aux, **my_status[index], **my_files[index]))
+    scanDF=pd.DataFrame(my_list)
+    scanDF.to_pickle(os.path.join(output_folder, 'scan.pkl'))
+    return scanDF
+
+def _scan_point(inputFile, pythonData, files, verbose, snapshot):
+    '''
+    Run a point of 'scan'.
+    '''
+    madxp.madxp(inputFile, pythonData=pythonData, outputDF=files['output DF'],
+                command_log_file=files['command log file'], stdout_file=files['stdout file'],
+                verbose=verbose, snapshot=snapshot)
+    return pythonData
+
+def scan(inputFile, points, pythonData=None, output_folder='scan', processes=None, timeout=None, verbose=False, snapshot='full'):
+    '''
+    Run a MADX file with the extended syntax for all the points of a scan.
+
+    Args:
+        inputFile: the MADX input file.
+        points: the list of the points (dictionaries updating pythonData, e.g., the output of 'grid') or
+            a dictionary {parameter: iterable of values} (converted with 'grid').
+        pythonData: the pythonData dictionary common to all the points (it is deep-copied for each point).
+        output_folder: the folder of the output. Each point writes the files of POINT_FILES in the
+            subfolder 'point_XXXX' (XXXX is the index of the point) and the aggregated DF is saved in 'scan.pkl'.
+        processes: the maximum number of points running at the same time (None for the number of CPUs).
+        timeout: the maximum execution time of a point in seconds (None for no limit).
+            The worker process of a point exceeding it is terminated.
+        verbose, snapshot: see madxp.madxp.
+
+    Returns:
+        The pandas DF with a row per point (same order of the points). The columns are the keys of the final
+        pythonData of the point and 'status' ('ok', 'failed' or 'timeout'), 'error' (the traceback of a failed point),
+        'execution time [s]' and the files of POINT_FILES.
+        A failed point does not stop the scan: its row has only the keys of its initial pythonData.
+    '''
+    my_data, my_files=_points_data(points, pythonData, output_folder)
+    my_context=_fork_context()
+
+    def start(index, connection):
+        process=my_context.Process(target=_worker,
+                                   args=(_scan_point, (inputFile, my_data[index], my_files[index], verbose, snapshot),
+                                         my_files[index], connection))
+        process.start()
+        return process
+
+    my_status=_run_points(start, len(my_data), processes, timeout)
+    return _scan_df(my_data, my_files, my_status, output_folder)
+
+def _fork_check(madx):
+    '''
+    Check if the MAD-X process of 'madx' can be forked (see _FORK_TESTED).
+
+    Returns:
+        None if it can be forked, otherwise the reason.
+    '''
+    if os.name!='posix':
+        return 'the MAD-X process can be forked only on POSIX systems'
+    for package, version in _FORK_TESTED.items():
+        try:
+            aux=importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            return f'{package} version not found'
+        if not aux.startswith(version):
+            return f'{package} {aux} is not a tested version ({version}x)'
+    if not hasattr(madx, '_service'):
+        return 'the MAD-X instance has no RPC service'
+    return None
+
+def _fork_madx(madx, stdout_file, fifo_folder):
+    '''
+    Fork the MAD-X process of 'madx' (the child has a copy of the full MAD-X workspace).
+
+    Returns:
+        The function connecting to the child (to be called once in the process using it) and returning
+        the LibMadxClient of the forked MAD-X process.
+    '''
+    to_madx=os.path.join(fifo_folder, 'to_madx')
+    from_madx=os.path.join(fifo_folder, 'from_madx')
+    os.mkfifo(to_madx)
+    os.mkfifo(from_madx)
+    from cpymad._rpc import LibMadxClient
+    from minrpc.connection import Connection
+    madx._service._request('function_call', 'builtins', 'exec',
+                           (_FORK_CODE, {'to_madx': to_madx, 'from_madx': from_madx, 'stdout_file': os.path.abspath(stdout_file)}), {})
+    def connect():
+        # same opening order of the child to avoid a deadlock
+        send=open(to_madx, 'wb', 0)
+        recv=open(from_madx, 'rb', 0)
+        return LibMadxClient(Connection(recv, send))
+    return connect
+
+def _sweep_point(connect, suffixDF, prefixDF, pythonData, namespace, files, verbose, snapshot):
+    '''
+    Run the remaining sections of a point of 'sweep' on the forked MAD-X process.
+    The python namespace is the one of the prefix (inherited by the forked worker).
+    '''
+    my_service=connect()
+    my_madx=Madx(libmadx=my_service.libmadx, command_log=files['command log file'])
+    suffixDF=madxp.df2run(my_madx, suffixDF, pythonData=pythonData, verbose=verbose, snapshot=snapshot, namespace=namespace)
+    pd.concat([prefixDF, suffixDF]).to_pickle(files['output DF'])
+    my_service.close()
+    return pythonData
+
+def _sweep_point_cache(cache, key, suffixDF, prefixDF, pythonData, namespace, files, verbose, snapshot):
+    '''
+    Run the remaining sections of a point of 'sweep' on a new MAD-X process, starting from the
+    workspace at the end of the prefix (restored from the cache).
+    The python namespace is the one of the prefix (inherited by the forked worker).
+    '''
+    with open(files['stdout file'], 'w') as f:
+        my_madx=Madx(stdout=f, command_log=files['command log file'])
+    try:
+        cache.restore(key, my_madx)
+        suffixDF=madxp.df2run(my_madx, suffixDF, pythonData=pythonData, verbose=verbose, snapshot=snapshot, namespace=namespace)
+        pd.concat([prefixDF, suffixDF]).to_pickle(files['output DF'])
+    finally:
+        my_madx.exit()
+    return pythonData
+
+def _unsaved_commands(myDF):
+    '''
+    The MAD-X commands of a MADX DF whose effect is not reproduced by the MAD-X 'save' of a SectionCache
+    (see _UNSAVED_COMMANDS), as a sorted list of (section title, command).
+    '''
+    my_set=set()
+    for title, subsections in zip(myDF.index, myDF['Code subsections']):
+        for code in subsections:
+            my_type, my_code=list(code.items())[0]
+            if my_type=='markdown':
+                continue
+            if my_type=='madx':
+                my_code='\n'.join(i.split('!')[0] for i in my_code.split('\n'))
+            for command, regex in _UNSAVED_COMMANDS.items():
+                if regex.search(my_code):
+                    my_set.add((title, command))
+    return sorted(my_set)
+
+def sweep(inputFile, points, prefix, pythonData=None, output_folder='sweep', processes=None, timeout=None, verbose=False, snapshot='full',
+          fork_madx=None):
+    '''
+    Run a MADX file with the extended syntax for all the points of a scan, running only once the common sections.
+
+    The sections of the prefix are run once with the common pythonData. Then, for each point, the MAD-X process
+    of the prefix is forked (copy-on-write, with the full MAD-X workspace) and the remaining sections are run
+    in a worker process with the pythonData of the point (a deep copy of the one at the end of the prefix, updated with the point)
+    and the python namespace at the end of the prefix (the objects defined in its python sections).
+    The sections of the prefix cannot depend on the parameters of the points.
+    The MAD-X process is forked only with the tested versions of cpymad and minrpc (_FORK_TESTED). Otherwise
+    the workspace at the end of the prefix is stored in a madxp.cache.SectionCache and restored in a new MAD-X
+    process for each point: the MAD-X 'save' does not reproduce macros, errors, 'select' flags, options and string
+    variables, so a prefix using them (see _UNSAVED_COMMANDS) raises an Exception.
+    The worker processes are forked, so the sweep runs only on POSIX systems.
+
+    Args:
+        inputFile: the MADX input file.
+        points: the points of the scan (see 'scan').
+        prefix: the number of the common sections or the title of the last common section.
+        pythonData: the pythonData dictionary common to all the points.
+        output_folder: the folder of the output (see 'scan'). The prefix writes its files in the subfolder 'prefix'.
+        processes, timeout, verbose, snapshot: see 'scan'.
+        fork_madx: None to fork the MAD-X process if possible (with a warning when the cache is used instead),
+            True to fork it (an Exception is raised if not possible) or False to use the cache.
+
+    Returns:
+        The pandas DF of the scan (see 'scan'). The output DF of each point has all the sections
+        (the ones of the prefix are the same for all the points).
+
+    See madxp/examples/run3/000_checkMakethin.py
+    '''
+    assert os.name=='posix', 'The worker processes can be forked only on POSIX systems.'
+    myDF=madxp.madx2df(inputFile)
+    if isinstance(prefix, str):
+        prefix=list(myDF.index).index(prefix)+1
+    assert 0<prefix<len(myDF)
+    if pythonData is None:
+        pythonData={}
+    pythonData=copy.deepcopy(pythonData)
+
+    # the common sections
+    prefix_files={key: os.path.join(output_folder, 'prefix', POINT_FILES[key]) for key in POINT_FILES}
+    os.makedirs(os.path.join(output_folder, 'prefix'), exist_ok=True)
+    with open(prefix_files['stdout file'], 'w') as f:
+        madx=Madx(stdout=f, command_log=prefix_files['command log file'])
+    try:
+        if fork_madx is not False:
+            reason=_fork_check(madx)
+            if reason is not None and fork_madx:
+                raise Exception(f'The MAD-X process cannot be forked: {reason}.')
+            if reason is not None:
+                print('*'*80)
+                print(f'WARNING: the MAD-X process cannot be forked ({reason}).')
+                print('The workspace at the end of the prefix is restored from a MAD-X save for each point.')
+                print('*'*80)
+            fork_madx=reason is None
+        cache=None
+        if not fork_madx:
+            my_commands=_unsaved_commands(myDF.iloc[:prefix])
+            if len(my_commands)>0:
+                raise Exception('The prefix cannot be restored from a MAD-X save, it uses: '
+                                +', '.join(f'{j} (section {i!r})' for i, j in my_commands)+'.')
+            cache=SectionCache(os.path.join(output_folder, 'prefix', 'cache'))
+            key=cache.keys(myDF.iloc[:prefix], pythonData, snapshot)[-1]
+        namespace={}
+        prefixDF=madxp.df2run(madx, myDF.iloc[:prefix], pythonData=pythonData, verbose=verbose, snapshot=snapshot,
+                              cache=cache, namespace=namespace)
+        prefixDF.to_pickle(prefix_files['output DF'])
+        with open(prefix_files['pythonData file'], 'wb') as fid:
+            pickle.dump(pythonData, fid)
+        if not fork_madx:
+            if np.any(mt._globals_arrays(madx)['var_type']==3):
+                raise Exception('The prefix cannot be restored from a MAD-X save, it defines string variables.')
+            assert key in cache, 'The workspace at the end of the prefix has not been cached.'
+            madx.exit()
+            madx=None
+
+        my_data, my_files=_points_data(points, pythonData, output_folder)
+        my_context=_fork_context()
+
+        with tempfile.TemporaryDirectory() as fifo_folder:
+            def start(index, connection):
+                files=my_files[index]
+                if fork_madx:
+                    my_folder=os.path.join(fifo_folder, f'point_{index:04d}')
+                    os.mkdir(my_folder)
+                    connect=_fork_madx(madx, files['stdout file'], my_folder)
+                    args=(_sweep_point, (connect, myDF.iloc[prefix:], prefixDF, my_data[index], namespace, files, verbose, snapshot))
+                else:
+                    args=(_sweep_point_cache, (cache, key, myDF.iloc[prefix:], prefixDF, my_data[index], namespace, files, verbose, snapshot))
+                process=my_context.Process(target=_worker, args=args+(files, connection))
+                process.start()
+                return process
+
+            my_status=_run_points(start, len(my_data), processes, timeout)
+    finally:
+        if madx is not None:
+            madx.exit()
+    return _scan_df(my_data, my_files, my_status, output_folder)
@@ -0,0 +1,241 @@
+'''
+Incremental snapshots of the MAD-X workspace.
+
+Instead of storing the full variables, sequences and beams DFs after each section of a mask,
+df2run(..., snapshot='diff') stores only the globals, expressions, sequences and beams that
+changed with respect to the previous section. The full state of any section can be rebuilt
+on demand from those differences.
+
+The other snapshot policies of df2run are 'none' (no snapshot), a list of variable names (a column
+per variable with its value), 'full' and 'marked' (full snapshot only of the sections whose title
+contains SNAPSHOT_MARKER, e.g. '!## Twiss the sequence [snapshot]').
+With df2run(..., lazy=True) the full snapshots store only the raw workspace state: the DFs
+are built (once) when they are first accessed (see LazyFrame).
+
+See madxp/examples/simpleFodo/000_run.py
+'''
+import numpy as np
+import pandas as pd
+from madxp import cpymadTool as mt
+
+_KEYS=('globals', 'sequences', 'beams')
+
+SNAPSHOT_MARKER='[snapshot]'
+
+SNAPSHOT_COLUMNS=['independent_variable_df', 'dependent_variable_df', 'constant_df', 'sequences_df', 'beams_df']
+
+def workspace_state(mad):
+    '''
+    Extract the raw state of the MAD-X workspace.
+
+    Args:
+        mad: The MAD-X handle.
+
+    Returns:
+        A dictionary with the keys
+        - 'globals': {variable name: (value, expression, variable type)}
+        - 'sequences': {sequence name: {'beam': bool, 'expanded': bool}}
+        - 'beams': {sequence name: dictionary of the beam attributes}
+    '''
+    return {'globals': mt._globals_dict(mad),
+            'sequences': mt._sequences_dict(mad),
+            'beams': mt._beams_dict(mad, verbose=False)}
+
+def _equal(a, b):
+    '''
+    Compare two raw values of the workspace (NaN are considered equal, also in tuples).
+    '''
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        return len(a)==len(b) and all(_equal(i, j) for i, j in zip(a, b))
+    try:
+        return bool(a==b) or (a!=a and b!=b)
+    except (ValueError, TypeError):
+        return False
+
+def state_diff(old_state, new_state):
+    '''
+    Compute the difference between two workspace states.
+
+    Args:
+        old_state: the previous state (output of 'workspace_state'). It can be None or {}.
+        new_state: the current state (output of 'workspace_state').
+
+    Returns:
+        A dictionary with the same keys of the state. For each key there is a dictionary with
+        - 'changed': the entries that are new or that changed value
+        - 'removed': the list of the entries that are not present anymore
+    '''
+    if not old_state:
+        old_state={}
+    diff={}
+    for key in _KEYS:
+        old=old_state.get(key, {})
+        new=new_state[key]
+        changed={k: v for k, v in new.items() if (k not in old) or (not _equal(old[k], v))}
+        removed=[k for k in old if k not in new]
+        diff[key]={'changed': changed, 'removed': removed}
+    return diff
+
+def apply_diff(state, diff, inplace=False):
+    '''
+    Apply a difference (output of 'state_diff') to a workspace state.
+
+    Args:
+        state: the workspace state. It can be None or {}.
+        diff: the difference to apply.
+        inplace: if True 'state' and its dictionaries are updated in place.
+
+    Returns:
+        The updated workspace state.
+    '''
+    if state is None:
+        state={}
+    new_state=state if inplace else {}
+    for key in _KEYS:
+        aux=state.get(key, {})
+        if not inplace:
+            aux=dict(aux)
+        for k in diff[key]['removed']:
+            aux.pop(k, None)
+        aux.update(diff[key]['changed'])
+        new_state[key]=aux
+    return new_state
+
+def rebuild_state(profileDF, section):
+    '''
+    Rebuild the workspace state at the end of a given section.
+
+    Args:
+        profileDF: the profile DF of df2run, obtained with snapshot='diff'.
+        section: the title of the section.
+
+    Returns:
+        The workspace state (see 'workspace_state') at the end of the section.
+    '''
+    state={}
+    for my_section, diff in profileDF['workspace_diff'].items():
+        apply_diff(state, diff, inplace=True)
+        if my_section==section:
+            return state
+    raise KeyError(f'Section {section} not found.')
+
+def state_to_snapshot(state):
+    '''
+    Convert a workspace state in the DFs stored by df2run(..., snapshot='full').
+
+    Args:
+        state: the workspace state (see 'workspace_state').
+
+    Returns:
+        A dictionary with the keys 'independent_variable_df', 'dependent_variable_df',
+        'constant_df', 'sequences_df' and 'beams_df'.
+    '''
+    my_dict=mt._variables_dict_from_globals(state['globals'])
+    my_dict['sequences_df']=pd.DataFrame(state['sequences']).transpose()
+    my_dict['beams_df']=mt._beams_df_from_dict(state['beams'])
+    return my_dict
+
+def section_snapshot(profileDF, section):
+    '''
+    Rebuild the full snapshot of a given section from a profile DF obtained with snapshot='diff'.
+
+    Args:
+        profileDF: the profile DF of df2run.
+        section: the title of the section.
+
+    Returns:
+        The dictionary of DFs of the section (see 'state_to_snapshot').
+    '''
+    return state_to_snapshot(rebuild_state(profileDF, section))
+
+def expand_profile(profileDF):
+    '''
+    Convert a profile DF obtained with snapshot='diff' in the one obtained with snapshot='full'.
+
+    Args:
+        profileDF: the profile DF of df2run.
+
+    Returns:
+        A copy of the profile DF with the full snapshot columns in place of 'workspace_diff'.
+    '''
+    my_list=[]
+    state={}
+    for diff in profileDF['workspace_diff']:
+        apply_diff(state, diff, inplace=True)
+        my_list.append(state_to_snapshot(state))
+    aux=profileDF.drop(columns='workspace_diff')
+    for key in SNAPSHOT_COLUMNS:
+        aux[key]=[i[key] for i in my_list]
+    return aux
+
+def variables_values(mad, names):
+    '''
+    Extract the values of a list of MAD-X variables (NaN for the undefined ones).
+    '''
+    my_dict={}
+    for i in names:
+        aux=mad.globals.get(i)
+        my_dict[i]=np.nan if aux is None else aux
+    return my_dict
+
+class _DeferredSnapshot():
+    '''
+    The raw workspace state of a section and, once built, the corresponding dictionary of DFs.
+    Only the raw state is pickled.
+    '''
+    def __init__(self, state):
+        self.state=state
+        self.snapshot=None
+
+    def __getstate__(self):
+        return {'state': self.state, 'snapshot': None}
+
+    def get(self, key):
+        if self.snapshot is None:
+            self.snapshot=state_to_snapshot(self.state)
+        return self.snapshot[key]
+
+class LazyFrame():
+    '''
+    A pandas DF of a snapshot (see SNAPSHOT_COLUMNS) built when it is first accessed.
+    The attributes, the indexing and the representation are the ones of the DF (attribute 'frame').
+    '''
+    def __init__(self, deferred, key):
+        self._deferred=deferred
+        self._key=key
+
+    @property
+    def frame(self):
+        '''The pandas DF.'''
+        return self._deferred.get(self._key)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.frame, name)
+
+    def __getitem__(self, key):
+        return self.frame[key]
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __iter__(self):
+        return iter(self.frame)
+
+    def __repr__(self):
+        return repr(self.frame)
+
+    def _repr_html_(self):
+        return self.frame._repr_html_()
+
+def lazy_snapshot(mad):
+    '''
+    Extract the raw workspace state and return the dictionary of the LazyFrame of the snapshot columns.
+    '''
+    aux=_DeferredSnapshot(workspace_state(mad))
+    return {key: LazyFrame(aux, key) for key in SNAPSHOT_COLUMNS}
+
+def is_marked(section):
+    '''Whether the title of the section asks for a full snapshot (see SNAPSHOT_MARKER).'''
+    return SNAPSHOT_MARKER in section
@@ -0,0 +1,82 @@
+import pickle
+from cpymad.madx import Madx
+import madxp
+from madxp import snapshot as sn
+from madxp.cache import SectionCache
+
+MASK='''!## Define the elements
+quadrupole_length=5;
+cell_length=100;
+!## Python re-definition
+//madx.input(f'quadrupole_length={pythonData["quadrupole_length"]};')
+//def strength(length):
+//    return 2.8/cell_length/length
+!## Define the gradient
+myK:=2.8/cell_length/quadrupole_length;
+qf: quadrupole, l=quadrupole_length, k1=myK;
+qd: quadrupole, l=quadrupole_length, k1=-myK;
+my_cell: sequence, refer=entry, l=cell_length;
+q1: qf, at=0;
+q2: qd, at=cell_length/2;
+endsequence;
+beam, particle=proton, energy=7000;
+!## Twiss the sequence
+use, sequence=my_cell;
+twiss, table=my_twiss;
+!## Python data extraction
+//pythonData['q1']=madx.table.summ.q1[0]
+'''
+
+
+def _run(folder, **kwargs):
+    pythonData={'quadrupole_length': 4}
+    with Madx(stdout=False) as madx:
+        my_df=madxp.df2run(madx, madxp.madx2df(str(folder/'input.madx')), pythonData=pythonData,
+                           cache=str(folder/'cache'), **kwargs)
+    return my_df, pythonData
+
+
+def test_restore(tmp_path):
+    (tmp_path/'input.madx').write_text(MASK.replace("//def strength(length):\n//    return 2.8/cell_length/length\n", ''))
+    first, first_data=_run(tmp_path)
+    second, second_data=_run(tmp_path)
+    assert not first['cached'].any()
+    assert second['cached'].all()
+    assert first_data==second_data
+    assert first['independent_variable_df'].iloc[-1].equals(second['independent_variable_df'].iloc[-1])
+
+
+def test_restore_namespace(tmp_path):
+    # a function defined in a python section cannot be stored: the sections from there are run again
+    (tmp_path/'input.madx').write_text(MASK)
+    _run(tmp_path)
+    second, second_data=_run(tmp_path)
+    assert second['cached'].tolist()==[True, False, False, False, False]
+    assert second_data['q1']>0
+
+
+def test_namespace_compatibility(tmp_path):
+    # the globals of madxp and the local variables of df2run are available to the python code, but not cached
+    (tmp_path/'input.madx').write_text(MASK.replace("//def strength(length):\n//    return 2.8/cell_length/length\n", '').replace(
+        "//pythonData['q1']", "//pythonData['names']=[section[0], len(myDF), Madx.__name__, np.pi>3, sys.maxsize>0]\n//pythonData['q1']"))
+    _, first_data=_run(tmp_path)
+    assert first_data['names']==['Python data extraction', 5, 'Madx', True, True]
+    second, second_data=_run(tmp_path)
+    assert second['cached'].all()
+    assert second_data==first_data
+    cache=SectionCache(str(tmp_path/'cache'))
+    key=cache.keys(madxp.madx2df(str(tmp_path/'input.madx')), {'quadrupole_length': 4})[-1]
+    with open(cache._path(key, 'namespace.pkl'), 'rb') as fid:
+        assert pickle.load(fid)=={'objects': {}, 'modules': {}, 'missing': []}
+
+
+def test_snapshot_policy(tmp_path):
+    (tmp_path/'input.madx').write_text(MASK)
+    _run(tmp_path, snapshot='none')
+    full, _=_run(tmp_path, snapshot='full')
+    assert not full['cached'].any()
+    assert 'sequences_df' in full
+    diff, _=_run(tmp_path, snapshot='diff')
+    assert not diff['cached'].any()
+    assert sn.expand_profile(diff)['sequences_df'].iloc[-1].equals(full['sequences_df'].iloc[-1])
+    assert len(SectionCache(str(tmp_path/'cache')))==3*5
@@ -0,0 +1,128 @@
+import gc
+import numpy as np
+import pandas as pd
+import pytest
+from cpymad.madx import Madx
+from madxp import cpymadTool as mt
+
+
+@pytest.fixture
+def mad():
+    with Madx(stdout=False) as my_mad:
+        my_mad.input('a=1; b:=a*2; c=-0.1;')
+        yield my_mad
+
+
+SEQUENCE='''kf=0.0056; ang:=0.02*kf/kf; kd=0.0028;
+qf: quadrupole, l=5, k1:=kf;
+qd: quadrupole, l=5, k1:=-kd*2;
+mb: sbend, l=10, angle:=ang;
+my_cell: sequence, refer=entry, l=100;
+q1: qf, at=0;
+b1: mb, at=20;
+q2: qd, at=50;
+endsequence;
+'''
+
+
+def test_get_variables_paths(mad, monkeypatch):
+    names=['a', 'b', 'c', 'undefined']
+    fast=mt._madx_exec(mad, mt._GET_VARIABLES_CODE, names=names)
+    assert fast is not None
+    assert fast==mt._get_variables_loop(mad, names)
+    values, errors=mt.get_variables(mad, names)
+    assert values=={'a': 1., 'b': 2., 'c': -0.1}
+    assert list(errors)==['undefined']
+    # untested versions of cpymad/minrpc: the variables are read one by one
+    monkeypatch.setitem(mt._EXEC_TESTED, 'cpymad', '0.0.')
+    assert mt._madx_exec_check(mad) is not None
+    assert mt._madx_exec(mad, mt._GET_VARIABLES_CODE, names=names) is None
+    assert mt.get_variables(mad, names)==(values, errors)
+
+
+def test_set_get_variables(mad):
+    variables={'x': 0.1, 'n': np.int64(3), 'flag': True, 'kq': np.array([[1., 2.], [3., 4.]]), 'bad': np.nan}
+    skipped=mt.set_variables(mad, variables)
+    assert list(skipped)==['bad']
+    python_data={'x': 0., 'n': 0, 'flag': 0, 'kq': np.zeros((2, 2)), 'missing': 0.}
+    errors=mt.mad_to_python_data(mad, python_data)
+    assert list(errors)==['missing']
+    assert python_data['x']==0.1
+    assert python_data['n']==3
+    assert python_data['flag']==1
+    assert np.array_equal(python_data['kq'], variables['kq'])
+
+
+def test_set_variables_deferred(mad):
+    assert mt.set_variables(mad, {'d': 'a*10', 'e': 'a'}, deferred=['d'])=={'e': 'type str not supported'}
+    mad.input('a=3;')
+    assert mt.get_variables(mad, ['d'])[0]=={'d': 30.}
+
+
+def test_globals_arrays(mad):
+    arrays=mt._globals_arrays(mad)
+    assert arrays['name'].tolist()==list(mad.globals)
+    for name, value, my_expression, var_type in zip(*[arrays[i] for i in ['name', 'value', 'expression', 'var_type']]):
+        aux=mad._libmadx.get_var(name)
+        assert (value, my_expression, var_type)==(aux.value, aux.expr, aux.var_type)
+    assert mt._globals_arrays_from_dict(mt._globals_dict(mad))['name'].tolist()==arrays['name'].tolist()
+
+
+def test_variables_dict(mad):
+    my_dict=mt.variables_dict(mad)
+    assert my_dict['dependent_variable_df'].loc['b'].to_dict()=={'value': 2., 'expression': 'a*2', 'parameters': ['a'], 'knobs': ['a']}
+    assert my_dict['independent_variable_df'].loc[['a', 'c'], 'value'].tolist()==[1., -0.1]
+    assert 'pi' in my_dict['constant_df'].index
+    assert len(my_dict['constant_df'])+len(my_dict['independent_variable_df'])+len(my_dict['dependent_variable_df'])==len(mad.globals)
+
+
+def test_sequence_df_columns(mad):
+    mad.input(SEQUENCE)
+    full=mt.sequence_df(mad, 'my_cell')
+    columnar=mt.sequence_df(mad, 'my_cell', columns=['k1', 'angle'])
+    assert columnar.index.tolist()==full.index.tolist()
+    for i in ['position', 'parent', 'base_type', 'length', 'parameters', 'knobs']:
+        assert columnar[i].tolist()==full[i].tolist()
+    for i in ['k1', 'angle']:
+        assert columnar[i].equals(full[i+' value'].rename(i))
+    assert columnar.loc['b1', 'knobs']==['kf']
+    quadrupoles=mt.sequence_df(mad, 'my_cell', columns=['k1'], classes=['quadrupole'])
+    assert quadrupoles.index.tolist()==['q1', 'q2']
+    assert quadrupoles['knobs'].tolist()==[['kf'], ['kd']]
+
+
+def test_knob_index():
+    my_df=pd.DataFrame({'knobs': [['a'], ['a', 'b'], [], ['b']]}, index=['w', 'x', 'y', 'z'])
+    my_index=mt.knob_index(my_df)
+    assert mt.knob_index(my_df) is my_index
+    assert mt.knob_df('b', my_df).index.tolist()==['x', 'z']
+    assert mt.knob_df('c', my_df).empty
+    assert mt.knobs_df(my_df).loc['a', 'dependences']==['w', 'x']
+    # new row labels: the index is rebuilt
+    my_df.drop(index='x', inplace=True)
+    assert mt.knob_index(my_df) is not my_index
+    assert mt.knob_df('b', my_df).index.tolist()==['z']
+    # in-place change of the knobs (same row labels): the rebuild has to be forced
+    my_df['knobs'].iloc[0].append('b')
+    assert mt.knob_df('b', my_df).index.tolist()==['z']
+    assert mt.knob_index(my_df, rebuild=True).labels('b')==['w', 'z']
+    key=id(my_df)
+    del my_df
+    gc.collect()
+    assert key not in mt._knob_index_cache
+
+
+def test_table_df(mad):
+    mad.input(SEQUENCE+'beam, particle=proton, energy=7000; use, sequence=my_cell; twiss, table=my_twiss;')
+    table=mad.table.my_twiss
+    full=mt.table_df(table)
+    assert full.index.tolist()==list(table.name)
+    selected=mt.table_df(table, columns=['s', 'betx'], classes=['quadrupole'])
+    assert selected.columns.tolist()==['name', 's', 'betx']
+    assert selected.equals(full.loc[full['keyword']=='quadrupole', ['name', 's', 'betx']])
+    assert mt.twiss_df(table, columns=['s'], pattern='q').index.tolist()==['q1:1', 'q2:1']
+    assert mt.table_df(table, s_range=(10, 50))['s'].tolist()==[20., 30., 50.]
+    lazy=mt.LazyTable(table, classes=['quadrupole'], s_range=(10, 100))
+    assert lazy['name'].tolist()==['q2:1']
+    assert 'betx' not in repr(lazy)
+    assert lazy['betx'][0]==full.loc['q2:1', 'betx']
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from cpymad.madx import Madx
+from madxp import cpymadTool as mt
+from madxp import evaluator
+
+_MASK='''
+kqf=0.01; kqd=-0.012; on_x=1; l.mq=3.1;
+a:=kqf*l.mq+sqrt(abs(kqd))^2;
+b:=a*on_x-2*exp(-kqf)+sin(kqd)/cos(kqf);
+c:=round(100*kqf)+floor(10*b)-ceil(10*kqd)+frac(-7.3*on_x);
+d:=-a^2+tanh(b)*erf(kqf)+log10(l.mq)+atan(c);
+qf: quadrupole, l:=l.mq, k1:=kqf+d*1e-3;
+qd: quadrupole, l:=l.mq, k1:=kqd-c*1e-4;
+fodo: sequence, l=20; qf, at=5; qd, at=15; endsequence;
+'''
+
+_SETTINGS={'kqf': [0.01, 0.0213, -0.0171],
+           'kqd': [-0.012, -0.0047, 0.0332],
+           'on_x': [1, 0, 2.5]}
+
+
+def test_knob_model_madx():
+    with Madx(stdout=False) as madx:
+        madx.input(_MASK)
+        my_dict=mt.variables_dict(madx)
+        my_sequence=mt.sequence_df(madx, 'fodo')
+        my_model=evaluator.knob_model(my_dict, list(_SETTINGS), sequence_df=my_sequence, columns=['k1'])
+        assert my_model.frozen==[]
+        my_values=my_model.evaluate({i: np.array(_SETTINGS[i]) for i in _SETTINGS})
+        for j in range(len(_SETTINGS['kqf'])):
+            madx.input(''.join(f'{i}={_SETTINGS[i][j]!r};' for i in _SETTINGS))
+            for i in ['a', 'b', 'c', 'd']:
+                assert my_values[i][j]==pytest.approx(madx.globals[i], rel=1e-12, abs=1e-15)
+            for i in ['qf', 'qd']:
+                assert my_values[f'{i}->k1'][j]==pytest.approx(madx.elements[i].k1, rel=1e-12, abs=1e-15)
+
+
+def test_round_halves():
+    with Madx(stdout=False) as madx:
+        madx.input('k=0.5; r:=round(k); s:=round(-k);')
+        my_model=evaluator.KnobModel({'r': 'round(k)', 's': 'round(-k)'}, {'k': 0.5}, ['k'])
+        my_df=my_model.check(madx, [{'k': i} for i in [0.5, 1.5, 2.5, -2.5, 3.5, 2.49]], rtol=0, atol=0)
+        assert my_df['passed'].all()
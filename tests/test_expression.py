@@ -0,0 +1,40 @@
+import pytest
+from cpymad.madx import Madx
+from madxp import expression
+from madxp import evaluator
+
+
+def _name(i):
+    return ('name', i)
+
+
+def test_precedence():
+    assert expression.parse('a+b*c')==('binary', '+', _name('a'), ('binary', '*', _name('b'), _name('c')))
+    assert expression.parse('a-b-c')==('binary', '-', ('binary', '-', _name('a'), _name('b')), _name('c'))
+    assert expression.parse('a*b^c')==('binary', '*', _name('a'), ('binary', '^', _name('b'), _name('c')))
+    assert expression.parse('(a+b)*c')==('binary', '*', ('binary', '+', _name('a'), _name('b')), _name('c'))
+    assert expression.parse('a<b+c')==('binary', '<', _name('a'), ('binary', '+', _name('b'), _name('c')))
+    assert expression.parse('a||b&&c')==('binary', '||', _name('a'), ('binary', '&&', _name('b'), _name('c')))
+
+
+def test_power():
+    # '^' is left associative and binds tighter than the sign
+    assert expression.parse('a^b^c')==('binary', '^', ('binary', '^', _name('a'), _name('b')), _name('c'))
+    assert expression.parse('-a^2')==('unary', '-', ('binary', '^', _name('a'), ('number', 2.)))
+    assert expression.parse('a**2')==expression.parse('a^2')
+
+
+@pytest.mark.parametrize('my_expression', ['2^3^2', '-2^2', '1+2*3-4/2', '-(1+2)*3', '10/5/2', '3-2-1', '-2^2*3'])
+def test_precedence_madx(my_expression):
+    with Madx(stdout=False) as madx:
+        madx.input(f'a={my_expression};')
+        reference=madx.globals['a']
+    my_model=evaluator.KnobModel({'a': my_expression}, {}, [])
+    assert my_model.evaluate({})['a']==pytest.approx(reference, rel=1e-15)
+
+
+def test_parameters():
+    assert expression.parameters('kqf*l.mq+table(summ,q1)+sqrt(k)')==('k', 'kqf', 'l.mq')
+    assert expression.parameters('mq.1->l*2')==('mq.1->l',)
+    with pytest.raises(ValueError):
+        expression.parse('a+')
@@ -0,0 +1,44 @@
+import pytest
+from cpymad.madx import Madx
+from madxp import cpymadTool as mt
+from madxp.graph import VariableGraph, CyclicDependencyError
+
+
+def test_knobs():
+    # d:=c*pi; c:=b+a; b:=2*a; e:=twopi (a constant only)
+    graph=VariableGraph({'b': ['a'], 'c': ['b', 'a'], 'd': ['c', 'pi'], 'e': ['twopi']},
+                        {'a': 1, 'b': 2, 'c': 2, 'd': 2, 'e': 2, 'pi': 0, 'twopi': 0})
+    assert graph.dependent_variables.index('b')<graph.dependent_variables.index('c')<graph.dependent_variables.index('d')
+    assert graph.knobs('d')==['a']
+    assert graph.knobs('e')==[]
+    assert graph.knobs('a')==['a']
+    assert graph.knobs('pi')==[]
+    assert graph.dependents('a')==['b', 'c', 'd']
+    assert graph.knobs_df().loc['a', 'dependences']==['b', 'c', 'd']
+
+
+def test_deep_knobs():
+    # a chain longer than the recursion limit
+    depth=5000
+    graph=VariableGraph({f'v{i}': [f'v{i-1}'] for i in range(1, depth)}, {f'v{i}': 2 for i in range(depth)})
+    assert graph.knobs(f'v{depth-1}')==['v0']
+    assert len(graph.dependents('v0'))==depth-1
+
+
+def test_cycle():
+    with pytest.raises(CyclicDependencyError) as error:
+        VariableGraph({'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': ['a']}, {i: 2 for i in 'abcd'})
+    assert error.value.cycle==['a', 'b', 'c', 'a']
+    graph=VariableGraph({'d': ['a']}, {i: 2 for i in 'abcd'}, opaque=['a', 'b', 'c'])
+    assert graph.knobs('d')==[]
+
+
+def test_variable_graph_madx():
+    with Madx(stdout=False) as mad:
+        mad.input('a=1; b:=2*a; c:=b+a*pi; d:=c^2+g; g=3; f:=sqrt(b)*twopi;')
+        graph=mt.variable_graph(mad)
+        assert graph.knobs('d')==['a', 'g']
+        assert graph.knobs('f')==['a']
+        assert graph.parents('c')==['a', 'b', 'pi']
+        assert not graph.is_dependent('g')
+        assert graph.is_constant('pi')
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from cpymad.madx import Madx
+from madxp import cpymadTool as mt
+from madxp import optics
+
+# a FODO cell with bends, a closed orbit (thin kicker) and a tilted quadrupole (not supported in numpy)
+SEQUENCE='''kf=0.0056; kd=0.0028;
+qf: quadrupole, l=5, k1:=kf;
+qd: quadrupole, l=5, k1:=-kd*2;
+mb: sbend, l=10, angle=0.02, e1=0.005;
+qt: quadrupole, l=2, k1=0.001, tilt=0.1;
+kick: hkicker, kick=1e-4;
+my_cell: sequence, refer=entry, l=100;
+q1: qf, at=0;
+b1: mb, at=20;
+t1: qt, at=40;
+k1: kick, at=45;
+q2: qd, at=50;
+b2: mb, at=70;
+endsequence;
+beam, particle=proton, energy=7000;
+use, sequence=my_cell;
+twiss, table=my_twiss;
+'''
+
+POSITIONS=[99., 2.5, 12., 20., 25., 41., 52., 75.]
+
+
+@pytest.fixture(scope='module')
+def interpolation():
+    with Madx(stdout=False) as mad:
+        mad.input(SEQUENCE)
+        my_table=mt.twiss_df(mad.table.my_twiss)
+    return my_table, mt.table_interpolation_df(POSITIONS, my_table)
+
+
+def _check(my_df, reference, rtol):
+    assert my_df['s'].tolist()==POSITIONS
+    assert my_df['keyword'].tolist()==reference['keyword'].tolist()
+    for i in ['betx', 'alfx', 'mux', 'bety', 'alfy', 'muy', 'dx', 'dpx', 'x', 'px']:
+        aux=reference[i].astype(float).values
+        assert np.allclose(my_df[i].astype(float), aux, rtol=0, atol=rtol*np.abs(aux).max()), i
+
+
+def test_matrix(interpolation):
+    # the matrix method neglects the chromatic effects: the dispersion differs at the 1e-3 level
+    my_table, reference=interpolation
+    my_df=mt.table_interpolation_df(POSITIONS, my_table, method='matrix')
+    assert my_df.columns.tolist()==[i for i in optics.INTERPOLATION_COLUMNS if i in my_table.columns]
+    _check(my_df, reference, 1e-3)
+    # the tilted quadrupole is interpolated by MAD-X
+    assert my_df['betx'].iloc[5]==reference['betx'].iloc[5]
+
+
+def test_batch(interpolation):
+    my_table, reference=interpolation
+    _check(mt.table_interpolation_df(POSITIONS, my_table, method='batch'), reference, 1e-8)
+
+
+def test_processes(interpolation):
+    my_table, reference=interpolation
+    assert mt.table_interpolation_df(POSITIONS, my_table, processes=2).equals(reference)
+    # the fallback positions of the batch method are run on the pool too
+    assert mt.table_interpolation_df(POSITIONS, my_table, method='batch', processes=2).equals(
+        mt.table_interpolation_df(POSITIONS, my_table, method='batch'))
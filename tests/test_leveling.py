@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from scipy import optimize
+from madxp import leveling, luminosity
+from test_luminosity import PARAMETERS
+
+# a fill with the intensity decaying in 10 hours
+TIME=np.linspace(0, 36000, 31)
+INTENSITY=2.2e11*np.exp(-TIME/36000)
+TIMELINE=dict(PARAMETERS, N1=INTENSITY, N2=INTENSITY)
+
+
+def _brentq(step, variable, bounds, target):
+    def function(value):
+        aux={i: (j[step] if isinstance(j, np.ndarray) else j) for i, j in TIMELINE.items()}
+        for i, factor in leveling.LEVELING_VARIABLES[variable].items():
+            aux[i]=factor*value
+        return np.log(luminosity.L(**aux, closed_form=False)/target)
+    return optimize.brentq(function, *bounds, xtol=1e-12)
+
+
+@pytest.mark.parametrize('variable, bounds', [('separation_x', [0, 100e-6]), ('beta', [0.3, 10])])
+def test_level(variable, bounds):
+    target=5e33
+    my_df, integrated=leveling.level(TIMELINE, variable, bounds, target_luminosity=target, time=TIME, rtol=1e-8)
+    assert my_df['leveled'].all()
+    assert np.allclose(my_df['luminosity [Hz/cm^2]'], target, rtol=1e-8, atol=0)
+    assert integrated==pytest.approx(target*TIME[-1], rel=1e-8)
+    for step in [0, 7, 30]:
+        assert my_df[variable].iloc[step]==pytest.approx(_brentq(step, variable, bounds, target), rel=1e-6)
+
+
+def test_level_unreachable():
+    # with the pile-up target the luminosity is lower; at the end of the fill the target is not reachable
+    my_df, integrated=leveling.level(TIMELINE, 'separation_x', [0, 100e-6], target_pileup=60, target_luminosity=5e34)
+    assert integrated is None
+    reachable=my_df['leveled'].values
+    assert reachable[0] and not reachable[-1]
+    assert np.allclose(my_df['pileup'][reachable], 60, rtol=1e-4, atol=0)
+    assert (my_df['separation_x'][~reachable]==0).all()
+    assert (my_df['pileup'][~reachable]<60).all()
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from cpymad.madx import Madx
+from madxp import luminosity
+from madxp import cpymadTool as mt
+
+PARAMETERS=dict(f=11245.5, nb=2736, N1=1.15e11, N2=1.15e11,
+                x_1=0, x_2=0, y_1=0, y_2=0,
+                px_1=160e-6, px_2=-160e-6, py_1=0, py_2=0,
+                energy_tot1=6800, energy_tot2=6800,
+                deltap_p0_1=1.1e-4, deltap_p0_2=1.1e-4,
+                epsilon_x1=2.5e-6, epsilon_x2=2.5e-6, epsilon_y1=2.5e-6, epsilon_y2=2.5e-6,
+                sigma_z1=0.0755, sigma_z2=0.0755,
+                beta_x1=0.3, beta_x2=0.3, beta_y1=0.3, beta_y2=0.3,
+                alpha_x1=0, alpha_x2=0, alpha_y1=0, alpha_y2=0,
+                dx_1=0, dx_2=0, dy_1=0, dy_2=0, dpx_1=0, dpx_2=0, dpy_1=0, dpy_2=0)
+
+
+def test_L_batch():
+    my_beta=np.array([0.15, 0.3, 1., 11.])[:, np.newaxis]
+    my_parameters=dict(PARAMETERS, beta_x1=my_beta, beta_x2=my_beta, beta_y1=my_beta, beta_y2=my_beta,
+                       y_1=np.array([0, 10e-6, 40e-6]), alpha_x1=0.5, dx_2=0.1, dpy_1=0.02, sigma_z2=0.09)
+    my_df=luminosity.check_L_batch(my_parameters, samples=12, rtol=1e-8)
+    assert my_df['passed'].all()
+    assert len(my_df)==12
+
+
+def test_L_batch_shape():
+    my_result, info=luminosity.L_batch(**dict(PARAMETERS, N1=np.array([1e11, 1.15e11])), full_output=True)
+    assert my_result.shape==(2,)
+    assert info['converged']
+    assert my_result[1]==pytest.approx(luminosity.L(**PARAMETERS, closed_form=False), rel=1e-8)
+
+
+@pytest.mark.parametrize('beta', [3., 11., 30.])
+def test_closed_form(beta):
+    my_parameters=dict(PARAMETERS, beta_x1=beta, beta_x2=beta, beta_y1=beta, beta_y2=beta, y_1=5e-6)
+    my_result, info=luminosity.L(**my_parameters, rtol=1e-4, full_output=True)
+    reference, reference_info=luminosity.L(**my_parameters, closed_form=False, full_output=True)
+    assert info['path']=='closed form'
+    assert reference_info['path']=='quad'
+    # the estimated error bounds the true one
+    assert abs(my_result/reference-1)<=max(info['error'], 1e-12)
+    assert info['error']<=1e-4
+
+
+def test_closed_form_fallback():
+    # strong hourglass effect: the expansion is not a Gaussian, quad is used without warnings
+    my_parameters=dict(PARAMETERS, beta_x1=0.01, beta_x2=0.01, beta_y1=0.01, beta_y2=0.01)
+    with np.errstate(all='raise'):
+        my_result, info=luminosity.L(**my_parameters, full_output=True)
+    assert info['path']=='quad'
+    assert my_result==luminosity.L(**my_parameters, closed_form=False)
+
+
+CRAB_CAVITIES=dict(CC_V_x_1=3e6, CC_f_x_1=400.79e6, R12_1=21, CC_V_x_2=-3e6, CC_f_x_2=400.79e6, R12_2=21)
+
+
+def test_hermite():
+    my_parameters=dict(PARAMETERS, **CRAB_CAVITIES)
+    my_result, info=luminosity.L(**my_parameters, full_output=True)
+    reference, reference_info=luminosity.L(**my_parameters, full_output=True, cc_integration='dblquad', sigma_integration=6)
+    assert info['path']=='hermite'
+    assert info['converged']
+    assert reference_info['path']=='dblquad'
+    assert my_result==pytest.approx(reference, rel=1e-7)
+    my_batch=luminosity.L_batch(**dict(my_parameters, N1=np.array([1.15e11, 1e11])))
+    assert my_batch[0]==pytest.approx(my_result, rel=1e-8)
+
+
+def test_hermite_not_converged(capsys):
+    my_result, info=luminosity.L_batch(**PARAMETERS, **CRAB_CAVITIES, order=4, max_order=8, full_output=True)
+    assert not info['converged']
+    assert 'did not converge' in capsys.readouterr().out
+
+
+# a ring with an orbit, dispersion and alpha at the IP. B2 circulates in the opposite direction:
+# as lhcb2 it is the same sequence with bv=-1, as lhcb4 it is the reflected sequence in its own frame
+# (x and s reversed: the quadrupoles and the vertical kicker change sign)
+RING='''{name}: sequence, refer=entry, l=100;
+q1_{name}: quadrupole, l=5, k1={sign}*0.0056, at=0;
+b1_{name}: sbend, l=10, angle=0.02, at=20;
+h1_{name}: hkicker, kick=2e-7, at=40;
+v1_{name}: vkicker, kick={sign}*3e-7, at=42;
+q2_{name}: quadrupole, l=5, k1={sign}*(-0.0056), at=50;
+ip1, at=62;
+b2_{name}: sbend, l=10, angle=0.02, at=70;
+endsequence;
+'''
+
+
+def test_twiss_luminosity():
+    with Madx(stdout=False) as mad:
+        mad.input('ip1: marker;')
+        for name, sign in [('b1', 1), ('b2', 1), ('b4', -1)]:
+            mad.input(RING.format(name=name, sign=sign))
+        mad.input('seqedit, sequence=b4; flatten; reflect; endedit;')
+        beam='particle=proton, energy=7000, npart=1.15e11, exn=2.5e-6, eyn=2.5e-6, sigt=0.0755, sige=1.1e-4, kbunch=2736'
+        mad.input(f'beam, sequence=b1, {beam}; beam, sequence=b2, bv=-1, {beam}; beam, sequence=b4, {beam};')
+        twiss={}
+        for name in ['b1', 'b2', 'b4']:
+            mad.input(f'use, sequence={name}; twiss, table=twiss_{name};')
+            twiss[name]=mt.twiss_df(mad.table[f'twiss_{name}'])
+        beams_df=mt.beams_df(mad)
+    lhcb2=luminosity.twiss_luminosity(twiss['b1'], twiss['b2'], beams_df, ['ip1'], beam_b1='b1', beam_b2='b2')
+    lhcb4=luminosity.twiss_luminosity(twiss['b1'], twiss['b4'], beams_df, ['ip1:1'], beam_b1='b1', beam_b2='b4', b2='lhcb4')
+    assert lhcb2.loc['ip1', 'luminosity [Hz/cm^2]']==pytest.approx(lhcb4.loc['ip1:1', 'luminosity [Hz/cm^2]'], rel=1e-7)
+    for i in ['x_2', 'px_2', 'py_2', 'alpha_x2', 'alpha_y2', 'dx_2', 'dpx_2']:
+        assert lhcb2.loc['ip1', i]==pytest.approx(lhcb4.loc['ip1:1', i], rel=1e-4), i
+    # the B4 twiss read in the B1 frame gives a different luminosity
+    wrong=luminosity.twiss_luminosity(twiss['b1'], twiss['b4'], beams_df, ['ip1'], beam_b1='b1', beam_b2='b4')
+    assert abs(wrong.loc['ip1', 'luminosity [Hz/cm^2]']/lhcb2.loc['ip1', 'luminosity [Hz/cm^2]']-1)>1e-4
+    assert lhcb2.loc['ip1', 'luminosity [Hz/cm^2]']==pytest.approx(luminosity.L(**lhcb2.loc['ip1', luminosity._L_ARGUMENTS]), rel=1e-6)
@@ -0,0 +1,30 @@
+import numpy as np
+from cpymad.madx import Madx
+import madxp
+
+MASK='''!## Subsections
+a=1;
+! a comment between two subsections
+b=2;
+!## Block
+i=0;
+while (i<3) {
+! a comment inside the block
+    i=i+1;
+};
+! a comment after the block
+c=i;
+'''
+
+
+def test_subsection_times(tmp_path):
+    (tmp_path/'input.madx').write_text(MASK)
+    my_hooks=[]
+    with Madx(stdout=False) as madx:
+        my_profile=madxp.df2run(madx, madxp.madx2df(str(tmp_path/'input.madx')), snapshot='none',
+                                hooks={'subsection_end': lambda *args: my_hooks.append(args)})
+        assert madx.globals['c']==3
+    assert np.isfinite(my_profile.loc['Subsections', 'subsection times [s]']).all()
+    assert np.isnan(my_profile.loc['Block', 'subsection times [s]']).tolist()==[True, True, True, False, False]
+    assert my_profile['madx time [s]'].min()>0
+    assert [i[1] for i in my_hooks]==[0, 1, 2]+list(range(5))
@@ -0,0 +1,80 @@
+import os
+import pandas as pd
+import pytest
+from madxp import scan
+
+MASK='''!## Define the sequence
+cell_length=100;
+qf: quadrupole, l=5, k1=0.0056;
+qd: quadrupole, l=5, k1:=-kd;
+my_cell: sequence, refer=entry, l=cell_length;
+q1: qf, at=0;
+q2: qd, at=cell_length/2;
+endsequence;
+beam, particle=proton, energy=7000;
+use, sequence=my_cell;
+!## Errors and macros
+select, flag=error, clear;
+select, flag=error, pattern=q1;
+ealign, dx=0.001;
+set_k: macro = {
+    kd=k;
+};
+!## Scanned strength
+//madx.input(f"k={pythonData['k']}; exec, set_k; twiss, table=my_twiss;")
+!## Python data extraction
+//pythonData['x']=madx.table.my_twiss.x[1]
+//pythonData['q1']=madx.table.summ.q1[0]
+'''
+
+POINTS=scan.grid(k=[0.0056, 0.0062])
+
+# a point fails (negative strength) and a point exceeds the timeout
+CHECK_MASK='''!## Check the point
+//import time
+//assert pythonData['k']>0, 'negative strength'
+//time.sleep(pythonData.get('sleep', 0))
+//pythonData['k2']=pythonData['k']**2
+'''
+
+
+def test_grid():
+    assert scan.grid(a=[1, 2], b='xy')==[{'a': 1, 'b': 'x'}, {'a': 1, 'b': 'y'}, {'a': 2, 'b': 'x'}, {'a': 2, 'b': 'y'}]
+
+
+def test_scan(tmp_path):
+    (tmp_path/'input.madx').write_text(CHECK_MASK)
+    points=[{'k': 2}, {'k': -1}, {'k': 3, 'sleep': 60}, {'k': 4}]
+    my_scan=scan.scan(str(tmp_path/'input.madx'), points, pythonData={'common': 1}, output_folder=str(tmp_path/'scan'),
+                      processes=2, timeout=5, snapshot='none')
+    assert my_scan['status'].tolist()==['ok', 'failed', 'timeout', 'ok']
+    assert my_scan['k'].tolist()==[2, -1, 3, 4]
+    assert my_scan['k2'].tolist()[::3]==[4, 16]
+    assert (my_scan['common']==1).all()
+    assert 'negative strength' in my_scan['error'].iloc[1]
+    assert os.path.isfile(my_scan['output DF'].iloc[0])
+    assert pd.read_pickle(str(tmp_path/'scan'/'scan.pkl'))['status'].equals(my_scan['status'])
+
+
+def test_sweep(tmp_path):
+    (tmp_path/'input.madx').write_text(MASK)
+    my_scan=scan.scan(str(tmp_path/'input.madx'), POINTS, output_folder=str(tmp_path/'scan'), snapshot='none')
+    my_sweep=scan.sweep(str(tmp_path/'input.madx'), POINTS, 'Errors and macros',
+                        output_folder=str(tmp_path/'sweep'), snapshot='none')
+    assert (my_scan['status']=='ok').all()
+    assert (my_sweep['status']=='ok').all()
+    assert my_scan['x'].tolist()==my_sweep['x'].tolist()
+    assert my_scan['q1'].tolist()==my_sweep['q1'].tolist()
+    assert my_scan['x'].abs().min()>0
+    assert my_scan['q1'].iloc[0]!=my_scan['q1'].iloc[1]
+
+
+def test_sweep_cache(tmp_path):
+    (tmp_path/'input.madx').write_text(MASK)
+    with pytest.raises(Exception, match='ealign'):
+        scan.sweep(str(tmp_path/'input.madx'), POINTS, 'Errors and macros', output_folder=str(tmp_path/'sweep'), fork_madx=False)
+    my_scan=scan.scan(str(tmp_path/'input.madx'), POINTS, output_folder=str(tmp_path/'scan'), snapshot='none')
+    my_sweep=scan.sweep(str(tmp_path/'input.madx'), POINTS, 'Define the sequence',
+                        output_folder=str(tmp_path/'sweep'), snapshot='none', fork_madx=False)
+    assert (my_sweep['status']=='ok').all()
+    assert my_scan['x'].tolist()==my_sweep['x'].tolist()
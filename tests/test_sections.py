@@ -0,0 +1,89 @@
+import pytest
+from cpymad.madx import Madx
+import madxp
+
+MASK='''!## Define the elements
+! The **length** of the quadrupoles
+quadrupole_length=5;
+cell_length=100;
+!## Python section
+//pythonData['a']=1
+!## Empty section
+!## Last section
+qf: quadrupole, l=quadrupole_length;
+'''
+
+
+def test_madx_sections(tmp_path):
+    (tmp_path/'input.madx').write_text(MASK)
+    my_sections=madxp.madx_sections(str(tmp_path/'input.madx'))
+    title, section=next(my_sections)
+    assert title=='Define the elements'
+    assert section['Code subsections']==[{'markdown': ' The **length** of the quadrupoles'},
+                                         {'madx': 'quadrupole_length=5;\ncell_length=100;\n'}]
+    assert section['Line']==1
+    assert section['Subsection lines']==[2, 3]
+    my_df=madxp.madx2df(str(tmp_path/'input.madx'))
+    assert my_df.index.tolist()==['Define the elements', 'Python section', 'Empty section', 'Last section']
+    assert my_df['Line'].tolist()==[1, 5, 7, 8]
+    assert my_df.loc['Python section', 'Code subsections']==[{'python': "pythonData['a']=1"}]
+    assert my_df.loc['Empty section', 'Code subsections']==[]
+    (tmp_path/'wrong.madx').write_text('a=1;\n'+MASK)
+    with pytest.raises(AssertionError):
+        madxp.madx2df(str(tmp_path/'wrong.madx'))
+
+
+def test_df2run_generator(tmp_path):
+    (tmp_path/'input.madx').write_text(MASK)
+    pythonData={}
+    with Madx(stdout=False) as madx:
+        my_df=madxp.df2run(madx, madxp.madx_sections(str(tmp_path/'input.madx')), pythonData=pythonData, snapshot='none')
+        assert madx.elements['qf'].l==5
+    assert my_df.index.tolist()==madxp.madx2df(str(tmp_path/'input.madx')).index.tolist()
+    assert pythonData=={'a': 1}
+
+
+def test_df2madx(tmp_path):
+    (tmp_path/'input.madx').write_text(MASK)
+    my_df=madxp.madx2df(str(tmp_path/'input.madx'))
+    assert madxp.df2madx(my_df)==MASK
+    assert madxp.df2madx(my_df, str(tmp_path/'output.madx')) is None
+    assert (tmp_path/'output.madx').read_text()==MASK
+
+
+def test_madx2md(tmp_path, monkeypatch):
+    (tmp_path/'input.madx').write_text(MASK)
+    madxp.madx2md(str(tmp_path/'input.madx'), str(tmp_path/'output.md'))
+    markdown=(tmp_path/'output.md').read_text()
+    assert markdown.startswith('## Define the elements\n The **length** of the quadrupoles\n```fortran\nquadrupole_length=5;')
+    assert "```python\n# python code\npythonData['a']=1\n```\n" in markdown
+    madxp.madx2md(str(tmp_path/'input.madx'), str(tmp_path/'incremental.md'), incremental=True)
+    assert (tmp_path/'incremental.md').read_text()==markdown
+    # only the modified section is rendered again
+    rendered=[]
+    section2md=madxp._section2md
+    monkeypatch.setattr(madxp, '_section2md', lambda title, *args: rendered.append(title) or section2md(title, *args))
+    (tmp_path/'input.madx').write_text(MASK.replace('l=quadrupole_length', 'l=2*quadrupole_length'))
+    madxp.madx2md(str(tmp_path/'input.madx'), str(tmp_path/'incremental.md'), incremental=True)
+    assert rendered==['Last section']
+    assert 'l=2*quadrupole_length' in (tmp_path/'incremental.md').read_text()
+
+
+def test_namespace(tmp_path):
+    (tmp_path/'input.madx').write_text('''!## Define a function
+//def twice(x):
+//    return 2*x
+!## Use it
+//pythonData['b']=twice(madx.globals['quadrupole_length'])
+''')
+    namespace={'quadrupole_length': 3}
+    madxp._compile_python.cache_clear()
+    with Madx(stdout=False) as madx:
+        madx.input('quadrupole_length=5;')
+        for i in range(2):
+            pythonData={}
+            madxp.df2run(madx, madxp.madx2df(str(tmp_path/'input.madx')), pythonData=pythonData, snapshot='none', namespace=namespace)
+            assert pythonData=={'b': 10}
+    assert namespace['twice'](1)==2
+    assert namespace['quadrupole_length']==3
+    assert madxp._compile_python.cache_info().hits==2
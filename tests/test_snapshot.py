@@ -0,0 +1,80 @@
+import pickle
+import numpy as np
+from cpymad.madx import Madx
+import madxp
+from madxp import snapshot as sn
+
+MASK='''!## Define the elements
+quadrupole_length=5;
+cell_length=100;
+!## Define the sequence
+myK:=2.8/cell_length/quadrupole_length;
+qf: quadrupole, l=quadrupole_length, k1=myK;
+qd: quadrupole, l=quadrupole_length, k1=-myK;
+my_cell: sequence, refer=entry, l=cell_length;
+q1: qf, at=0;
+q2: qd, at=cell_length/2;
+endsequence;
+!## Define the beam [snapshot]
+beam, particle=proton, energy=7000;
+!## Change the length
+quadrupole_length=4;
+use, sequence=my_cell;
+'''
+
+
+def _run(tmp_path, **kwargs):
+    (tmp_path/'input.madx').write_text(MASK)
+    with Madx(stdout=False) as madx:
+        return madxp.df2run(madx, madxp.madx2df(str(tmp_path/'input.madx')), **kwargs)
+
+
+def test_state_diff():
+    # a NaN in a new tuple is equal to the previous one
+    old={'globals': {'a': (1., '', 0), 'b': (2., '', 0), 'c': (np.nan, '', 0)}, 'sequences': {}, 'beams': {}}
+    new={'globals': {'a': (1., '', 0), 'b': (3., 'a*3', 1), 'c': (float('nan'), '', 0), 'd': (4., '', 0)},
+         'sequences': {'s': {'beam': False, 'expanded': False}}, 'beams': {}}
+    diff=sn.state_diff(old, new)
+    assert diff['globals']=={'changed': {'b': (3., 'a*3', 1), 'd': (4., '', 0)}, 'removed': []}
+    assert sn.apply_diff(old, diff)['globals'].keys()==new['globals'].keys()
+    assert sn.apply_diff(old, diff)['globals']['b']==new['globals']['b']
+    assert sn.apply_diff(old, diff)['sequences']==new['sequences']
+    assert sn.state_diff(new, old)['globals']['removed']==['d']
+    assert sn.apply_diff(new, sn.state_diff(new, old))['globals'].keys()==old['globals'].keys()
+
+
+def test_expand_profile(tmp_path):
+    full=_run(tmp_path, snapshot='full')
+    diff=_run(tmp_path, snapshot='diff')
+    assert 'sequences_df' not in diff
+    expanded=sn.expand_profile(diff)
+    for key in sn.SNAPSHOT_COLUMNS:
+        for i, j in zip(full[key], expanded[key]):
+            assert i.equals(j)
+    assert sn.section_snapshot(diff, 'Define the sequence')['sequences_df'].equals(full.loc['Define the sequence', 'sequences_df'])
+    # only the changed variables are stored (the deferred expressions are stored if their value changed)
+    assert sorted(diff.loc['Change the length', 'workspace_diff']['globals']['changed'])==['myk', 'quadrupole_length']
+
+
+def test_lazy_snapshot(tmp_path):
+    full=_run(tmp_path, snapshot='full')
+    lazy=_run(tmp_path, snapshot='full', lazy=True)
+    aux=lazy.loc['Define the sequence', 'sequences_df']
+    assert isinstance(aux, sn.LazyFrame)
+    assert aux._deferred.snapshot is None
+    assert aux.frame.equals(full.loc['Define the sequence', 'sequences_df'])
+    assert aux.index.tolist()==['my_cell']
+    # only the raw state is pickled
+    lazy=pickle.loads(pickle.dumps(lazy))
+    for key in sn.SNAPSHOT_COLUMNS:
+        for i, j in zip(full[key], lazy[key]):
+            assert i.equals(j.frame)
+
+
+def test_marked_snapshot(tmp_path):
+    marked=_run(tmp_path, snapshot='marked')
+    assert marked['sequences_df'].notna().tolist()==[False, False, True, False]
+    assert marked.loc['Define the beam [snapshot]', 'sequences_df'].index.tolist()==['my_cell']
+    values=_run(tmp_path, snapshot=['quadrupole_length', 'myk'])
+    assert values['quadrupole_length'].tolist()==[5, 5, 5, 4]
+    assert np.isnan(values['myk'].iloc[0])